@@ -0,0 +1,306 @@
+"""
+Gerador de carga para o main.py rodando contra os stubs de bench/stubs.py.
+
+Cenários (misturados por peso):
+    api       POST /api/buy → POST /api/wait
+    telegram  update de callback "comprar_<serviço>" em /webhook/telegram
+    webhook   POST /webhook/smsbower para AIDs comprados pela API
+    mp        notificação de pagamento em /webhook/mercadopago
+
+Os usuários de teste (ids 990000000+) são criados direto no banco, com
+token "bench-<n>" e saldo alto lançado no livro-razão (saldo_lancamentos,
+tipo 'bench'); a coluna usuarios.saldo é legada e o app não a lê. Ao final imprime vazão, p50/p99 por
+operação e o pico de threads/RSS do processo do app.
+
+    python bench/carga.py --iniciar-app --stubs http://127.0.0.1:9100 --duracao 60
+"""
+import argparse
+import collections
+import json
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+
+import psycopg2
+import requests
+
+UID_BASE = 990000000
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+_lock = threading.Lock()
+latencias = collections.defaultdict(list)   # operação -> [segundos]
+erros = collections.Counter()               # operação -> n
+aids_api = collections.deque(maxlen=5000)
+amostras = []                               # (ts, threads, rss_kb)
+
+
+def registrar(op, t0, ok=True):
+    dt = time.perf_counter() - t0
+    with _lock:
+        latencias[op].append(dt)
+        if not ok:
+            erros[op] += 1
+
+
+def percentil(valores, p):
+    if not valores:
+        return 0.0
+    ordenados = sorted(valores)
+    return ordenados[min(len(ordenados) - 1, int(p / 100.0 * len(ordenados)))]
+
+
+# ------------------------------------------------------------------
+# preparação
+# ------------------------------------------------------------------
+# mesmo cálculo de SALDO_CENTAVOS_SQL no main.py (snapshot + pendentes)
+SALDO_CENTAVOS_SQL = """(
+    COALESCE((SELECT centavos FROM saldo_snapshot WHERE user_id=%(uid)s), 0)
+  + COALESCE((SELECT sum(valor_centavos) FROM saldo_lancamentos WHERE user_id=%(uid)s AND NOT compactado), 0)
+)::bigint"""
+
+
+def semear_usuarios(database_url, n, saldo):
+    alvo = int(round(saldo * 100))
+    with psycopg2.connect(database_url) as conn, conn.cursor() as cur:
+        for i in range(n):
+            uid = str(UID_BASE + i)
+            cur.execute("""
+                INSERT INTO usuarios (id, numeros, refer, indicados)
+                VALUES (%s, '[]', NULL, '[]')
+                ON CONFLICT (id) DO NOTHING
+            """, (uid,))
+            # lança só a diferença: rodadas seguidas voltam ao mesmo saldo
+            cur.execute(f"""
+                INSERT INTO saldo_lancamentos (user_id, valor_centavos, tipo)
+                SELECT %(uid)s, d, 'bench'
+                FROM (SELECT %(alvo)s - {SALDO_CENTAVOS_SQL} AS d) x
+                WHERE d <> 0
+            """, {"uid": uid, "alvo": alvo})
+            cur.execute("""
+                INSERT INTO api_tokens (user_id, token) VALUES (%s, %s)
+                ON CONFLICT (user_id) DO UPDATE SET token=EXCLUDED.token
+            """, (uid, f"bench-{i}"))
+    return [(UID_BASE + i, f"bench-{i}") for i in range(n)]
+
+
+def iniciar_app(args):
+    env = dict(os.environ)
+    base = args.stubs.rstrip('/')
+    env.update({
+        "PORT": str(args.porta_app),
+        "SMSBOWER_URL": f"{base}/smsbower/handler_api.php",
+        "SMSBOWER_WEB_URL": f"{base}/smsbower/getPricesByService",
+        "SMS24H_URL": f"{base}/sms24h/handler_api",
+        "TELEGRAM_API_URL": f"{base}/tg",
+        "MP_API_URL": f"{base}/mp",
+        "BOT_TOKEN": env.get("BOT_TOKEN") or "1:bench",
+        "API_KEY_SMSBOWER": env.get("API_KEY_SMSBOWER") or "bench",
+        "API_KEY_SMS24H": env.get("API_KEY_SMS24H") or "bench",
+        "MP_ACCESS_TOKEN": env.get("MP_ACCESS_TOKEN") or "bench",
+        "SITE_URL": "",
+    })
+    proc = subprocess.Popen([sys.executable, os.path.join(RAIZ, "main.py")], env=env, cwd=RAIZ)
+    for _ in range(120):
+        try:
+            requests.get(f"{args.app}/", timeout=1)
+            return proc
+        except requests.RequestException:
+            if proc.poll() is not None:
+                raise SystemExit("app terminou durante a inicialização")
+            time.sleep(0.5)
+    proc.terminate()
+    raise SystemExit("app não respondeu em 60s")
+
+
+def amostrar_processo(pid, parar):
+    while not parar.is_set():
+        try:
+            with open(f"/proc/{pid}/status") as f:
+                campos = dict(l.split(":", 1) for l in f if ":" in l)
+            amostras.append((time.time(), int(campos["Threads"]), int(campos["VmRSS"].split()[0])))
+        except (OSError, KeyError, ValueError):
+            pass
+        parar.wait(1)
+
+
+# ------------------------------------------------------------------
+# cenários
+# ------------------------------------------------------------------
+def cenario_api(sessao, args, uid, token):
+    t0 = time.perf_counter()
+    try:
+        r = sessao.post(f"{args.app}/api/buy", json={"token": token, "service": args.servico}, timeout=60)
+        corpo = r.json()
+        ok = r.status_code == 200 and corpo.get("status") == "success"
+    except (requests.RequestException, ValueError):
+        ok, corpo = False, {}
+    registrar("api_buy", t0, ok)
+    if not ok:
+        return
+    aid = corpo["aid"]
+    aids_api.append(aid)
+    t0 = time.perf_counter()
+    try:
+        r = sessao.post(f"{args.app}/api/wait", json={"token": token, "aid": aid, "timeout": args.wait_timeout},
+                        timeout=args.wait_timeout + 30)
+        ok = r.status_code == 200
+    except requests.RequestException:
+        ok = False
+    registrar("api_wait", t0, ok)
+
+
+def cenario_telegram(sessao, args, uid, token):
+    update = {
+        "update_id": random.randint(1, 2 ** 31),
+        "callback_query": {
+            "id": str(random.randint(1, 2 ** 31)),
+            "from": {"id": uid, "is_bot": False, "first_name": "bench"},
+            "chat_instance": "bench",
+            "data": f"comprar_{args.servico}",
+            "message": {
+                "message_id": random.randint(1, 2 ** 20),
+                "date": int(time.time()),
+                "chat": {"id": uid, "type": "private"},
+                "text": "menu",
+            },
+        },
+    }
+    t0 = time.perf_counter()
+    try:
+        r = sessao.post(f"{args.app}/webhook/telegram", data=json.dumps(update), timeout=30)
+        ok = r.status_code == 200
+    except requests.RequestException:
+        ok = False
+    registrar("webhook_telegram", t0, ok)
+
+
+def cenario_webhook(sessao, args, uid, token):
+    with _lock:
+        aid = random.choice(aids_api) if aids_api else str(random.randint(1, 10 ** 9))
+    t0 = time.perf_counter()
+    try:
+        r = sessao.post(f"{args.app}/webhook/smsbower", json={
+            "activationId": aid,
+            "service": args.servico,
+            "text": f"codigo {random.randint(0, 999999):06d}",
+        }, timeout=30)
+        ok = r.status_code == 200
+    except requests.RequestException:
+        ok = False
+    registrar("webhook_smsbower", t0, ok)
+
+
+def cenario_mp(sessao, args, uid, token):
+    # formato entendido pelo stub: bench-<uid>-<centavos>-<único>
+    pid = f"bench-{uid}-{random.choice((1000, 2000, 5000))}-{random.getrandbits(40)}"
+    t0 = time.perf_counter()
+    try:
+        r = sessao.post(f"{args.app}/webhook/mercadopago", json={"type": "payment", "data": {"id": pid}}, timeout=30)
+        ok = r.status_code == 200
+    except requests.RequestException:
+        ok = False
+    registrar("webhook_mp", t0, ok)
+
+
+CENARIOS = {
+    "api": cenario_api,
+    "telegram": cenario_telegram,
+    "webhook": cenario_webhook,
+    "mp": cenario_mp,
+}
+
+
+def trabalhador(args, usuarios, pesos, fim):
+    sessao = requests.Session()
+    nomes, ws = zip(*pesos)
+    while time.time() < fim:
+        uid, token = random.choice(usuarios)
+        CENARIOS[random.choices(nomes, ws)[0]](sessao, args, uid, token)
+
+
+def relatorio(duracao):
+    linhas = [f"{'operação':<20}{'n':>8}{'erros':>8}{'req/s':>10}{'p50 ms':>10}{'p99 ms':>10}"]
+    resumo = {}
+    for op in sorted(latencias):
+        vals = latencias[op]
+        r = {
+            "n": len(vals),
+            "erros": erros[op],
+            "rps": len(vals) / duracao,
+            "p50_ms": percentil(vals, 50) * 1000,
+            "p99_ms": percentil(vals, 99) * 1000,
+        }
+        resumo[op] = r
+        linhas.append(f"{op:<20}{r['n']:>8}{r['erros']:>8}{r['rps']:>10.1f}{r['p50_ms']:>10.1f}{r['p99_ms']:>10.1f}")
+    if amostras:
+        resumo["processo"] = {
+            "threads_max": max(a[1] for a in amostras),
+            "rss_max_mb": max(a[2] for a in amostras) / 1024,
+            "rss_final_mb": amostras[-1][2] / 1024,
+        }
+        p = resumo["processo"]
+        linhas.append(f"threads (máx): {p['threads_max']}   RSS máx/final: {p['rss_max_mb']:.1f}/{p['rss_final_mb']:.1f} MB")
+    return "\n".join(linhas), resumo
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--app", default="http://127.0.0.1:8080")
+    ap.add_argument("--porta-app", type=int, default=8080, help="porta usada com --iniciar-app")
+    ap.add_argument("--stubs", default="http://127.0.0.1:9100", help="base de bench/stubs.py")
+    ap.add_argument("--iniciar-app", action="store_true", help="sobe o main.py apontando para os stubs")
+    ap.add_argument("--pid", type=int, help="PID do app para medir threads/RSS (sem --iniciar-app)")
+    ap.add_argument("--database-url", default=os.getenv("DATABASE_URL"))
+    ap.add_argument("--usuarios", type=int, default=50)
+    ap.add_argument("--saldo", type=float, default=100000.0)
+    ap.add_argument("--concorrencia", type=int, default=20)
+    ap.add_argument("--duracao", type=float, default=60, help="segundos")
+    ap.add_argument("--servico", default="mercado")
+    ap.add_argument("--wait-timeout", type=int, default=30)
+    ap.add_argument("--cenarios", default="api=4,telegram=3,webhook=2,mp=1", help="nome=peso,...")
+    ap.add_argument("--json", help="grava o resumo neste arquivo")
+    args = ap.parse_args()
+
+    if not args.database_url:
+        raise SystemExit("defina DATABASE_URL (o app precisa de um Postgres de teste)")
+    pesos = []
+    for item in args.cenarios.split(","):
+        nome, _, peso = item.partition("=")
+        if nome not in CENARIOS:
+            raise SystemExit(f"cenário desconhecido: {nome}")
+        pesos.append((nome, float(peso or 1)))
+
+    proc = iniciar_app(args) if args.iniciar_app else None
+    pid = proc.pid if proc else args.pid
+    parar = threading.Event()
+    try:
+        usuarios = semear_usuarios(args.database_url, args.usuarios, args.saldo)
+        if pid:
+            threading.Thread(target=amostrar_processo, args=(pid, parar), daemon=True).start()
+        inicio = time.time()
+        fim = inicio + args.duracao
+        threads = [threading.Thread(target=trabalhador, args=(args, usuarios, pesos, fim), daemon=True)
+                   for _ in range(args.concorrencia)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        duracao = time.time() - inicio
+    finally:
+        parar.set()
+        if proc:
+            proc.terminate()
+            proc.wait(30)
+
+    texto, resumo = relatorio(duracao)
+    print(texto)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(resumo, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
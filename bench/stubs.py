@@ -0,0 +1,308 @@
+"""
+Servidores falsos para testar carga no main.py sem gastar saldo real.
+
+Um único processo responde por quatro serviços, separados por prefixo:
+
+    /smsbower/handler_api.php        → SMSBOWER_URL
+    /smsbower/getPricesByService     → SMSBOWER_WEB_URL (scanner China 2)
+    /sms24h/handler_api              → SMS24H_URL
+    /tg                              → TELEGRAM_API_URL (Bot API)
+    /mp                              → MP_API_URL (Mercado Pago)
+
+Latência, estoque e chegada de SMS são configuráveis pela linha de comando.
+Quando um SMS "chega" num número do SMSBower o stub faz o POST em
+/webhook/smsbower do app, como o provider real; no sms24h ele só aparece
+no getStatus.
+
+    python bench/stubs.py --porta 9100 --app-url http://127.0.0.1:8080
+"""
+import argparse
+import heapq
+import itertools
+import json
+import random
+import threading
+import time
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+from urllib.request import Request, urlopen
+
+CFG = None
+_ids = itertools.count(int(time.time()) % 1000000 * 1000)
+_msg_ids = itertools.count(1)
+_lock = threading.Lock()
+ativacoes = {}      # aid -> {"provider", "service", "chega_em", "codigo", "cancelado"}
+estoque = {}        # provider -> restante (None = infinito)
+contadores = {}     # (rota, resultado) -> n
+
+
+def _contar(rota, resultado="ok"):
+    with _lock:
+        contadores[(rota, resultado)] = contadores.get((rota, resultado), 0) + 1
+
+
+def _dormir(media_ms):
+    if media_ms <= 0:
+        return
+    j = CFG.jitter
+    time.sleep(random.uniform(media_ms * (1 - j), media_ms * (1 + j)) / 1000.0)
+
+
+# ------------------------------------------------------------------
+# chegada de SMS (agenda única, dispara webhook do SMSBower)
+# ------------------------------------------------------------------
+_agenda = []
+_agenda_cond = threading.Condition()
+
+
+def _sortear_chegada():
+    if random.random() > CFG.sms_prob:
+        return None
+    return time.time() + min(random.expovariate(1.0 / CFG.sms_media), CFG.sms_max)
+
+
+def _agendar_webhook(aid, quando):
+    with _agenda_cond:
+        heapq.heappush(_agenda, (quando, aid))
+        _agenda_cond.notify()
+
+
+def _loop_webhooks():
+    while True:
+        with _agenda_cond:
+            while not _agenda or _agenda[0][0] > time.time():
+                _agenda_cond.wait(_agenda[0][0] - time.time() if _agenda else None)
+            _, aid = heapq.heappop(_agenda)
+        at = ativacoes.get(aid)
+        if not at or at["cancelado"] or not CFG.app_url:
+            continue
+        try:
+            corpo = json.dumps({
+                "activationId": aid,
+                "service": at["service"],
+                "text": f"Seu codigo de verificacao e {at['codigo']}",
+                "receivedAt": datetime.now().strftime('%d/%m/%Y %H:%M:%S'),
+            }).encode()
+            req = Request(f"{CFG.app_url}/webhook/smsbower", data=corpo,
+                          headers={"Content-Type": "application/json"})
+            urlopen(req, timeout=10).read()
+            _contar("webhook_smsbower")
+        except Exception:
+            _contar("webhook_smsbower", "erro")
+
+
+# ------------------------------------------------------------------
+# handler_api (SMSBower e sms24h usam o mesmo protocolo)
+# ------------------------------------------------------------------
+def _handler_api(provider, q):
+    action = q.get("action", "")
+    _dormir(CFG.lat_smsbower if provider == "smsbower" else CFG.lat_sms24h)
+    _contar(f"{provider}.{action}")
+
+    if action == "getNumber":
+        with _lock:
+            resto = estoque.get(provider)
+            if resto is not None:
+                if resto <= 0:
+                    return "NO_NUMBERS"
+                estoque[provider] = resto - 1
+        aid = str(next(_ids))
+        numero = "5511" + "".join(random.choice("0123456789") for _ in range(9))
+        chega_em = _sortear_chegada()
+        ativacoes[aid] = {
+            "provider": provider,
+            "service": q.get("service"),
+            "chega_em": chega_em,
+            "codigo": f"{random.randint(0, 999999):06d}",
+            "cancelado": False,
+        }
+        if provider == "smsbower" and chega_em:
+            _agendar_webhook(aid, chega_em)
+        return f"ACCESS_NUMBER:{aid}:{numero}"
+
+    if action == "getStatus":
+        at = ativacoes.get(q.get("id"))
+        if not at:
+            return "NO_ACTIVATION"
+        if at["cancelado"]:
+            return "STATUS_CANCEL"
+        if at["chega_em"] and time.time() >= at["chega_em"]:
+            return f"STATUS_OK:{at['codigo']}"
+        return "STATUS_WAIT_CODE"
+
+    if action == "setStatus":
+        at = ativacoes.get(q.get("id"))
+        if not at:
+            return "NO_ACTIVATION"
+        status = str(q.get("status"))
+        if status == "8":
+            at["cancelado"] = True
+            return "ACCESS_CANCEL"
+        if status == "3":
+            at["chega_em"] = _sortear_chegada()
+            return "ACCESS_RETRY_GET"
+        if status == "6":
+            return "ACCESS_ACTIVATION"
+        return "ACCESS_READY"
+
+    if action == "getExtraActivation":
+        if q.get("activationId") not in ativacoes:
+            return "NO_ACTIVATION"
+        return _handler_api(provider, {"action": "getNumber", "service": "ot"})
+
+    if action == "getPricesV2":
+        country = q.get("country", "73")
+        servico = q.get("service")
+        faixas = {f"{p:.4f}": random.randint(5, 500) for p in (0.03, 0.05, 0.08, 0.12, 0.5)}
+        return json.dumps({country: {servico: faixas}})
+
+    return "BAD_ACTION"
+
+
+def _precos_por_servico(q):
+    _dormir(CFG.lat_smsbower)
+    _contar("smsbower.getPricesByService")
+    sid = str(q.get("serviceId"))
+    return json.dumps({"services": {sid: {"countries": {"14": {
+        "min_price": round(random.uniform(0.02, 0.2), 4),
+        "count": random.randint(0, 300),
+    }}}}})
+
+
+# ------------------------------------------------------------------
+# Telegram Bot API
+# ------------------------------------------------------------------
+def _telegram(metodo, params):
+    _dormir(CFG.lat_telegram)
+    if random.random() < CFG.tg_429:
+        _contar(f"tg.{metodo}", "429")
+        return 429, {"ok": False, "error_code": 429, "description": "Too Many Requests: retry after 1",
+                     "parameters": {"retry_after": 1}}
+    _contar(f"tg.{metodo}")
+    if metodo == "getMe":
+        return 200, {"ok": True, "result": {"id": 1, "is_bot": True, "first_name": "bench", "username": "bench_bot"}}
+    if metodo in ("sendMessage", "editMessageText", "sendDocument", "sendPhoto"):
+        try:
+            chat_id = int(params.get("chat_id"))
+        except (TypeError, ValueError):
+            chat_id = 0
+        return 200, {"ok": True, "result": {
+            "message_id": int(params.get("message_id") or next(_msg_ids)),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "text": params.get("text") or "",
+        }}
+    return 200, {"ok": True, "result": True}
+
+
+# ------------------------------------------------------------------
+# Mercado Pago
+# ------------------------------------------------------------------
+def _mercado_pago(metodo_http, caminho):
+    _dormir(CFG.lat_mp)
+    _contar(f"mp.{metodo_http}")
+    if caminho.startswith("/v1/payments/"):
+        # o gerador usa ids "bench-<uid>-<centavos>-<seq>"
+        pid = caminho.rsplit("/", 1)[-1]
+        partes = pid.split("-")
+        if len(partes) == 4 and partes[0] == "bench":
+            ref = f"{partes[1]}:{int(partes[2]) / 100:.2f}"
+            return 200, {"id": pid, "status": "approved", "external_reference": ref}
+        return 404, {"message": "not_found"}
+    if caminho.startswith("/checkout/preferences"):
+        pref = next(_ids)
+        return 201, {"id": str(pref), "init_point": f"https://example.invalid/checkout/{pref}"}
+    return 404, {"message": "not_found"}
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def _params(self):
+        url = urlparse(self.path)
+        params = {k: v[-1] for k, v in parse_qs(url.query).items()}
+        tamanho = int(self.headers.get("Content-Length") or 0)
+        corpo = self.rfile.read(tamanho) if tamanho else b""
+        if corpo:
+            tipo = self.headers.get("Content-Type", "")
+            if "json" in tipo:
+                try:
+                    params.update(json.loads(corpo))
+                except ValueError:
+                    pass
+            elif "x-www-form-urlencoded" in tipo:
+                params.update({k: v[-1] for k, v in parse_qs(corpo.decode()).items()})
+        return url.path, params
+
+    def _responder(self, status, corpo, tipo="text/plain"):
+        dados = corpo if isinstance(corpo, bytes) else corpo.encode()
+        self.send_response(status)
+        self.send_header("Content-Type", tipo)
+        self.send_header("Content-Length", str(len(dados)))
+        self.end_headers()
+        self.wfile.write(dados)
+
+    def _despachar(self):
+        caminho, params = self._params()
+        if caminho.startswith("/smsbower/getPricesByService"):
+            return self._responder(200, _precos_por_servico(params), "application/json")
+        if caminho.startswith("/smsbower/"):
+            return self._responder(200, _handler_api("smsbower", params))
+        if caminho.startswith("/sms24h/"):
+            return self._responder(200, _handler_api("sms24h", params))
+        if caminho.startswith("/tg/"):
+            metodo = caminho.rsplit("/", 1)[-1]
+            status, corpo = _telegram(metodo, params)
+            return self._responder(status, json.dumps(corpo), "application/json")
+        if caminho.startswith("/mp/"):
+            status, corpo = _mercado_pago(self.command, caminho[len("/mp"):])
+            return self._responder(status, json.dumps(corpo), "application/json")
+        if caminho == "/_stats":
+            with _lock:
+                snap = {f"{r}|{res}": n for (r, res), n in contadores.items()}
+            return self._responder(200, json.dumps(snap), "application/json")
+        self._responder(404, "not found")
+
+    do_GET = _despachar
+    do_POST = _despachar
+
+
+def main():
+    global CFG
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--porta", type=int, default=9100)
+    ap.add_argument("--app-url", default="http://127.0.0.1:8080", help="app que recebe /webhook/smsbower ('' desliga)")
+    ap.add_argument("--lat-smsbower", type=float, default=150, help="latência média (ms)")
+    ap.add_argument("--lat-sms24h", type=float, default=250, help="latência média (ms)")
+    ap.add_argument("--lat-telegram", type=float, default=80, help="latência média (ms)")
+    ap.add_argument("--lat-mp", type=float, default=200, help="latência média (ms)")
+    ap.add_argument("--jitter", type=float, default=0.5, help="variação relativa da latência (0..1)")
+    ap.add_argument("--estoque-smsbower", type=int, default=-1, help="números disponíveis (-1 = infinito)")
+    ap.add_argument("--estoque-sms24h", type=int, default=-1, help="números disponíveis (-1 = infinito)")
+    ap.add_argument("--sms-prob", type=float, default=0.8, help="probabilidade de um número receber SMS")
+    ap.add_argument("--sms-media", type=float, default=20, help="tempo médio até o SMS (s, exponencial)")
+    ap.add_argument("--sms-max", type=float, default=600, help="teto do tempo até o SMS (s)")
+    ap.add_argument("--tg-429", type=float, default=0.0, help="fração de chamadas ao Telegram que recebem 429")
+    CFG = ap.parse_args()
+
+    estoque["smsbower"] = None if CFG.estoque_smsbower < 0 else CFG.estoque_smsbower
+    estoque["sms24h"] = None if CFG.estoque_sms24h < 0 else CFG.estoque_sms24h
+    threading.Thread(target=_loop_webhooks, name="stub-webhooks", daemon=True).start()
+
+    base = f"http://{CFG.host}:{CFG.porta}"
+    print("Exporte no ambiente do app:")
+    print(f"  SMSBOWER_URL={base}/smsbower/handler_api.php")
+    print(f"  SMSBOWER_WEB_URL={base}/smsbower/getPricesByService")
+    print(f"  SMS24H_URL={base}/sms24h/handler_api")
+    print(f"  TELEGRAM_API_URL={base}/tg")
+    print(f"  MP_API_URL={base}/mp")
+    ThreadingHTTPServer((CFG.host, CFG.porta), Handler).serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -7,8 +7,28 @@ import requests
 import re
 import psycopg2
 import psycopg2.extras
+import psycopg2.pool
+import psycopg2.extensions
+import select
+import contextlib
+import atexit
+import signal
+import sys
+import queue
+import collections
+import heapq
+import itertools
+import random
+import bisect
+import hashlib
+import hmac
+import ipaddress
+import socket
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor, as_completed, Future
 from datetime import datetime
-from flask import Flask, request, render_template_string
+from types import MappingProxyType
+from flask import Flask, request, render_template_string, Response, stream_with_context
 
 import telebot
 import mercadopago
@@ -20,7 +40,8 @@ BOT_TOKEN         = os.getenv("BOT_TOKEN")
 ALERT_BOT_TOKEN   = os.getenv("ALERT_BOT_TOKEN")
 ALERT_CHAT_ID     = os.getenv("ALERT_CHAT_ID")
 API_KEY_SMSBOWER  = os.getenv("API_KEY_SMSBOWER")
-SMSBOWER_URL      = "https://smsbower.online/stubs/handler_api.php"
+SMSBOWER_URL      = os.getenv("SMSBOWER_URL") or "https://smsbower.online/stubs/handler_api.php"
+SMSBOWER_WEB_URL  = os.getenv("SMSBOWER_WEB_URL") or "https://smsbower.org/activations/getPricesByService"
 COUNTRY_ID        = "73"  # BRAZIL no provider SMSBOWER
 MP_ACCESS_TOKEN   = os.getenv("MP_ACCESS_TOKEN")
 SITE_URL          = (os.getenv("SITE_URL") or "").rstrip('/')
@@ -38,7 +59,13 @@ sms_log_bot = telebot.TeleBot("8370380805:AAHuw5Fn9LAayYfItP3hsafIbMFB2uc5luc")
 HIST_CHANNEL      = os.getenv("HIST_CHANNEL", "@historico_recarregas")
 
 # >>> API sms24h (Servidor 2)
-SMS24H_URL        = "https://api.sms24h.org/stubs/handler_api"
+SMS24H_URL        = os.getenv("SMS24H_URL") or "https://api.sms24h.org/stubs/handler_api"
+
+# >>> endpoints alternativos (bench/ com servidores falsos); vazio = produção
+TELEGRAM_API_URL  = (os.getenv("TELEGRAM_API_URL") or "").rstrip('/')
+MP_API_URL        = (os.getenv("MP_API_URL") or "").rstrip('/')
+if TELEGRAM_API_URL:
+    telebot.apihelper.API_URL = TELEGRAM_API_URL + "/bot{0}/{1}"
 API_KEY_SMS24H    = os.getenv("API_KEY_SMS24H")  # defina no ambiente
 
 # =========================================================
@@ -48,15 +75,279 @@ bot         = telebot.TeleBot(BOT_TOKEN, threaded=True)
 alert_bot   = telebot.TeleBot(ALERT_BOT_TOKEN) if ALERT_BOT_TOKEN else None
 backup_bot  = telebot.TeleBot(BACKUP_BOT_TOKEN)
 admin_bot   = telebot.TeleBot(ADMIN_BOT_TOKEN)
-mp_client   = mercadopago.SDK(MP_ACCESS_TOKEN)
+def _criar_mp_client():
+    if not MP_API_URL:
+        return mercadopago.SDK(MP_ACCESS_TOKEN)
+    from mercadopago.http import HttpClient
+
+    class _HttpClientRedirecionado(HttpClient):
+        def request(self, method, url, maxretries=None, **kwargs):
+            url = url.replace("https://api.mercadopago.com", MP_API_URL, 1)
+            return super().request(method, url, maxretries=maxretries, **kwargs)
+
+    return mercadopago.SDK(MP_ACCESS_TOKEN, http_client=_HttpClientRedirecionado())
+
+mp_client   = _criar_mp_client()
 app = Flask(__name__)
 PENDING_REACT = {}
 
+# =========================================================
+# ======================= MÉTRICAS ========================
+# =========================================================
+# Formato texto do Prometheus, sem dependência extra. Cada observação é um
+# lock curto + bisect; os rótulos são sempre de cardinalidade fixa
+# (provedor/ação/método/rota), nunca AID ou usuário.
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")  # se definido, /metrics exige ?token=
+BUCKETS_PADRAO = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+_metricas = []
+
+def _fmt_rotulos(nomes, valores, extra=None):
+    pares = list(zip(nomes, valores)) + ([extra] if extra else [])
+    if not pares:
+        return ""
+    return "{" + ",".join(f'{k}="{str(v)}"' for k, v in pares) + "}"
+
+class Contador:
+    def __init__(self, nome, ajuda, rotulos=()):
+        self.nome, self.ajuda, self.rotulos = nome, ajuda, tuple(rotulos)
+        self._lock = threading.Lock()
+        self._valores = collections.defaultdict(float)
+        _metricas.append(self)
+
+    def inc(self, *valores, n=1):
+        with self._lock:
+            self._valores[valores] += n
+
+    def exportar(self):
+        linhas = [f"# HELP {self.nome} {self.ajuda}", f"# TYPE {self.nome} counter"]
+        with self._lock:
+            itens = list(self._valores.items())
+        for vals, v in itens:
+            linhas.append(f"{self.nome}{_fmt_rotulos(self.rotulos, vals)} {v}")
+        return linhas
+
+class Histograma:
+    def __init__(self, nome, ajuda, rotulos=(), buckets=BUCKETS_PADRAO):
+        self.nome, self.ajuda, self.rotulos = nome, ajuda, tuple(rotulos)
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._series = {}   # valores → [contagens por bucket..., +Inf], soma
+        _metricas.append(self)
+
+    def observar(self, segundos, *valores):
+        i = bisect.bisect_left(self.buckets, segundos)
+        with self._lock:
+            serie = self._series.get(valores)
+            if serie is None:
+                serie = self._series[valores] = [[0] * (len(self.buckets) + 1), 0.0]
+            serie[0][i] += 1
+            serie[1] += segundos
+
+    @contextlib.contextmanager
+    def medir(self, *valores):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observar(time.perf_counter() - t0, *valores)
+
+    def exportar(self):
+        linhas = [f"# HELP {self.nome} {self.ajuda}", f"# TYPE {self.nome} histogram"]
+        with self._lock:
+            series = [(vals, list(c), soma) for vals, (c, soma) in self._series.items()]
+        for vals, contagens, soma in series:
+            acum = 0
+            for le, c in zip(self.buckets + ("+Inf",), contagens):
+                acum += c
+                linhas.append(f"{self.nome}_bucket{_fmt_rotulos(self.rotulos, vals, ('le', le))} {acum}")
+            linhas.append(f"{self.nome}_sum{_fmt_rotulos(self.rotulos, vals)} {soma}")
+            linhas.append(f"{self.nome}_count{_fmt_rotulos(self.rotulos, vals)} {acum}")
+        return linhas
+
+class Medidor:
+    """Gauge lido na hora da coleta (nada custa no caminho quente)."""
+    def __init__(self, nome, ajuda, fn):
+        self.nome, self.ajuda, self.fn = nome, ajuda, fn
+        _metricas.append(self)
+
+    def exportar(self):
+        try:
+            valor = float(self.fn())
+        except Exception:
+            return []
+        return [f"# HELP {self.nome} {self.ajuda}", f"# TYPE {self.nome} gauge", f"{self.nome} {valor}"]
+
+def renderizar_metricas():
+    linhas = []
+    for m in _metricas:
+        linhas.extend(m.exportar())
+    return "\n".join(linhas) + "\n"
+
+m_provider_seg   = Histograma("provider_request_seconds", "Latência das chamadas aos provedores", ("provider", "action"))
+m_provider_erros = Contador("provider_request_errors_total", "Chamadas aos provedores com erro HTTP/rede", ("provider", "action"))
+m_provider_curto = Contador("provider_circuit_rejected_total", "Chamadas recusadas com o disjuntor aberto", ("provider", "action"))
+m_db_checkout    = Histograma("db_checkout_seconds", "Espera por conexão livre no pool")
+m_db_query       = Histograma("db_query_seconds", "Tempo de execução de cada statement SQL")
+m_db_erros       = Contador("db_errors_total", "Transações com rollback por exceção")
+m_tg_seg         = Histograma("telegram_api_seconds", "Latência das chamadas à API do Telegram", ("metodo",))
+m_tg_resultado   = Contador("telegram_api_total", "Chamadas à API do Telegram por resultado", ("metodo", "resultado"))
+m_http_seg       = Histograma("http_request_seconds", "Tempo de atendimento das rotas /api e /webhook", ("rota",))
+m_scanner_seg    = Histograma("scanner_sweep_seconds", "Duração de cada varredura do China 2",
+                              buckets=(1, 2.5, 5, 10, 20, 30, 60, 120))
+Medidor("threads_ativas", "Threads vivas no processo", threading.active_count)
+
 # =========================================================
 # ==================== BANCO DE DADOS =====================
 # =========================================================
+# >>> NOVO: pool de conexões (antes era um psycopg2.connect + TLS por chamada)
+DB_POOL_MIN          = int(os.getenv("DB_POOL_MIN", "1"))
+DB_POOL_MAX          = int(os.getenv("DB_POOL_MAX", "10"))
+DB_POOL_TIMEOUT      = float(os.getenv("DB_POOL_TIMEOUT", "10"))      # espera máx. por conexão livre
+DB_CONN_MAX_LIFETIME = float(os.getenv("DB_CONN_MAX_LIFETIME", "1800"))  # recicla conexões antigas
+DB_HEALTHCHECK_IDLE  = float(os.getenv("DB_HEALTHCHECK_IDLE", "30"))   # SELECT 1 se ficou parada mais que isso
+DB_STATEMENT_TIMEOUT_MS = int(os.getenv("DB_STATEMENT_TIMEOUT_MS", "15000"))
+# pgbouncer em modo transaction rejeita o parâmetro de startup "options"
+# e não garante estado de sessão → nada de SET/LISTEN nas conexões do pool
+DB_PGBOUNCER         = (os.getenv("DB_PGBOUNCER") or "").lower() in ("1", "true", "yes")
+
+_db_pool = None
+_db_pool_lock = threading.Lock()
+_db_pool_sem = threading.BoundedSemaphore(DB_POOL_MAX)
+_db_conn_meta = {}   # id(conn) -> {"created": ts, "last_used": ts}
+_db_stats_lock = threading.Lock()
+db_pool_stats_data = {
+    "checkouts": 0,
+    "timeouts": 0,
+    "discarded": 0,
+    "errors": 0,
+    "wait_total_ms": 0.0,
+    "wait_max_ms": 0.0,
+    "held_total_ms": 0.0,
+    "held_max_ms": 0.0,
+}
+
+class CursorMedido(psycopg2.extras.RealDictCursor):
+    def execute(self, query, vars=None):
+        t0 = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            m_db_query.observar(time.perf_counter() - t0)
+
+def _db_connect_kwargs():
+    kw = {"cursor_factory": CursorMedido}
+    if not DB_PGBOUNCER and DB_STATEMENT_TIMEOUT_MS > 0:
+        kw["options"] = f"-c statement_timeout={DB_STATEMENT_TIMEOUT_MS}"
+    return kw
+
+def _get_db_pool():
+    global _db_pool
+    if _db_pool is None:
+        with _db_pool_lock:
+            if _db_pool is None:
+                _db_pool = psycopg2.pool.ThreadedConnectionPool(
+                    DB_POOL_MIN, DB_POOL_MAX, DATABASE_URL, **_db_connect_kwargs()
+                )
+    return _db_pool
+
+def _db_stat(wait_ms=None, held_ms=None, **incr):
+    with _db_stats_lock:
+        for k, v in incr.items():
+            db_pool_stats_data[k] += v
+        if wait_ms is not None:
+            db_pool_stats_data["checkouts"] += 1
+            db_pool_stats_data["wait_total_ms"] += wait_ms
+            db_pool_stats_data["wait_max_ms"] = max(db_pool_stats_data["wait_max_ms"], wait_ms)
+        if held_ms is not None:
+            db_pool_stats_data["held_total_ms"] += held_ms
+            db_pool_stats_data["held_max_ms"] = max(db_pool_stats_data["held_max_ms"], held_ms)
+
+def db_pool_stats():
+    with _db_stats_lock:
+        snap = dict(db_pool_stats_data)
+    snap["in_use"] = DB_POOL_MAX - _db_pool_sem._value
+    snap["max"] = DB_POOL_MAX
+    return snap
+
+def _db_conn_saudavel(conn):
+    if conn.closed:
+        return False
+    meta = _db_conn_meta.get(id(conn))
+    now = time.time()
+    if meta is None:
+        _db_conn_meta[id(conn)] = {"created": now, "last_used": now}
+        return True
+    if DB_CONN_MAX_LIFETIME > 0 and now - meta["created"] > DB_CONN_MAX_LIFETIME:
+        return False
+    if now - meta["last_used"] > DB_HEALTHCHECK_IDLE:
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+        except Exception:
+            return False
+    return True
+
+def _db_descartar(pool, conn):
+    _db_conn_meta.pop(id(conn), None)
+    try:
+        pool.putconn(conn, close=True)
+    except Exception:
+        pass
+    _db_stat(discarded=1)
+
+@contextlib.contextmanager
 def get_db_conn():
-    return psycopg2.connect(DATABASE_URL, cursor_factory=psycopg2.extras.RealDictCursor)
+    """
+    Empresta uma conexão do pool. Uso igual ao de antes:
+        with get_db_conn() as conn, conn.cursor() as cur: ...
+    Ao sair faz commit (ou rollback em exceção) e devolve a conexão ao pool.
+    """
+    t0 = time.perf_counter()
+    if not _db_pool_sem.acquire(timeout=DB_POOL_TIMEOUT):
+        _db_stat(timeouts=1)
+        raise psycopg2.pool.PoolError(f"pool esgotado após {DB_POOL_TIMEOUT}s")
+    pool = None
+    conn = None
+    try:
+        pool = _get_db_pool()
+        for _ in range(3):
+            conn = pool.getconn()
+            if _db_conn_saudavel(conn):
+                break
+            _db_descartar(pool, conn)
+            conn = None
+        if conn is None:
+            conn = pool.getconn()
+            _db_conn_meta[id(conn)] = {"created": time.time(), "last_used": time.time()}
+        t1 = time.perf_counter()
+        _db_stat(wait_ms=(t1 - t0) * 1000)
+        m_db_checkout.observar(t1 - t0)
+        broken = False
+        try:
+            yield conn
+            if not conn.closed:
+                conn.commit()
+        except Exception:
+            _db_stat(errors=1)
+            m_db_erros.inc()
+            try:
+                conn.rollback()
+            except Exception:
+                broken = True
+            raise
+        finally:
+            _db_stat(held_ms=(time.perf_counter() - t1) * 1000)
+            if broken or conn.closed:
+                _db_descartar(pool, conn)
+            else:
+                meta = _db_conn_meta.get(id(conn))
+                if meta:
+                    meta["last_used"] = time.time()
+                pool.putconn(conn)
+    finally:
+        _db_pool_sem.release()
 
 def criar_tabela_usuarios():
     with get_db_conn() as conn, conn.cursor() as cur:
@@ -84,6 +375,24 @@ def criar_tabela_numeros_sms():
                     data_criacao TIMESTAMP DEFAULT NOW()
                 )
             """)
+            # >>> NOVO: posse dos números servida por aqui (antes: usuarios.numeros JSON)
+            cur.execute("""
+                CREATE INDEX IF NOT EXISTS idx_numeros_sms_user_data
+                ON numeros_sms (user_id, data_criacao)
+            """)
+            cur.execute("ALTER TABLE numeros_sms ADD COLUMN IF NOT EXISTS service_key TEXT")
+            # >>> NOVO: contadores por dia/serviço de compras, cancelamentos e
+            # SMS recebidos, gravados em lote (o painel não varre mais numeros_sms)
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS estatisticas (
+                    dia DATE NOT NULL,
+                    service_key TEXT NOT NULL,
+                    vendidos INTEGER NOT NULL DEFAULT 0,
+                    cancelados INTEGER NOT NULL DEFAULT 0,
+                    recebidos INTEGER NOT NULL DEFAULT 0,
+                    PRIMARY KEY (dia, service_key)
+                )
+            """)
             conn.commit()
 def criar_tabela_api_tokens():
     with get_db_conn() as conn, conn.cursor() as cur:
@@ -108,6 +417,26 @@ def criar_tabela_payments():
         """)
         conn.commit()
 
+# >>> NOVO: notificações do Mercado Pago aguardando processamento
+def criar_tabela_mp_fila():
+    with get_db_conn() as conn, conn.cursor() as cur:
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS mp_fila (
+                payment_id TEXT PRIMARY KEY,
+                status TEXT NOT NULL DEFAULT 'pendente',
+                tentativas INTEGER NOT NULL DEFAULT 0,
+                proxima_em TIMESTAMP NOT NULL DEFAULT NOW(),
+                ultimo_erro TEXT,
+                recebido_em TIMESTAMP NOT NULL DEFAULT NOW(),
+                processado_em TIMESTAMP
+            )
+        """)
+        cur.execute("""
+            CREATE INDEX IF NOT EXISTS idx_mp_fila_pendentes
+            ON mp_fila (proxima_em) WHERE status = 'pendente'
+        """)
+        conn.commit()
+
 # >>> NOVO: tabela para persistir configurações (preços, emojis, caps)
 def criar_tabela_config():
     with get_db_conn() as conn, conn.cursor() as cur:
@@ -119,23 +448,393 @@ def criar_tabela_config():
         """)
         conn.commit()
 
+# >>> NOVO: ativações em andamento sobrevivem a restart/deploy
+def criar_tabela_ativacoes():
+    with get_db_conn() as conn, conn.cursor() as cur:
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS ativacoes (
+                aid TEXT PRIMARY KEY,
+                user_id TEXT,
+                estado TEXT NOT NULL DEFAULT 'ativa',
+                dados JSONB NOT NULL,
+                criado_em TIMESTAMP DEFAULT NOW(),
+                atualizado_em TIMESTAMP DEFAULT NOW()
+            )
+        """)
+        cur.execute("""
+            CREATE INDEX IF NOT EXISTS idx_ativacoes_atualizado
+            ON ativacoes (atualizado_em)
+        """)
+        conn.commit()
+
+# >>> NOVO: broadcast do painel como job persistido (retoma do cursor após restart)
+def criar_tabela_broadcast():
+    with get_db_conn() as conn, conn.cursor() as cur:
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS broadcast_jobs (
+                id SERIAL PRIMARY KEY,
+                texto TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'pendente',
+                cursor TEXT NOT NULL DEFAULT '',
+                total INTEGER NOT NULL DEFAULT 0,
+                enviados INTEGER NOT NULL DEFAULT 0,
+                falhas INTEGER NOT NULL DEFAULT 0,
+                bloqueados INTEGER NOT NULL DEFAULT 0,
+                lease_ate TIMESTAMP,
+                criado_em TIMESTAMP DEFAULT NOW(),
+                iniciado_em TIMESTAMP,
+                concluido_em TIMESTAMP
+            )
+        """)
+        # chats que bloquearam o bot saem dos próximos broadcasts
+        cur.execute("ALTER TABLE usuarios ADD COLUMN IF NOT EXISTS bloqueado BOOLEAN DEFAULT FALSE")
+        conn.commit()
+
 criar_tabela_usuarios()
 criar_tabela_numeros_sms()
+criar_tabela_ativacoes()
+criar_tabela_broadcast()
+
+# >>> NOVO: webhooks de clientes da API (fila de entrega persistida)
+def criar_tabela_webhooks():
+    with get_db_conn() as conn, conn.cursor() as cur:
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS api_webhooks (
+                user_id TEXT PRIMARY KEY,
+                url TEXT NOT NULL,
+                segredo TEXT NOT NULL,
+                criado_em TIMESTAMP DEFAULT NOW()
+            )
+        """)
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS webhook_entregas (
+                id BIGSERIAL PRIMARY KEY,
+                user_id TEXT NOT NULL,
+                url TEXT NOT NULL,
+                evento TEXT NOT NULL,
+                payload JSONB NOT NULL,
+                status TEXT NOT NULL DEFAULT 'pendente',
+                tentativas INTEGER NOT NULL DEFAULT 0,
+                proxima_em TIMESTAMP NOT NULL DEFAULT NOW(),
+                ultimo_erro TEXT,
+                criado_em TIMESTAMP NOT NULL DEFAULT NOW(),
+                entregue_em TIMESTAMP
+            )
+        """)
+        cur.execute("""
+            CREATE INDEX IF NOT EXISTS idx_webhook_entregas_pendentes
+            ON webhook_entregas (proxima_em) WHERE status = 'pendente'
+        """)
+        conn.commit()
+
+criar_tabela_webhooks()
 criar_tabela_payments()
+criar_tabela_mp_fila()
 criar_tabela_config()
 
+# >>> NOVO: migração única usuarios.numeros (JSON) → numeros_sms
+def migrar_numeros_json():
+    with get_db_conn() as conn, conn.cursor() as cur:
+        cur.execute("SELECT 1 FROM app_config WHERE key='migracao_numeros_sms'")
+        if cur.fetchone():
+            return
+        # serializa workers que sobem juntos
+        cur.execute("SELECT pg_advisory_xact_lock(hashtext('migracao_numeros_sms'))")
+        cur.execute("SELECT 1 FROM app_config WHERE key='migracao_numeros_sms'")
+        if cur.fetchone():
+            return
+        cur.execute("SELECT id, numeros FROM usuarios WHERE numeros LIKE '[%'")
+        usuarios = cur.fetchall()
+        migrados, ignorados = 0, []
+        log = logging.getLogger("bot_sms")   # roda antes do logger do módulo existir
+        for u in usuarios:
+            # linha com JSON quebrado não pode travar o startup: registra e segue
+            try:
+                aids = [str(a) for a in json.loads(u['numeros'])]
+            except (ValueError, TypeError) as e:
+                log.error(f"[MIGRACAO] numeros inválido para usuário {u['id']}: {e}")
+                ignorados.append(u['id'])
+                continue
+            # data antiga (epoch + posição na lista): os AIDs legados ficam no fim
+            # de "ORDER BY data_criacao DESC" e mantêm a ordem original entre si
+            cur.execute("SAVEPOINT migra_usuario")
+            try:
+                for idx, aid in enumerate(aids):
+                    cur.execute("""
+                        INSERT INTO numeros_sms (aid, user_id, price, cancelado, sms_recebido, data_criacao)
+                        VALUES (%s, %s, NULL, FALSE, FALSE, TIMESTAMP 'epoch' + %s * INTERVAL '1 second')
+                        ON CONFLICT (aid) DO NOTHING
+                    """, (aid, u['id'], idx))
+                    migrados += cur.rowcount
+                cur.execute("RELEASE SAVEPOINT migra_usuario")
+            except psycopg2.Error as e:
+                cur.execute("ROLLBACK TO SAVEPOINT migra_usuario")
+                log.error(f"[MIGRACAO] falha ao migrar números do usuário {u['id']}: {e}")
+                ignorados.append(u['id'])
+        cur.execute("""
+            INSERT INTO app_config (key, value) VALUES ('migracao_numeros_sms', %s)
+            ON CONFLICT (key) DO NOTHING
+        """, (json.dumps({"migrados": migrados, "ignorados": ignorados,
+                          "em": datetime.now().isoformat()}),))
+        conn.commit()
+
+migrar_numeros_json()
+
+# >>> NOVO: carga inicial única do rollup a partir do histórico
+def migrar_estatisticas():
+    with get_db_conn() as conn, conn.cursor() as cur:
+        cur.execute("SELECT 1 FROM app_config WHERE key='rollup_estatisticas'")
+        if cur.fetchone():
+            return
+        cur.execute("SELECT pg_advisory_xact_lock(hashtext('rollup_estatisticas'))")
+        cur.execute("SELECT 1 FROM app_config WHERE key='rollup_estatisticas'")
+        if cur.fetchone():
+            return
+        # segura escritas em numeros_sms durante a carga para não contar em dobro
+        cur.execute("LOCK TABLE numeros_sms IN SHARE MODE")
+        cur.execute("""
+            INSERT INTO estatisticas (dia, service_key, vendidos, cancelados, recebidos)
+            SELECT COALESCE(data_criacao::date, CURRENT_DATE),
+                   COALESCE(service_key, 'desconhecido'),
+                   count(*),
+                   count(*) FILTER (WHERE cancelado),
+                   count(*) FILTER (WHERE sms_recebido)
+            FROM numeros_sms
+            GROUP BY 1, 2
+            ON CONFLICT (dia, service_key) DO UPDATE SET
+                vendidos   = estatisticas.vendidos   + EXCLUDED.vendidos,
+                cancelados = estatisticas.cancelados + EXCLUDED.cancelados,
+                recebidos  = estatisticas.recebidos  + EXCLUDED.recebidos
+        """)
+        cur.execute("""
+            INSERT INTO app_config (key, value) VALUES ('rollup_estatisticas', %s)
+            ON CONFLICT (key) DO NOTHING
+        """, (json.dumps({"em": datetime.now().isoformat()}),))
+        conn.commit()
+
+migrar_estatisticas()
+
+# >>> NOVO: saldo em livro-razão (centavos inteiros, só INSERT no caminho quente)
+# saldo = saldo_snapshot.centavos + soma dos lançamentos ainda não compactados.
+# A compactação marca lançamentos e soma no snapshot na mesma transação;
+# as linhas continuam lá, então sum(valor_centavos) reconstrói qualquer saldo.
+# usuarios.saldo fica como legado (só origem da migração).
+def criar_tabela_ledger():
+    with get_db_conn() as conn, conn.cursor() as cur:
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS saldo_lancamentos (
+                id BIGSERIAL PRIMARY KEY,
+                user_id TEXT NOT NULL,
+                valor_centavos BIGINT NOT NULL,
+                tipo TEXT NOT NULL,
+                ref TEXT,
+                compactado BOOLEAN NOT NULL DEFAULT FALSE,
+                criado_em TIMESTAMP NOT NULL DEFAULT NOW()
+            )
+        """)
+        cur.execute("""
+            CREATE INDEX IF NOT EXISTS idx_saldo_lanc_pendentes
+            ON saldo_lancamentos (user_id) WHERE NOT compactado
+        """)
+        cur.execute("""
+            CREATE INDEX IF NOT EXISTS idx_saldo_lanc_user
+            ON saldo_lancamentos (user_id, id)
+        """)
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS saldo_snapshot (
+                user_id TEXT PRIMARY KEY,
+                centavos BIGINT NOT NULL DEFAULT 0,
+                atualizado_em TIMESTAMP NOT NULL DEFAULT NOW()
+            )
+        """)
+        conn.commit()
+
+def migrar_saldos_ledger():
+    with get_db_conn() as conn, conn.cursor() as cur:
+        cur.execute("SELECT 1 FROM app_config WHERE key='migracao_ledger'")
+        if cur.fetchone():
+            return
+        cur.execute("SELECT pg_advisory_xact_lock(hashtext('migracao_ledger'))")
+        cur.execute("SELECT 1 FROM app_config WHERE key='migracao_ledger'")
+        if cur.fetchone():
+            return
+        cur.execute("LOCK TABLE usuarios IN SHARE MODE")
+        # lançamento de abertura já compactado + snapshot com o mesmo valor
+        cur.execute("""
+            INSERT INTO saldo_lancamentos (user_id, valor_centavos, tipo, compactado)
+            SELECT id, ROUND(COALESCE(saldo, 0) * 100)::bigint, 'abertura', TRUE
+            FROM usuarios
+        """)
+        cur.execute("""
+            INSERT INTO saldo_snapshot (user_id, centavos)
+            SELECT id, ROUND(COALESCE(saldo, 0) * 100)::bigint FROM usuarios
+            ON CONFLICT (user_id) DO NOTHING
+        """)
+        cur.execute("""
+            INSERT INTO app_config (key, value) VALUES ('migracao_ledger', %s)
+            ON CONFLICT (key) DO NOTHING
+        """, (json.dumps({"em": datetime.now().isoformat()}),))
+        conn.commit()
+
+criar_tabela_ledger()
+migrar_saldos_ledger()
+
 # =========================================================
 # =================== LOG EM TELEGRAM =====================
 # =========================================================
+TG_LOG_QUEUE_MAX     = int(os.getenv("TG_LOG_QUEUE_MAX", "1000"))
+TG_LOG_HIGH_WATER    = int(os.getenv("TG_LOG_HIGH_WATER", "200"))   # acima disso amostra INFO
+TG_LOG_INFO_SAMPLE   = int(os.getenv("TG_LOG_INFO_SAMPLE", "10"))   # sob pressão mantém 1 a cada N
+TG_LOG_MIN_INTERVAL  = float(os.getenv("TG_LOG_MIN_INTERVAL", "1.1"))  # ~1 msg/s por chat
+TG_LOG_URGENT_MAX    = int(os.getenv("TG_LOG_URGENT_MAX", "5000"))     # além disso vai para o stderr
+TG_LOG_BACKOFF_MAX   = float(os.getenv("TG_LOG_BACKOFF_MAX", "60"))
+TG_MAX_MESSAGE_LEN   = 4096
+
 class TelegramLogHandler(logging.Handler):
+    """
+    emit() só enfileira; uma thread dedicada junta os registros em mensagens
+    de até 4096 caracteres e respeita ~1 msg/s no chat de alertas.
+    WARNING+ (e log_admin) vai para uma fila própria: em qualquer falha de
+    envio volta para a frente com backoff; só se passar de TG_LOG_URGENT_MAX
+    o mais antigo sai para o stderr. INFO é amostrado quando a fila passa de
+    TG_LOG_HIGH_WATER, descartado se ela encher e não é reenviado.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._info = queue.Queue(maxsize=TG_LOG_QUEUE_MAX)
+        self._urgent = collections.deque()
+        self._sobra = None          # (texto, urgente) que não coube no último lote
+        self._lock = threading.Lock()   # _urgent (limite), stats e amostragem
+        self._wake = threading.Event()
+        self._sample_seq = 0
+        self._thread = None
+        self._thread_lock = threading.Lock()
+        self.stats = {"enfileirados": 0, "descartados": 0, "amostrados": 0,
+                      "enviados": 0, "mensagens": 0, "falhas": 0}
+
+    def queue_depth(self):
+        return self._info.qsize() + len(self._urgent) + (1 if self._sobra else 0)
+
+    def _contar(self, campo, n=1):
+        with self._lock:
+            self.stats[campo] += n
+
+    def _urgentes(self, linhas, na_frente=False):
+        excedentes = []
+        with self._lock:
+            if na_frente:
+                self._urgent.extendleft(reversed(linhas))
+            else:
+                self._urgent.extend(linhas)
+            while len(self._urgent) > TG_LOG_URGENT_MAX:
+                excedentes.append(self._urgent.popleft())
+                self.stats["descartados"] += 1
+        for ln in excedentes:
+            # não cabe mais na fila: pelo menos fica no log do processo
+            sys.stderr.write(ln + "\n")
+
+    def _garantir_thread(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._thread_lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._sender_loop, name="tg-log-sender", daemon=True)
+                self._thread.start()
+
+    def enqueue_text(self, msg, urgent=False):
+        if urgent:
+            self._urgentes([msg])
+        else:
+            depth = self._info.qsize()
+            if depth >= TG_LOG_HIGH_WATER:
+                with self._lock:
+                    self._sample_seq += 1
+                    pular = self._sample_seq % max(1, TG_LOG_INFO_SAMPLE)
+                    if pular:
+                        self.stats["amostrados"] += 1
+                if pular:
+                    return
+            try:
+                self._info.put_nowait(msg)
+            except queue.Full:
+                self._contar("descartados")
+                return
+        self._contar("enfileirados")
+        self._garantir_thread()
+        self._wake.set()
+
     def emit(self, record):
         if not alert_bot or not ALERT_CHAT_ID:
             return
-        msg = self.format(record)
         try:
-            alert_bot.send_message(ALERT_CHAT_ID, msg)
-        except:
-            pass
+            msg = self.format(record)
+        except Exception:
+            self.handleError(record)
+            return
+        self.enqueue_text(msg, urgent=record.levelno >= logging.WARNING)
+
+    def _proximo_lote(self):
+        """Lista de (texto, urgente) que cabe numa mensagem."""
+        linhas = []
+        tamanho = 0
+        while True:
+            if self._sobra is not None:
+                item, urgente = self._sobra
+                self._sobra = None
+            else:
+                try:
+                    item, urgente = self._urgent.popleft(), True
+                except IndexError:
+                    try:
+                        item, urgente = self._info.get_nowait(), False
+                    except queue.Empty:
+                        break
+            item = item[:TG_MAX_MESSAGE_LEN]
+            if linhas and tamanho + len(item) + 1 > TG_MAX_MESSAGE_LEN:
+                # abre a próxima mensagem
+                self._sobra = (item, urgente)
+                break
+            linhas.append((item, urgente))
+            tamanho += len(item) + 1
+        return linhas
+
+    def _sender_loop(self):
+        last_send = 0.0
+        backoff = 0.0
+        while True:
+            self._wake.wait(timeout=5)
+            self._wake.clear()
+            while self.queue_depth():
+                espera = last_send + TG_LOG_MIN_INTERVAL - time.time()
+                if espera > 0:
+                    time.sleep(espera)
+                linhas = self._proximo_lote()
+                if not linhas:
+                    break
+                last_send = time.time()
+                try:
+                    alert_bot.send_message(ALERT_CHAT_ID, "\n".join(t for t, _ in linhas))
+                    self._contar("enviados", len(linhas))
+                    self._contar("mensagens")
+                    backoff = 0.0
+                except Exception as e:
+                    self._contar("falhas")
+                    # qualquer falha (rede, 5xx, 429...): urgentes voltam para a
+                    # frente; INFO não é reenviado
+                    urgentes = [t for t, u in linhas if u]
+                    if len(urgentes) < len(linhas):
+                        self._contar("descartados", len(linhas) - len(urgentes))
+                    if urgentes:
+                        self._urgentes(urgentes, na_frente=True)
+                    result = getattr(e, "result_json", None) or {}
+                    retry_after = (result.get("parameters") or {}).get("retry_after")
+                    if retry_after:
+                        # 429: respeita o retry_after do Telegram
+                        time.sleep(float(retry_after))
+                    else:
+                        backoff = min(TG_LOG_BACKOFF_MAX, max(1.0, backoff * 2))
+                        time.sleep(backoff)
 
 logger = logging.getLogger("bot_sms")
 logger.setLevel(logging.INFO)
@@ -145,11 +844,9 @@ logger.addHandler(handler)
 
 # Helper para logs administrativos (saldo novo, compra/cancelamento)
 def log_admin(msg: str):
-    try:
-        if alert_bot and ALERT_CHAT_ID:
-            alert_bot.send_message(ALERT_CHAT_ID, msg)
-    except Exception:
-        pass
+    # vai pela fila do handler (sem round trip no caminho da compra), sem descarte
+    if alert_bot and ALERT_CHAT_ID:
+        handler.enqueue_text(msg, urgent=True)
 
 # =========================================================
 # ======= SERVICES JSON + MAPA DE SERVIÇOS DINÂMICO =======
@@ -196,16 +893,14 @@ SCANNER_PRICE_LOCK = threading.Lock()
 def set_china2_service_code(new_code, reason="", price=None):
     with SERVICE_CODE_LOCK:
         old = GLOBAL_SERVICE_MAP['china2']
-        GLOBAL_SERVICE_MAP['china2'] = new_code
-    if price is not None:
-        try:
-            p = float(price)
-        except:
-            p = None
-        if p is not None:
-            with SCANNER_PRICE_LOCK:
-                global SCANNER_LAST_PRICE
-                SCANNER_LAST_PRICE = p
+    try:
+        p = float(price) if price is not None else None
+    except:
+        p = None
+    # grava em app_config e propaga para os outros workers
+    if not salvar_config('china2', {"code": new_code, "price": p}):
+        logger.error(f"[SCANNER] China 2 não atualizado ({old} → {new_code}): falha ao gravar")
+        return False
     logger.info(f"[SCANNER] China 2: {old} → {new_code} {('['+reason+']') if reason else ''}")
     try:
         if alert_bot and ALERT_CHAT_ID:
@@ -216,6 +911,7 @@ def set_china2_service_code(new_code, reason="", price=None):
             )
     except:
         pass
+    return True
 
 # =========================================================
 # ================== VARS / LOCKS EXISTENTES ==============
@@ -230,107 +926,117 @@ PRAZO_SEGUNDOS   = PRAZO_MINUTOS * 60
 # ====== NOVO: controle do scanner (liga/desliga via painel) ======
 SCANNER_ENABLED = True   # padrão ligado
 
-# ====== NOVO: preços dinâmicos editáveis no painel ======
-SERVICE_PRICES = {
-    'mercado':   0.75,
-    'mpsrv2':    0.90,
-    'china':     0.60,
-    'china2':    0.60,
-    'china3':    0.60,  # novo: SMS para China 3 (srv2)
-    'picpay':    0.65,
-    'picsrv2':   0.70,
-    'wa1':       6.50,
-    'wa2':       7.00,
-    'outros':    1.10,
-    'srv2':      0.77,
-    # sms24h:
-    'nubank':    0.90,
-    'c6':        0.45,
-    'neon':      0.39,
-    'agibanksrv2': 0.48,  # novo
-    'app99srv2':   0.39,  # novo
-    'nextsrv2':    0.42,  # novo
-    # Servidor 1 / SMSBower:
-    'c6srv1':    0.64,
-    'google':    0.90,
-    'agibank':   0.48,  # novo
-    'app99':     0.39,  # novo
-    # Servidor 2 / sms24h:
-    'googlesrv2': 0.90,
-}
+# ====== NOVO: catálogo de serviços (registro único) ======
+# Uma linha por serviço, na ordem do menu de compra:
+#   (chave, nome, emoji, preço R$, provider, código no provider, cap US$ S1, regra de preço)
+# código None = vem do GLOBAL_SERVICE_MAP (China 2 é trocado pelo scanner).
+# cap só vale para smsbower. Regra de preço: 'menor', 'wa' ou 'scanner'.
+SERVICOS_PADRAO = (
+    ('mercado',     'Mercado Pago SMS',            '📲',  0.75, 'smsbower', 'cq',  0.10, 'menor'),
+    ('mpsrv2',      'Mercado Pago SMS Servidor 2', '🛰️', 0.90, 'sms24h',   'cq',  None, None),
+    ('china',       'SMS para China',              '🇨🇳', 0.60, 'smsbower', 'vi',  0.10, 'menor'),
+    ('china2',      'SMS para China 2',            '🇨🇳', 0.60, 'smsbower', None,  0.10, 'scanner'),
+    ('china3',      'SMS para China 3',            '🇨🇳', 0.60, 'sms24h',   'ot',  None, None),
+    ('picpay',      'PicPay SMS',                  '💸',  0.65, 'smsbower', 'ev',  0.10, 'menor'),
+    ('picsrv2',     'PicPay SMS Servidor 2',       '🛰️', 0.70, 'sms24h',   'ev',  None, None),
+    ('wa1',         'WhatsApp',                    '💬',  6.50, 'smsbower', 'wa',  0.70, 'wa'),
+    ('wa2',         'WhatsApp Servidor 2',         '🛰️', 7.00, 'sms24h',   'wa',  None, None),
+    ('google',      'Google SMS',                  '🔍',  0.90, 'smsbower', 'go',  0.11, 'menor'),
+    ('googlesrv2',  'Google SMS Servidor 2',       '🔍',  0.90, 'sms24h',   'go',  None, None),
+    ('nubank',      'Nubank SMS Servidor 2',       '🏦',  0.90, 'sms24h',   'aaa', None, None),
+    ('c6srv1',      'C6 Bank SMS',                 '🏦',  0.64, 'smsbower', 'ot',  0.08, 'menor'),
+    ('c6',          'C6 Bank SMS Servidor 2',      '🏦',  0.45, 'sms24h',   'aff', None, None),
+    ('neon',        'Neon SMS Servidor 2',         '🏦',  0.39, 'sms24h',   'aex', None, None),
+    ('agibank',     'Agibank SMS',                 '🏦',  0.48, 'smsbower', 'sa',  0.08, 'menor'),
+    ('agibanksrv2', 'Agibank SMS Servidor 2',      '🏦',  0.48, 'sms24h',   'sa',  None, None),
+    ('app99',       '99app SMS',                   '🚕',  0.39, 'smsbower', 'ki',  0.07, 'menor'),
+    ('app99srv2',   '99app SMS Servidor 2',        '🚕',  0.39, 'sms24h',   'ki',  None, None),
+    ('nextsrv2',    'Next SMS Servidor 2',         '🏦',  0.42, 'sms24h',   'aey', None, None),
+    ('outros',      'Outros SMS',                  '📡',  1.10, 'smsbower', 'ot',  0.20, 'menor'),
+    ('srv2',        'Outros SMS Servidor 2',       '🛰️', 0.77, 'sms24h',   'ot',  None, None),
+)
+# serviços que recebem o texto completo do SMS; os demais só números com 4+ dígitos
+SERVICOS_TEXTO_COMPLETO = ('outros',)
+S1_CAP_PADRAO = 0.10
+
+# Entrada compilada da tabela de roteamento (imutável)
+RotaServico = collections.namedtuple(
+    'RotaServico', 'chave nome emoji preco provider codigo cap regra_preco texto_completo servidor')
+
+SERVIDOR_PROVIDER = {'smsbower': 'servidor 1', 'sms24h': 'servidor 2'}
+
+def _linha_padrao(linha):
+    chave, nome, emoji, preco, provider, codigo, cap, regra = linha
+    return {'nome': nome, 'emoji': emoji, 'preco': preco, 'provider': provider,
+            'codigo': codigo, 'cap': cap, 'regra_preco': regra,
+            'texto_completo': chave in SERVICOS_TEXTO_COMPLETO}
+
+def compilar_servicos(overrides=None, precos=None, emojis=None, caps=None):
+    """
+    Junta padrões + app_config 'servicos' (campos por chave; chave nova cria
+    serviço, {"ativo": false} remove) + preços/emojis/caps do painel e devolve
+    as rotas já na ordem do menu, num só mapping imutável (quem itera o menu
+    e quem busca por chave leem o mesmo snapshot). Linhas inválidas são
+    descartadas com log.
+    """
+    specs = collections.OrderedDict((l[0], _linha_padrao(l)) for l in SERVICOS_PADRAO)
+    for chave, campos in (overrides or {}).items():
+        if not isinstance(campos, dict):
+            continue
+        if campos.get('ativo') is False:
+            specs.pop(chave, None)
+            continue
+        specs.setdefault(chave, {'nome': chave, 'emoji': '•', 'preco': None, 'provider': None,
+                                 'codigo': None, 'cap': None, 'regra_preco': 'menor',
+                                 'texto_completo': False})
+        specs[chave].update({k: v for k, v in campos.items() if k != 'ativo'})
+    ordem = list(specs)
+    for chave, campos in (overrides or {}).items():
+        if isinstance(campos, dict) and 'ordem' in campos and chave in specs:
+            try:
+                pos = max(0, int(campos['ordem']))
+            except (TypeError, ValueError):
+                continue
+            ordem.remove(chave)
+            ordem.insert(pos, chave)
 
-# >>> rótulos
-SERVICE_NAMES = {
-    'mercado':    'Mercado Pago SMS',
-    'mpsrv2':     'Mercado Pago SMS Servidor 2',
-    'china':      'SMS para China',
-    'china2':     'SMS para China 2',
-    'china3':     'SMS para China 3',  # novo
-    'picpay':     'PicPay SMS',
-    'picsrv2':    'PicPay SMS Servidor 2',
-    'wa1':        'WhatsApp',
-    'wa2':        'WhatsApp Servidor 2',
-    'outros':     'Outros SMS',
-    'srv2':       'Outros SMS Servidor 2',
-    # sms24h:
-    'nubank':     'Nubank SMS Servidor 2',
-    'c6':         'C6 Bank SMS Servidor 2',
-    'neon':       'Neon SMS Servidor 2',
-    'agibanksrv2':'Agibank SMS Servidor 2',   # novo
-    'app99srv2':  '99app SMS Servidor 2',     # novo
-    'nextsrv2':   'Next SMS Servidor 2',      # novo
-    # Servidor 1:
-    'c6srv1':     'C6 Bank SMS',
-    'google':     'Google SMS',
-    'agibank':    'Agibank SMS',             # novo
-    'app99':      '99app SMS',               # novo
-    # Servidor 2:
-    'googlesrv2': 'Google SMS Servidor 2',
-}
+    rotas = {}
+    with SERVICE_CODE_LOCK:
+        mapa = dict(GLOBAL_SERVICE_MAP)
+    for chave in ordem:
+        s = specs[chave]
+        try:
+            preco = float((precos or {}).get(chave, s['preco']))
+            cap = (caps or {}).get(chave, s['cap'])
+            if s['provider'] == 'smsbower':
+                cap = float(cap if cap is not None else S1_CAP_PADRAO)
+            elif s['provider'] == 'sms24h':
+                cap = None
+            else:
+                raise ValueError(f"provider desconhecido: {s['provider']}")
+            codigo = s['codigo'] or mapa.get(chave)
+            if not codigo:
+                raise ValueError("sem código no provider")
+        except (TypeError, ValueError) as e:
+            logger.error(f"[SERVICOS] '{chave}' ignorado: {e}")
+            continue
+        rotas[chave] = RotaServico(
+            chave, s['nome'], (emojis or {}).get(chave) or s['emoji'], preco,
+            s['provider'], codigo, cap, s['regra_preco'], bool(s['texto_completo']),
+            SERVIDOR_PROVIDER[s['provider']])
+    return MappingProxyType(rotas)
 
-# >>> emojis
-SERVICE_EMOJIS = {
-    'mercado':     '📲',
-    'mpsrv2':      '🛰️',
-    'china':       '🇨🇳',
-    'china2':      '🇨🇳',
-    'china3':      '🇨🇳',   # novo
-    'picpay':      '💸',
-    'picsrv2':     '🛰️',
-    'wa1':         '💬',
-    'wa2':         '🛰️',
-    'outros':      '📡',
-    'srv2':        '🛰️',
-    'nubank':      '🏦',
-    'c6':          '🏦',
-    'neon':        '🏦',
-    'c6srv1':      '🏦',
-    'google':      '🔍',
-    'googlesrv2':  '🔍',
-    'agibank':     '🏦',    # novo
-    'agibanksrv2': '🏦',    # novo
-    'app99':       '🚕',    # novo
-    'app99srv2':   '🚕',    # novo
-    'nextsrv2':    '🏦',    # novo
-}
+ROTAS_SERVICO = compilar_servicos()
+
+# Visões derivadas da tabela (painel, docs e validações continuam usando estes nomes)
+SERVICE_PRICES  = MappingProxyType({k: r.preco for k, r in ROTAS_SERVICO.items()})
+SERVICE_NAMES   = MappingProxyType({k: r.nome for k, r in ROTAS_SERVICO.items()})
+SERVICE_EMOJIS  = MappingProxyType({k: r.emoji for k, r in ROTAS_SERVICO.items()})
+# >>> CAPs por serviço (Servidor 1 / SMSBower) - EDITÁVEIS NO PAINEL
+S1_CAPS         = MappingProxyType({k: r.cap for k, r in ROTAS_SERVICO.items() if r.provider == 'smsbower'})
 
 # >>> CAP global editável para maxPrice no SMSBower
 SMSBOWER_MAX_PRICE_CAP = 0.1754  # USD
-
-# >>> NOVO: CAPs por serviço (Servidor 1 / SMSBower) - EDITÁVEIS NO PAINEL
-DEFAULT_S1_CAPS = {
-    'mercado':  0.10,
-    'china':    0.10,
-    'china2':   0.10,
-    'picpay':   0.10,
-    'wa1':      0.70,  # WA segue regra especial, mas limitado por este cap
-    'outros':   0.20,
-    'c6srv1':   0.08,  # solicitado
-    'google':   0.11,  # solicitado
-    'agibank':  0.08,  # novo: Agibank S1
-    'app99':    0.07,  # novo: 99app S1
-}
-S1_CAPS = DEFAULT_S1_CAPS.copy()
 import secrets
 @bot.message_handler(func=lambda m: PENDING_REACT.get(m.from_user.id))
 def handle_reactivate(m):
@@ -347,17 +1053,7 @@ def handle_reactivate(m):
 
     # Chama API getExtraActivation
     try:
-        r = requests.get(
-            SMS24H_URL,
-            params={
-                'api_key': API_KEY_SMS24H,
-                'action': 'getExtraActivation',
-                'activationId': aid_old
-            },
-            timeout=12
-        )
-        r.raise_for_status()
-        txt = r.text.strip()
+        txt = sms24h_api.get_extra_activation(aid_old)
     except requests.exceptions.HTTPError:
         return bot.send_message(m.chat.id, "❌ Erro: A reativação não está disponível no momento.")
     except Exception:
@@ -367,7 +1063,7 @@ def handle_reactivate(m):
     if txt.startswith("ACCESS_NUMBER:"):
         _a, new_aid, new_phone = txt.split(":", 2)
 
-        ok = comprar_numero_atomico(uid, new_aid, price)
+        ok = comprar_numero_atomico(uid, new_aid, price, 'srv2')
         if not ok:
             return bot.send_message(m.chat.id, "⚠ Erro ao descontar saldo, tente novamente.")
 
@@ -382,7 +1078,7 @@ def handle_reactivate(m):
             parse_mode="Markdown"
         )
 
-        status_map[new_aid] = {
+        registrar_ativacao(new_aid, {
             'user_id': uid,
             'price': price,
             'chat_id': m.chat.id,
@@ -392,15 +1088,75 @@ def handle_reactivate(m):
             'full': new_phone,
             'short': short,
             'provider': 'sms24h',
+            'creation_ts': time.time(),
             'codes': []
-        }
+        })
 
-        spawn_sms_thread(new_aid)
+        iniciar_polling(new_aid)
         return
 
     # Erros da API:
     bot.send_message(m.chat.id, f"❌ Não foi possível reativar.\nAPI: {txt}")
 
+# >>> NOVO: cache token → user_id (LRU + TTL, com cache negativo p/ tokens inválidos)
+API_TOKEN_CACHE_MAX     = int(os.getenv("API_TOKEN_CACHE_MAX", "10000"))
+API_TOKEN_CACHE_TTL     = float(os.getenv("API_TOKEN_CACHE_TTL", "300"))
+API_TOKEN_CACHE_NEG_TTL = float(os.getenv("API_TOKEN_CACHE_NEG_TTL", "30"))
+
+class CacheTokens:
+    def __init__(self, max_itens, ttl, ttl_negativo):
+        self.max_itens = max_itens
+        self.ttl = ttl
+        self.ttl_negativo = ttl_negativo
+        self._lock = threading.Lock()
+        self._itens = collections.OrderedDict()   # token -> (user_id | None, expira_em)
+        self.stats = {"hits": 0, "misses": 0, "negativos": 0}
+
+    def get(self, token):
+        """(achou, user_id); user_id None = token sabidamente inválido."""
+        with self._lock:
+            item = self._itens.get(token)
+            if item is None or item[1] < time.monotonic():
+                if item is not None:
+                    del self._itens[token]
+                self.stats["misses"] += 1
+                return False, None
+            self._itens.move_to_end(token)
+            self.stats["hits"] += 1
+            if item[0] is None:
+                self.stats["negativos"] += 1
+            return True, item[0]
+
+    def put(self, token, user_id):
+        ttl = self.ttl if user_id is not None else self.ttl_negativo
+        with self._lock:
+            self._itens[token] = (user_id, time.monotonic() + ttl)
+            self._itens.move_to_end(token)
+            while len(self._itens) > self.max_itens:
+                self._itens.popitem(last=False)
+
+    def invalidar(self, token=None, user_id=None):
+        with self._lock:
+            if token is not None:
+                self._itens.pop(token, None)
+            if user_id is not None:
+                for tk in [t for t, (u, _) in self._itens.items() if u == str(user_id)]:
+                    del self._itens[tk]
+
+token_cache = CacheTokens(API_TOKEN_CACHE_MAX, API_TOKEN_CACHE_TTL, API_TOKEN_CACHE_NEG_TTL)
+
+def autenticar_token(token):
+    """user_id (str) dono do token, ou None. Só vai ao banco em cache miss."""
+    achou, user_id = token_cache.get(token)
+    if achou:
+        return user_id
+    with get_db_conn() as conn, conn.cursor() as cur:
+        cur.execute("SELECT user_id FROM api_tokens WHERE token=%s", (token,))
+        row = cur.fetchone()
+    user_id = str(row['user_id']) if row else None
+    token_cache.put(token, user_id)
+    return user_id
+
 def get_or_create_api_token(user_id):
     with get_db_conn() as conn, conn.cursor() as cur:
         cur.execute("SELECT token FROM api_tokens WHERE user_id=%s", (str(user_id),))
@@ -411,97 +1167,165 @@ def get_or_create_api_token(user_id):
         token = secrets.token_hex(32)
         cur.execute("INSERT INTO api_tokens (user_id, token) VALUES (%s, %s)", (str(user_id), token))
         conn.commit()
-        return token
-
-# ---------- Persistência de preços, emojis, caps ----------
-def save_prices_emojis_to_db():
-    try:
-        with get_db_conn() as conn, conn.cursor() as cur:
-            cur.execute("""
-                INSERT INTO app_config (key, value) VALUES ('service_prices', %s)
-                ON CONFLICT (key) DO UPDATE SET value = EXCLUDED.value
-            """, (json.dumps(SERVICE_PRICES),))
-            cur.execute("""
-                INSERT INTO app_config (key, value) VALUES ('service_emojis', %s)
-                ON CONFLICT (key) DO UPDATE SET value = EXCLUDED.value
-            """, (json.dumps(SERVICE_EMOJIS),))
-            conn.commit()
-    except Exception as e:
-        logger.error(f"[config] erro ao salvar preços/emojis: {e}")
+    # token novo pode ter caído no cache negativo antes de existir
+    token_cache.put(token, str(user_id))
+    return token
 
-def load_prices_emojis_from_db():
-    global SERVICE_PRICES, SERVICE_EMOJIS
-    try:
-        with get_db_conn() as conn, conn.cursor() as cur:
-            cur.execute("SELECT key, value FROM app_config WHERE key IN ('service_prices','service_emojis')")
-            rows = cur.fetchall()
-        store = {r['key']: r['value'] for r in rows}
-        if 'service_prices' in store and isinstance(store['service_prices'], dict):
-            SERVICE_PRICES.update(store['service_prices'])
-        else:
-            save_prices_emojis_to_db()
-        if 'service_emojis' in store and isinstance(store['service_emojis'], dict):
-            SERVICE_EMOJIS.update(store['service_emojis'])
-        else:
-            save_prices_emojis_to_db()
-    except Exception as e:
-        logger.error(f"[config] erro ao carregar preços/emojis: {e}")
-
-def save_smsg_cap_to_db():
-    try:
-        with get_db_conn() as conn, conn.cursor() as cur:
-            cur.execute("""
-                INSERT INTO app_config (key, value) VALUES ('smsbower_max_price_cap', %s)
-                ON CONFLICT (key) DO UPDATE SET value = EXCLUDED.value
-            """, (json.dumps(SMSBOWER_MAX_PRICE_CAP),))
-            conn.commit()
-    except Exception as e:
-        logger.error(f"[config] erro ao salvar cap do SMSBower: {e}")
-
-def load_smsg_cap_from_db():
+def rotacionar_api_token(user_id):
+    """Gera um token novo e revoga o anterior (inclusive no cache)."""
+    token = secrets.token_hex(32)
+    with get_db_conn() as conn, conn.cursor() as cur:
+        cur.execute("SELECT token FROM api_tokens WHERE user_id=%s", (str(user_id),))
+        row = cur.fetchone()
+        cur.execute("""
+            INSERT INTO api_tokens (user_id, token) VALUES (%s, %s)
+            ON CONFLICT (user_id) DO UPDATE SET token = EXCLUDED.token
+        """, (str(user_id), token))
+        conn.commit()
+    if row:
+        token_cache.put(row['token'], None)
+    token_cache.invalidar(user_id=user_id)
+    token_cache.put(token, str(user_id))
+    return token
+
+# ---------- Persistência de preços, emojis, caps (compartilhada entre workers) ----------
+# Cada alteração vai para app_config e é anunciada com NOTIFY; cada worker
+# tem uma thread em LISTEN que relê a chave e troca o snapshot imutável
+# (MappingProxyType) de uma vez. Leitores nunca veem um dict pela metade
+# e não há leitura no banco por requisição.
+CONFIG_CHANNEL      = "app_config"
+# LISTEN precisa de sessão própria: com pgbouncer em modo transaction,
+# aponte DATABASE_URL_DIRECT para o Postgres direto
+DATABASE_URL_DIRECT = os.getenv("DATABASE_URL_DIRECT") or DATABASE_URL
+CONFIG_KEYS = ('service_prices', 'service_emojis', 'smsbower_max_price_cap',
+               'smsbower_service_caps', 'scanner_enabled', 'china2', 'servicos')
+
+_config_lock = threading.Lock()
+config_stats = {"notificacoes": 0, "recargas": 0, "reconexoes": 0}
+
+# últimas versões lidas de app_config que entram na tabela de serviços
+_config_servicos = {'servicos': {}, 'service_prices': {}, 'service_emojis': {}, 'smsbower_service_caps': {}}
+
+def _recompilar_servicos():
+    """Recompila a tabela e troca rotas + visões derivadas de uma vez (sob _config_lock)."""
+    global ROTAS_SERVICO, SERVICE_PRICES, SERVICE_NAMES, SERVICE_EMOJIS, S1_CAPS
+    precos, caps = {}, {}
+    for origem, destino in ((_config_servicos['service_prices'], precos),
+                            (_config_servicos['smsbower_service_caps'], caps)):
+        for k, v in origem.items():
+            try: destino[k] = float(v)
+            except: pass
+    rotas = compilar_servicos(_config_servicos['servicos'], precos,
+                              _config_servicos['service_emojis'], caps)
+    ROTAS_SERVICO = rotas
+    SERVICE_PRICES = MappingProxyType({k: r.preco for k, r in rotas.items()})
+    SERVICE_NAMES  = MappingProxyType({k: r.nome for k, r in rotas.items()})
+    SERVICE_EMOJIS = MappingProxyType({k: r.emoji for k, r in rotas.items()})
+    S1_CAPS        = MappingProxyType({k: r.cap for k, r in rotas.items() if r.provider == 'smsbower'})
+
+def aplicar_config(key, value):
+    """Troca o snapshot em memória da chave (sem tocar no banco)."""
     global SMSBOWER_MAX_PRICE_CAP
-    try:
-        with get_db_conn() as conn, conn.cursor() as cur:
-            cur.execute("SELECT value FROM app_config WHERE key='smsbower_max_price_cap'")
-            row = cur.fetchone()
-        if row is not None:
-            val = row['value']
+    global SCANNER_ENABLED, SCANNER_LAST_PRICE
+    with _config_lock:
+        if key in _config_servicos and isinstance(value, dict):
+            _config_servicos[key] = value
+            _recompilar_servicos()
+        elif key == 'smsbower_max_price_cap':
             try:
-                SMSBOWER_MAX_PRICE_CAP = float(val if not isinstance(val, dict) else val.get('cap', SMSBOWER_MAX_PRICE_CAP))
+                SMSBOWER_MAX_PRICE_CAP = float(value if not isinstance(value, dict) else value.get('cap', SMSBOWER_MAX_PRICE_CAP))
             except:
                 pass
-    except Exception as e:
-        logger.error(f"[config] erro ao carregar cap do SMSBower: {e}")
-
-# >>> NOVO: persistir/ler caps por serviço (Servidor 1)
-def save_s1_caps_to_db():
+        elif key == 'scanner_enabled':
+            SCANNER_ENABLED = bool(value)
+        elif key == 'china2' and isinstance(value, dict) and value.get('code'):
+            with SERVICE_CODE_LOCK:
+                GLOBAL_SERVICE_MAP['china2'] = value['code']
+            _recompilar_servicos()
+            if value.get('price') is not None:
+                with SCANNER_PRICE_LOCK:
+                    SCANNER_LAST_PRICE = float(value['price'])
+
+def salvar_config(key, value):
+    """
+    Grava em app_config e avisa os outros workers; só depois do COMMIT aplica
+    aqui (relendo do banco, que é quem manda). Se a gravação falhar nada muda
+    em nenhum worker e retorna False para o chamador avisar.
+    """
     try:
         with get_db_conn() as conn, conn.cursor() as cur:
             cur.execute("""
-                INSERT INTO app_config (key, value) VALUES ('smsbower_service_caps', %s)
+                INSERT INTO app_config (key, value) VALUES (%s, %s)
                 ON CONFLICT (key) DO UPDATE SET value = EXCLUDED.value
-            """, (json.dumps(S1_CAPS),))
+            """, (key, json.dumps(value)))
+            # entregue aos ouvintes só no COMMIT
+            cur.execute("SELECT pg_notify(%s, %s)", (CONFIG_CHANNEL, key))
             conn.commit()
     except Exception as e:
-        logger.error(f"[config] erro ao salvar caps por serviço: {e}")
+        logger.error(f"[config] erro ao salvar {key}: {e}")
+        return False
+    carregar_config((key,))
+    return True
 
-def load_s1_caps_from_db():
-    global S1_CAPS
+def carregar_config(keys=CONFIG_KEYS, gravar_padroes=False):
     try:
         with get_db_conn() as conn, conn.cursor() as cur:
-            cur.execute("SELECT value FROM app_config WHERE key='smsbower_service_caps'")
-            row = cur.fetchone()
-        if row and isinstance(row['value'], dict):
-            S1_CAPS.update(row['value'])
-        else:
-            save_s1_caps_to_db()
+            cur.execute("SELECT key, value FROM app_config WHERE key = ANY(%s)", (list(keys),))
+            store = {r['key']: r['value'] for r in cur.fetchall()}
     except Exception as e:
-        logger.error(f"[config] erro ao carregar caps por serviço: {e}")
+        logger.error(f"[config] erro ao carregar {', '.join(keys)}: {e}")
+        return
+    for key, value in store.items():
+        aplicar_config(key, value)
+    config_stats["recargas"] += 1
+    if gravar_padroes:
+        padroes = {
+            'service_prices': dict(SERVICE_PRICES),
+            'service_emojis': dict(SERVICE_EMOJIS),
+            'smsbower_service_caps': dict(S1_CAPS),
+        }
+        for key, value in padroes.items():
+            if key not in store:
+                salvar_config(key, value)
+
+def _config_listener_loop():
+    espera = 1
+    while True:
+        conn = None
+        try:
+            conn = psycopg2.connect(DATABASE_URL_DIRECT)
+            conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+            with conn.cursor() as cur:
+                cur.execute(f"LISTEN {CONFIG_CHANNEL}")
+            # o que mudou enquanto estávamos desconectados
+            carregar_config()
+            espera = 1
+            while True:
+                if select.select([conn], [], [], 60) == ([], [], []):
+                    with conn.cursor() as cur:
+                        cur.execute("SELECT 1")   # keepalive
+                    continue
+                conn.poll()
+                chaves = set()
+                while conn.notifies:
+                    chaves.add(conn.notifies.pop(0).payload)
+                config_stats["notificacoes"] += len(chaves)
+                chaves &= set(CONFIG_KEYS)
+                if chaves:
+                    carregar_config(tuple(chaves))
+        except Exception as e:
+            config_stats["reconexoes"] += 1
+            logger.error(f"[config] listener caiu: {e}")
+        finally:
+            if conn is not None:
+                try: conn.close()
+                except: pass
+        time.sleep(espera)
+        espera = min(espera * 2, 60)
 
 # carregar persistidos
-load_prices_emojis_from_db()
-load_smsg_cap_from_db()
-load_s1_caps_from_db()
+carregar_config(gravar_padroes=True)
+threading.Thread(target=_config_listener_loop, name="config-listener", daemon=True).start()
 @app.route('/webhook/smsbower', methods=['POST'])
 def smsbower_webhook():
     try:
@@ -525,45 +1349,32 @@ def smsbower_webhook():
         # =====================================================
         # REGRA PRINCIPAL
         # =====================================================
-        if service_key == "outros":
-            # 👉 OUTROS: envia TEXTO COMPLETO
-            payloads = [text.strip()]
-        else:
-            # 👉 TODOS OS OUTROS: só números com 4+ dígitos
-            payloads = [n for n in re.findall(r"\d+", text) if len(n) >= 4]
+        # texto completo ou só números com 4+ dígitos, conforme a rota do serviço
+        payloads = extrair_codigos(service_key, text)
 
         if not payloads:
             return "ok", 200
 
-        enviados = []
-
-        for payload in payloads:
-            if payload in info["codes"]:
-                continue
-            info["codes"].append(payload)
-            enviados.append(payload)
+        enviados = adicionar_codigos(aid, info, payloads)
 
         if not enviados:
             return "ok", 200
 
-        registrar_sms_recebido(aid)
-
         # =====================================================
         # LOG DO SMS (BOT SEPARADO)
         # =====================================================
-        try:
-            sms_log_bot.send_message(
-                ADMIN_CHAT_ID,
-                f"📩 *SMS RECEBIDO (SMSBOWER)*\n"
-                f"AID: `{aid}`\n"
-                f"Serviço: `{service_key}`\n"
-                f"Texto:\n`{text}`\n\n"
-                f"Extraído:\n`{', '.join(enviados)}`\n"
-                f"🕘 {received_at}",
-                parse_mode="Markdown"
-            )
-        except:
-            pass
+        tg_enviar(
+            ADMIN_CHAT_ID,
+            f"📩 *SMS RECEBIDO (SMSBOWER)*\n"
+            f"AID: `{aid}`\n"
+            f"Serviço: `{service_key}`\n"
+            f"Texto:\n`{text}`\n\n"
+            f"Extraído:\n`{', '.join(enviados)}`\n"
+            f"🕘 {received_at}",
+            prioridade=PRIO_COUNTDOWN,
+            bot_inst=sms_log_bot,
+            parse_mode="Markdown"
+        )
 
         # =====================================================
         # API → só grava
@@ -574,41 +1385,7 @@ def smsbower_webhook():
         # =====================================================
         # TELEGRAM USUÁRIO
         # =====================================================
-        chat_id = info.get("chat_id")
-        full = info.get("full")
-        short = info.get("short")
-        service_name = info.get("service")
-
-        msg = (
-            f"📦 {service_name}\n"
-            f"☎️ Número: `{full}`\n"
-            f"☎️ Sem DDI: `{short}`\n\n"
-        )
-
-        for i, p in enumerate(info["codes"], 1):
-            msg += f"📩 SMS{i}: `{p}`\n"
-
-        msg += f"🕘 {received_at}"
-
-        kb = telebot.types.InlineKeyboardMarkup()
-        kb.row(telebot.types.InlineKeyboardButton('📲 Receber outro SMS', callback_data=f'retry_{aid}'))
-        kb.row(telebot.types.InlineKeyboardButton('🛒 Comprar mesmo serviço', callback_data=f'comprar_{service_key}'))
-        kb.row(
-            telebot.types.InlineKeyboardButton('📲 Comprar serviços', callback_data='menu_comprar'),
-            telebot.types.InlineKeyboardButton('📜 Menu', callback_data='menu')
-        )
-
-        if info.get("sms_message_id"):
-            bot.edit_message_text(
-                msg,
-                chat_id,
-                info["sms_message_id"],
-                parse_mode="Markdown",
-                reply_markup=kb
-            )
-        else:
-            m = bot.send_message(chat_id, msg, parse_mode="Markdown", reply_markup=kb)
-            info["sms_message_id"] = m.message_id
+        _notificar_codigos_telegram(aid, info, received_at)
 
         return "ok", 200
 
@@ -626,41 +1403,63 @@ def smsbower_webhook():
 # =========================================================
 # ======================== USUÁRIO =========================
 # =========================================================
+# saldo em centavos a partir do livro-razão (parâmetros: user_id, user_id)
+SALDO_CENTAVOS_SQL = """(
+    COALESCE((SELECT centavos FROM saldo_snapshot WHERE user_id=%s), 0)
+  + COALESCE((SELECT sum(valor_centavos) FROM saldo_lancamentos WHERE user_id=%s AND NOT compactado), 0)
+)::bigint"""
+
 def carregar_usuario(uid):
+    # não lê mais a coluna legada "numeros" (lista pode ter milhares de AIDs)
     with get_db_conn() as conn:
         with conn.cursor() as cur:
-            cur.execute("SELECT * FROM usuarios WHERE id=%s", (str(uid),))
+            cur.execute(f"""
+                SELECT id, refer, indicados, {SALDO_CENTAVOS_SQL} AS centavos
+                FROM usuarios WHERE id=%s
+            """, (str(uid), str(uid), str(uid)))
             user = cur.fetchone()
             if not user:
                 return None
-            user['numeros'] = json.loads(user['numeros'])
+            user['saldo'] = user.pop('centavos') / 100
             user['indicados'] = json.loads(user.get('indicados', '[]') or '[]')
             return user
 
+def listar_numeros_usuario(uid, limite=50):
+    """AIDs mais recentes do usuário (índice user_id, data_criacao)."""
+    with get_db_conn() as conn:
+        with conn.cursor() as cur:
+            cur.execute("""
+                SELECT aid FROM numeros_sms
+                WHERE user_id=%s
+                ORDER BY data_criacao DESC
+                LIMIT %s
+            """, (str(uid), limite))
+            return [r['aid'] for r in cur.fetchall()]
+
 def salvar_usuario(user):
     with get_db_conn() as conn:
         with conn.cursor() as cur:
+            # saldo não é mais gravado aqui: só via lançamentos (creditar/reservar)
             cur.execute("""
-                UPDATE usuarios SET saldo=%s, numeros=%s, refer=%s, indicados=%s WHERE id=%s
+                UPDATE usuarios SET refer=%s, indicados=%s WHERE id=%s
             """, (
-                user['saldo'],
-                json.dumps(user['numeros']),
                 user.get('refer'),
                 json.dumps(user.get('indicados', [])),
                 str(user['id'])
             ))
             conn.commit()
-    try:
-        exportar_backup_json()
-    except Exception as e:
-        logger.error(f"Erro ao enviar backup: {e}")
+    agendar_backup()
 
 def criar_usuario(uid, refer=None):
     with get_db_conn() as conn:
         with conn.cursor() as cur:
-            cur.execute("SELECT id FROM usuarios WHERE id=%s", (str(uid),))
+            cur.execute("SELECT id, bloqueado FROM usuarios WHERE id=%s", (str(uid),))
             exists = cur.fetchone()
             if exists:
+                if exists.get('bloqueado'):
+                    # voltou a falar com o bot → volta a receber broadcasts
+                    cur.execute("UPDATE usuarios SET bloqueado=FALSE WHERE id=%s", (str(uid),))
+                    conn.commit()
                 return
             cur.execute("""
                 INSERT INTO usuarios (id, saldo, numeros, refer, indicados)
@@ -684,43 +1483,156 @@ def get_user_ref_link(uid):
 def exportar_backup_json():
     with get_db_conn() as conn:
         with conn.cursor() as cur:
-            cur.execute("SELECT * FROM usuarios")
+            cur.execute("""
+                SELECT u.id,
+                       ((COALESCE(s.centavos, 0) + COALESCE(p.centavos, 0)) / 100.0)::float8 AS saldo,
+                       u.refer, u.indicados,
+                       COALESCE(
+                           json_agg(n.aid ORDER BY n.data_criacao) FILTER (WHERE n.aid IS NOT NULL),
+                           '[]'::json
+                       ) AS numeros
+                FROM usuarios u
+                LEFT JOIN saldo_snapshot s ON s.user_id = u.id
+                LEFT JOIN (
+                    SELECT user_id, sum(valor_centavos) AS centavos
+                    FROM saldo_lancamentos WHERE NOT compactado GROUP BY user_id
+                ) p ON p.user_id = u.id
+                LEFT JOIN numeros_sms n ON n.user_id = u.id
+                GROUP BY u.id, s.centavos, p.centavos
+            """)
             users = cur.fetchall()
-            for u in users:
-                u['numeros'] = json.loads(u['numeros'])
-                u['indicados'] = json.loads(u.get('indicados', '[]') or '[]')
-            with open("usuarios_backup.json", "w", encoding="utf-8") as f:
-                json.dump(users, f, indent=2, ensure_ascii=False)
-            enviar_documento_bot(backup_bot, BACKUP_CHAT_ID, "usuarios_backup.json")
+    # arquivo e upload fora da conexão para não prender o pool durante o envio
+    for u in users:
+        u['indicados'] = json.loads(u.get('indicados', '[]') or '[]')
+    tmp = "usuarios_backup.json.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(users, f, ensure_ascii=False)
+    os.replace(tmp, "usuarios_backup.json")
+    enviar_documento_bot(backup_bot, BACKUP_CHAT_ID, "usuarios_backup.json")
 
 # =========================================================
-# ============= serviço api =================
+# ============ BACKUP EM SEGUNDO PLANO (debounce) =========
 # =========================================================
-@bot.message_handler(commands=['token'])
-def cmd_token(m):
-    criar_usuario(m.from_user.id)
-    tk = get_or_create_api_token(m.from_user.id)
-    bot.send_message(m.chat.id, f"🔑 Seu token API:\n`{tk}`", parse_mode='Markdown')
-@app.route('/api/buy', methods=['POST'])
-def api_buy():
-    data = request.json or {}
-
+# Quem altera saldo só marca "sujo"; um worker gera no máximo um snapshot
+# a cada BACKUP_MIN_INTERVAL_SEC e o último é forçado no desligamento.
+BACKUP_MIN_INTERVAL_SEC = float(os.getenv("BACKUP_MIN_INTERVAL_SEC", "120"))
+
+_backup_cond = threading.Condition()
+_backup_state = {"dirty": False, "last_run": 0.0, "thread": None, "stopping": False}
+backup_stats = {"solicitados": 0, "enviados": 0, "falhas": 0, "ultimo_ms": 0.0}
+
+def agendar_backup():
+    """Marca o backup como pendente; retorna imediatamente."""
+    with _backup_cond:
+        _backup_state["dirty"] = True
+        backup_stats["solicitados"] += 1
+        t = _backup_state["thread"]
+        if t is None or not t.is_alive():
+            t = threading.Thread(target=_backup_worker, name="backup-worker", daemon=True)
+            _backup_state["thread"] = t
+            t.start()
+        _backup_cond.notify()
+
+def _executar_backup():
+    t0 = time.perf_counter()
+    try:
+        exportar_backup_json()
+        backup_stats["enviados"] += 1
+    except Exception as e:
+        backup_stats["falhas"] += 1
+        logger.error(f"Erro ao enviar backup: {e}")
+    finally:
+        backup_stats["ultimo_ms"] = (time.perf_counter() - t0) * 1000
+
+def _backup_worker():
+    while True:
+        with _backup_cond:
+            while not _backup_state["dirty"] and not _backup_state["stopping"]:
+                _backup_cond.wait()
+            if _backup_state["stopping"]:
+                return
+            # janela de coalescência: espera o intervalo mínimo desde o último envio
+            espera = _backup_state["last_run"] + BACKUP_MIN_INTERVAL_SEC - time.time()
+            while espera > 0 and not _backup_state["stopping"]:
+                _backup_cond.wait(espera)
+                espera = _backup_state["last_run"] + BACKUP_MIN_INTERVAL_SEC - time.time()
+            if _backup_state["stopping"]:
+                return
+            _backup_state["dirty"] = False
+            _backup_state["last_run"] = time.time()
+        _executar_backup()
+
+def flush_backup():
+    """Chamado no desligamento: para o worker e grava o snapshot pendente."""
+    with _backup_cond:
+        _backup_state["stopping"] = True
+        pendente = _backup_state["dirty"]
+        _backup_state["dirty"] = False
+        _backup_cond.notify_all()
+    if pendente:
+        _executar_backup()
+
+atexit.register(flush_backup)
+
+# =========================================================
+# ============= serviço api =================
+# =========================================================
+@bot.message_handler(commands=['token'])
+def cmd_token(m):
+    criar_usuario(m.from_user.id)
+    # "/token novo" revoga o token atual e gera outro
+    if (m.text or "").split()[1:2] == ["novo"]:
+        tk = rotacionar_api_token(m.from_user.id)
+    else:
+        tk = get_or_create_api_token(m.from_user.id)
+    bot.send_message(m.chat.id, f"🔑 Seu token API:\n`{tk}`", parse_mode='Markdown')
+def solicitar_numero_api(service):
+    """
+    Pede um número ao provider do serviço pela tabela de rotas (mesmas regras
+    de preço/cap para API, lote e bot). Retorna (resp, provider, serviodr); resp None = serviço sem configuração.
+    """
+    rota = ROTAS_SERVICO.get(service)
+    if rota is None:
+        return None, None, None
+
+    if rota.provider == 'sms24h':
+        return sms24h_api.get_number(rota.codigo), rota.provider, rota.servidor
+
+    # smsbower respeitando limite USD
+    s1_effective_cap = min(float(SMSBOWER_MAX_PRICE_CAP), rota.cap)
+
+    if rota.regra_preco == 'wa':
+        base_max_price = obter_preco_wa_desc_v2(rota.codigo, COUNTRY_ID, max_usd=s1_effective_cap)
+    elif rota.regra_preco == 'scanner':
+        with SCANNER_PRICE_LOCK:
+            mp = SCANNER_LAST_PRICE
+        base_max_price = float(mp) if mp is not None else obter_menor_preco_v2(rota.codigo, COUNTRY_ID)
+    else:
+        base_max_price = obter_menor_preco_v2(rota.codigo, COUNTRY_ID)
+
+    if (base_max_price is None) or (float(base_max_price) > s1_effective_cap):
+        return {"status": "error", "message": "NO_NUMBERS"}, rota.provider, rota.servidor
+
+    # compra no menor preço encontrado (para realmente “comprar o menor”)
+    resp = smsbower_api.get_number(rota.codigo, max_price=float(base_max_price))
+    return resp, rota.provider, rota.servidor
+
+
+@app.route('/api/buy', methods=['POST'])
+def api_buy():
+    data = request.json or {}
+
     token = data.get("token")
     service = data.get("service")  # exemplo: mercado, china, google...
 
     if not token or not service:
         return {"error": "token e service são obrigatórios"}, 400
 
-    # validar token
-    with get_db_conn() as conn, conn.cursor() as cur:
-        cur.execute("SELECT user_id FROM api_tokens WHERE token=%s", (token,))
-        row = cur.fetchone()
-
-    if not row:
+    # validar token (cache em memória)
+    user_id = autenticar_token(token)
+    if not user_id:
         return {"error": "token inválido"}, 401
 
-    user_id = row['user_id']
-
     # validar user
     user = carregar_usuario(user_id)
     if not user:
@@ -736,68 +1648,9 @@ def api_buy():
     if saldo < price:
         return {"error": "saldo insuficiente", "saldo": saldo}, 402
 
-    # identificar provider
-    idsms = {
-        'mercado':     get_service_code('mercado'),
-        'mpsrv2':      'cq',
-        'china':       get_service_code('china'),
-        'china2':      get_service_code('china2'),
-        'china3':      'ot',      # novo: China 3 (srv2, sms24h)
-        'picpay':      get_service_code('picpay'),
-        'picsrv2':     'ev',
-        'wa1':         'wa',
-        'wa2':         'wa',
-        'outros':      get_service_code('outros'),
-        'srv2':        'ot',
-        'nubank':      'aaa',
-        'c6':          'aff',
-        'neon':        'aex',
-        'agibank':     'sa',      # novo: Agibank S1 (smsbower)
-        'agibanksrv2': 'sa',      # novo: Agibank S2 (sms24h)
-        'app99':       'ki',      # novo: 99app S1
-        'app99srv2':   'ki',      # novo: 99app S2
-        'nextsrv2':    'aey',     # novo: Next S2
-        'c6srv1':      get_service_code('outros'),
-        'google':      'go',
-        'googlesrv2':  'go',
-    }
-    
-    service_code = idsms.get(service)
-
-    if not service_code:
+    resp, provider, serviodr = solicitar_numero_api(service)
+    if resp is None:
         return {"error": "serviço sem configuração"}, 400
-
-    # servidor SMS24H
-        # servidor SMS24H
-    # servidor SMS24H
-    if service in ('srv2','mpsrv2','picsrv2','wa2','nubank','c6','neon','googlesrv2','agibanksrv2','app99srv2','nextsrv2','china3'):
-        resp = solicitar_numero_sms24h(service_code)
-        provider = 'sms24h'
-        serviodr = 'servidor 2'
-
-    else:
-        # smsbower respeitando limite USD
-        s1_effective_cap = min(
-            float(SMSBOWER_MAX_PRICE_CAP),
-            float(S1_CAPS.get(service, 0.10))
-        )
-
-        if service == 'wa1':
-            base_max_price = obter_preco_wa_desc_v2(service_code, COUNTRY_ID, max_usd=s1_effective_cap)
-        elif service == 'china2':
-            with SCANNER_PRICE_LOCK:
-                mp = SCANNER_LAST_PRICE
-            base_max_price = float(mp) if mp is not None else obter_menor_preco_v2(service_code, COUNTRY_ID)
-        else:
-            base_max_price = obter_menor_preco_v2(service_code, COUNTRY_ID)
-
-        if (base_max_price is None) or (float(base_max_price) > s1_effective_cap):
-            return {"error":"sem números disponíveis"}, 503
-
-        resp = solicitar_numero_smsbower(service_code, max_price=float(base_max_price))
-        provider = 'smsbower'
-        serviodr = 'servidor 1'
-
     if resp.get('status') != 'success':
         return {"error": "sem números disponíveis"}, 503
 
@@ -805,13 +1658,13 @@ def api_buy():
     full = resp['number']
     short = full[2:] if full.startswith('55') else full
 
-    ok = comprar_numero_atomico(user_id, aid, price)
+    ok = comprar_numero_atomico(user_id, aid, price, service)
 
     if not ok:
         return {"error": "erro ao descontar saldo / duplicidade"}, 500
 
-    # registrar para thread de SMS
-    status_map[aid] = {
+    # registrar para o polling de SMS
+    registrar_ativacao(aid, {
         "user_id": user_id,
         "price": price,
         "service": service,
@@ -824,9 +1677,9 @@ def api_buy():
         "is_api": True,
         "creation_ts": time.time(),
         "codes": []   # ✅ FUNDAMENTAL
-    }
+    })
 
-    spawn_sms_thread(aid)
+    iniciar_polling(aid)
 
     return {
         "status": "success",
@@ -838,6 +1691,130 @@ def api_buy():
         "provider": serviodr
     }, 200
 
+API_BATCH_MAX         = int(os.getenv("API_BATCH_MAX", "100"))
+API_BATCH_CONCORRENCIA = int(os.getenv("API_BATCH_CONCORRENCIA", "16"))
+_pool_lote = ThreadPoolExecutor(max_workers=API_BATCH_CONCORRENCIA, thread_name_prefix="buy-batch")
+
+@app.route('/api/buy_batch', methods=['POST'])
+def api_buy_batch():
+    data = request.json or {}
+
+    token = data.get("token")
+    service = data.get("service")
+    try:
+        quantidade = int(data.get("quantity", 0))
+    except (TypeError, ValueError):
+        quantidade = 0
+
+    if not token or not service:
+        return {"error": "token e service são obrigatórios"}, 400
+    if not 1 <= quantidade <= API_BATCH_MAX:
+        return {"error": f"quantity deve estar entre 1 e {API_BATCH_MAX}"}, 400
+
+    user_id = autenticar_token(token)
+    if not user_id:
+        return {"error": "token inválido"}, 401
+
+    if service not in SERVICE_PRICES:
+        return {"error": "serviço inválido"}, 400
+    price = SERVICE_PRICES[service]
+
+    # 1. reserva o lote inteiro de uma vez
+    if reservar_saldo(user_id, round(price * quantidade, 2), 'compra_lote') is None:
+        saldo = (carregar_usuario(user_id) or {}).get('saldo', 0.0)
+        return {"error": "saldo insuficiente", "saldo": saldo, "necessario": round(price * quantidade, 2)}, 402
+
+    # 2. pede os números em paralelo
+    itens = [None] * quantidade
+    try:
+        futuros = {_pool_lote.submit(solicitar_numero_api, service): i for i in range(quantidade)}
+        for fut in as_completed(futuros):
+            i = futuros[fut]
+            try:
+                itens[i] = fut.result()
+            except Exception as e:
+                logger.error(f"[API] buy_batch erro no item {i}: {e}")
+    finally:
+        # 3. associa os obtidos e estorna o restante (mesmo se algo acima falhar)
+        obtidos = {
+            r[0]['id']: r for r in itens
+            if r and r[0] is not None and r[0].get('status') == 'success'
+        }
+        for tentativa in range(3):
+            try:
+                associados, donos, saldo = confirmar_lote(user_id, price, service, list(obtidos), quantidade)
+                break
+            except Exception as e:
+                logger.error(f"[API] buy_batch confirmar_lote (tentativa {tentativa + 1}): {e}")
+                time.sleep(0.5 * (tentativa + 1))
+        else:
+            associados = None
+
+    if associados is None:
+        saldo = desfazer_lote(user_id, price, quantidade, obtidos)
+        return {"error": "falha ao registrar o lote; números cancelados e valor estornado",
+                "refunded": round(quantidade * price, 2), "saldo_restante": saldo}, 503
+
+    associados = set(associados)
+    vistos = set()
+    resultados = []
+    for r in itens:
+        resp = r[0] if r else None
+        if resp is None and r is not None:
+            resultados.append({"status": "error", "error": "serviço sem configuração"})
+            continue
+        if not resp or resp.get('status') != 'success':
+            resultados.append({"status": "error", "error": "sem números disponíveis"})
+            continue
+        aid, full = resp['id'], resp['number']
+        _, provider, serviodr = r
+        if aid in vistos:
+            # mesmo AID duas vezes no lote: vale só o primeiro, este já foi estornado
+            resultados.append({"status": "error", "error": "duplicidade"})
+            continue
+        vistos.add(aid)
+        if aid not in associados:
+            # AID já registrado (de outro usuário ou de compra anterior deste):
+            # o saldo já foi estornado; com dono não cancela no provider, senão
+            # mata uma ativação viva
+            if aid not in donos:
+                cancelar_numero(aid, provider)
+            resultados.append({"status": "error", "error": "duplicidade"})
+            continue
+        short = full[2:] if full.startswith('55') else full
+        registrar_ativacao(aid, {
+            "user_id": user_id,
+            "price": price,
+            "service": service,
+            "service_key": service,
+            "full": full,
+            "short": short,
+            "provider": provider,
+            "chat_id": None,
+            "message_id": None,
+            "is_api": True,
+            "creation_ts": time.time(),
+            "codes": []
+        })
+        iniciar_polling(aid)
+        resultados.append({
+            "status": "success",
+            "aid": aid,
+            "number": full,
+            "short": short,
+            "price": price,
+            "provider": serviodr
+        })
+
+    return {
+        "status": "success" if associados else "error",
+        "requested": quantidade,
+        "delivered": len(associados),
+        "refunded": round((quantidade - len(associados)) * price, 2),
+        "saldo_restante": saldo,
+        "items": resultados
+    }, 200 if associados else 503
+
 @app.route('/api/status', methods=['POST'])
 def api_status():
     data = request.json or {}
@@ -848,16 +1825,11 @@ def api_status():
     if not token or not aid:
         return {"error": "token e aid são obrigatórios"}, 400
 
-    # validar token
-    with get_db_conn() as conn, conn.cursor() as cur:
-        cur.execute("SELECT user_id FROM api_tokens WHERE token=%s", (token,))
-        row = cur.fetchone()
-
-    if not row:
+    # validar token (cache em memória)
+    user_id = autenticar_token(token)
+    if not user_id:
         return {"error": "token inválido"}, 401
 
-    user_id = row['user_id']
-
     info = status_map.get(aid)
 
     if not info:
@@ -866,8 +1838,10 @@ def api_status():
     if str(info['user_id']) != str(user_id):
         return {"error": "este número não pertence ao usuário"}, 403
 
-    status_resp = obter_status(aid, info['provider'])
+    return aplicar_status_api(aid, info, obter_status(aid, info['provider']))
 
+def aplicar_status_api(aid, info, status_resp):
+    """Interpreta o getStatus do provider na resposta do /api/status (e grava códigos novos)."""
     # nada ainda?
     if not status_resp or status_resp.startswith("STATUS_WAIT"):
         return {
@@ -886,15 +1860,7 @@ def api_status():
     raw = status_resp.split(":", 1)[1]
 
     # 🔒 REGRA ÚNICA PARA API (igual webhook)
-    if info.get("service_key") == "outros":
-        payloads = [raw.strip()]
-    else:
-        payloads = [n for n in re.findall(r"\d+", raw) if len(n) >= 4]
-
-    for p in payloads:
-        if p not in info["codes"]:
-            info["codes"].append(p)
-            registrar_sms_recebido(aid)
+    adicionar_codigos(aid, info, extrair_codigos(info.get("service_key"), raw))
 
     return {
         "status": "received",
@@ -912,15 +1878,10 @@ def api_cancel():
     if not token or not aid:
         return {"error": "token e aid são obrigatórios"}, 400
 
-    # validar token
-    with get_db_conn() as conn, conn.cursor() as cur:
-        cur.execute("SELECT user_id FROM api_tokens WHERE token=%s", (token,))
-        row = cur.fetchone()
-
-    if not row:
+    # validar token (cache em memória)
+    user_id = autenticar_token(token)
+    if not user_id:
         return {"error": "token inválido"}, 401
-
-    user_id = row['user_id']
     info = status_map.get(aid)
 
     if not info:
@@ -954,6 +1915,7 @@ def api_cancel():
     # =============================================================
 
     info['canceled_by_user'] = True
+    finalizar_ativacao(aid, 'cancelada')
     cancelar_numero(aid, provider)
     ok = marcar_cancelado_e_devolver(info['user_id'], aid)
 
@@ -971,15 +1933,11 @@ def api_retry():
     if not token or not aid:
         return {"error": "token e aid são obrigatórios"}, 400
 
-    # validar token
-    with get_db_conn() as conn, conn.cursor() as cur:
-        cur.execute("SELECT user_id FROM api_tokens WHERE token=%s", (token,))
-        row = cur.fetchone()
-
-    if not row:
+    # validar token (cache em memória)
+    user_id = autenticar_token(token)
+    if not user_id:
         return {"error": "token inválido"}, 401
-
-    user_id = str(row['user_id'])
+    user_id = str(user_id)
 
     info = status_map.get(aid)
 
@@ -995,21 +1953,12 @@ def api_retry():
     # - Se não recebeu ainda, também permite
     try:
         if provider == "smsbower":
-            requests.get(
-                SMSBOWER_URL,
-                params={
-                    'api_key': API_KEY_SMSBOWER,
-                    'action': 'setStatus',
-                    'status': '3',
-                    'id': aid
-                },
-                timeout=10
-            )
+            smsbower_api.chamar('setStatus', status='3', id=aid)
         else:
-            set_status_sms24h(aid, 3)
+            sms24h_api.set_status(aid, 3)
 
         # reinicia o monitor de SMS
-        spawn_sms_thread(aid)
+        iniciar_polling(aid)
 
         return {
             "status": "retry_sent",
@@ -1019,6 +1968,139 @@ def api_retry():
 
     except Exception as e:
         return {"error": "falha ao solicitar novo SMS", "details": str(e)}, 500
+# >>> NOVO: variantes em lote de status/cancel/retry
+def _lote_aids(data):
+    """Valida token + lista de AIDs. Retorna (user_id, aids, None) ou (None, None, (erro, http))."""
+    token = data.get("token")
+    aids = data.get("aids")
+    if not token or not isinstance(aids, list) or not aids:
+        return None, None, ({"error": "token e aids (lista) são obrigatórios"}, 400)
+    if len(aids) > API_BATCH_MAX:
+        return None, None, ({"error": f"no máximo {API_BATCH_MAX} aids por chamada"}, 400)
+    user_id = autenticar_token(token)
+    if not user_id:
+        return None, None, ({"error": "token inválido"}, 401)
+    return str(user_id), list(dict.fromkeys(str(a) for a in aids)), None
+
+def _ativacao_do_usuario(aid, user_id):
+    info = status_map.get(aid)
+    if not info:
+        return None, {"error": "aid inválido ou expirado"}
+    if str(info['user_id']) != user_id:
+        return None, {"error": "este número não pertence ao usuário"}
+    info.setdefault("codes", [])
+    return info, None
+
+@app.route('/api/status_batch', methods=['POST'])
+def api_status_batch():
+    user_id, aids, erro = _lote_aids(request.json or {})
+    if erro:
+        return erro
+
+    resultados = {}
+    consultar = {}
+    for aid in aids:
+        info, err = _ativacao_do_usuario(aid, user_id)
+        if err:
+            resultados[aid] = err
+        elif info.get("codes"):
+            # já temos o SMS em memória (webhook/poller): sem chamada ao provider
+            resultados[aid] = {"status": "received", "sms": api_last_code(info)}
+        elif info.get("estado") in ESTADOS_FINAIS:
+            resultados[aid] = {"status": "canceled", "sms": []}
+        else:
+            consultar[aid] = info
+
+    futuros = {_pool_lote.submit(obter_status, aid, info['provider']): aid for aid, info in consultar.items()}
+    for fut in as_completed(futuros):
+        aid = futuros[fut]
+        try:
+            resultados[aid] = aplicar_status_api(aid, consultar[aid], fut.result())
+        except Exception as e:
+            logger.error(f"[API] status_batch {aid}: {e}")
+            resultados[aid] = {"status": "waiting", "sms": consultar[aid].get("codes", [])}
+
+    return {"results": {aid: resultados[aid] for aid in aids}}
+
+@app.route('/api/cancel_batch', methods=['POST'])
+def api_cancel_batch():
+    user_id, aids, erro = _lote_aids(request.json or {})
+    if erro:
+        return erro
+
+    resultados = {}
+    elegiveis = {}
+    for aid in aids:
+        info, err = _ativacao_do_usuario(aid, user_id)
+        if err:
+            resultados[aid] = err
+            continue
+        if info.get("codes"):
+            resultados[aid] = {"error": "não pode cancelar após receber SMS"}
+            continue
+        if info.get("provider") == "smsbower":
+            elapsed = time.time() - info.setdefault("creation_ts", time.time())
+            if elapsed < 120:  # 2 minutos, igual ao /api/cancel
+                resultados[aid] = {
+                    "error": "cancelamento só permitido após 2 minutos para este provider",
+                    "wait_seconds": int(120 - elapsed)
+                }
+                continue
+        elegiveis[aid] = info
+
+    for aid, info in elegiveis.items():
+        info['canceled_by_user'] = True
+        finalizar_ativacao(aid, 'cancelada')
+    futuros = [_pool_lote.submit(cancelar_numero, aid, info.get("provider")) for aid, info in elegiveis.items()]
+    for fut in as_completed(futuros):
+        try:
+            fut.result()
+        except Exception as e:
+            logger.error(f"[API] cancel_batch provider: {e}")
+
+    estornados, saldo = cancelar_lote_e_devolver(user_id, list(elegiveis)) if elegiveis else ([], None)
+    estornados = set(estornados)
+    for aid in elegiveis:
+        resultados[aid] = {"status": "canceled" if aid in estornados else "error"}
+    if saldo is None:
+        saldo = carregar_usuario(user_id)['saldo']
+
+    return {"results": {aid: resultados[aid] for aid in aids}, "saldo": saldo}
+
+@app.route('/api/retry_batch', methods=['POST'])
+def api_retry_batch():
+    user_id, aids, erro = _lote_aids(request.json or {})
+    if erro:
+        return erro
+
+    resultados = {}
+    validos = {}
+    for aid in aids:
+        info, err = _ativacao_do_usuario(aid, user_id)
+        if err:
+            resultados[aid] = err
+        else:
+            validos[aid] = info
+
+    def pedir_outro(aid, provider):
+        if provider == "smsbower":
+            smsbower_api.chamar('setStatus', status='3', id=aid)
+        else:
+            sms24h_api.set_status(aid, 3)
+
+    futuros = {_pool_lote.submit(pedir_outro, aid, info.get("provider", "smsbower")): aid
+               for aid, info in validos.items()}
+    for fut in as_completed(futuros):
+        aid = futuros[fut]
+        try:
+            fut.result()
+            iniciar_polling(aid)
+            resultados[aid] = {"status": "retry_sent"}
+        except Exception as e:
+            resultados[aid] = {"error": "falha ao solicitar novo SMS", "details": str(e)}
+
+    return {"results": {aid: resultados[aid] for aid in aids}}
+
 @app.route('/api/balance', methods=['POST'])
 def api_balance():
     data = request.json or {}
@@ -1027,17 +2109,14 @@ def api_balance():
     if not token:
         return {"error": "token é obrigatório"}, 400
 
-    with get_db_conn() as conn, conn.cursor() as cur:
-        cur.execute("SELECT user_id FROM api_tokens WHERE token=%s", (token,))
-        row = cur.fetchone()
-
-    if not row:
+    user_id = autenticar_token(token)
+    if not user_id:
         return {"error": "token inválido"}, 401
 
-    user = carregar_usuario(row['user_id'])
+    user = carregar_usuario(user_id)
 
     return {
-        "user_id": row['user_id'],
+        "user_id": user_id,
         "saldo": float(user['saldo'])
     }
 @app.route('/api/wait', methods=['POST'])
@@ -1051,15 +2130,11 @@ def api_wait():
     if not token or not aid:
         return {"error": "token e aid são obrigatórios"}, 400
 
-    # validar token
-    with get_db_conn() as conn, conn.cursor() as cur:
-        cur.execute("SELECT user_id FROM api_tokens WHERE token=%s", (token,))
-        row = cur.fetchone()
-
-    if not row:
+    # validar token (cache em memória)
+    user_id = autenticar_token(token)
+    if not user_id:
         return {"error": "token inválido"}, 401
-
-    user_id = str(row['user_id'])
+    user_id = str(user_id)
 
     info = status_map.get(aid)
     
@@ -1069,8 +2144,6 @@ def api_wait():
     if str(info['user_id']) != user_id:
         return {"error": "este número não pertence ao usuário"}, 403
 
-    provider = info['provider']
-
     # 1. Se já tem SMS, retorna imediatamente
     if info.get("codes"):
         return {
@@ -1078,38 +2151,25 @@ def api_wait():
             "sms": info["codes"]
         }
 
-    # 2. Loop de long polling
-    end_time = time.time() + timeout
-
-    while time.time() < end_time:
-        status_resp = obter_status(aid, provider)
-
-        # CANCELADO
-        if status_resp == "STATUS_CANCEL":
-            return {
-                "status": "canceled",
-                "sms": info.get("codes", [])
-            }
-
-        # RECEBEU SMS
-        if status_resp and ":" in status_resp:
-            raw = status_resp.split(":", 1)[1]
-            if info.get("service_key") == "outros":
-                payloads = [raw.strip()]
-            else:
-                payloads = [n for n in re.findall(r"\d+", raw) if len(n) >= 4]
-
-            for p in payloads:
-                if p not in info["codes"]:
-                    info["codes"].append(p)
-                    registrar_sms_recebido(aid)
+    # 2. Espera sem polling: acordado pelo webhook, pelo poller do agendador
+    #    ou por cancelamento/expiração (ver adicionar_codigos/finalizar_ativacao)
+    notificador.esperar(
+        aid,
+        lambda: bool(info.get("codes")) or info.get("estado") in ESTADOS_FINAIS,
+        min(max(timeout, 0), API_WAIT_MAX_SEC)
+    )
 
-            return {
-                "status": "received",
-                "sms": payloads
-            }
+    if info.get("codes"):
+        return {
+            "status": "received",
+            "sms": info["codes"]
+        }
 
-        time.sleep(3)
+    if info.get("estado") in ESTADOS_FINAIS:
+        return {
+            "status": "canceled",
+            "sms": info.get("codes", [])
+        }
 
     # 3. Timeout atingido → retorna que está aguardando
     return {
@@ -1117,6 +2177,70 @@ def api_wait():
         "sms": info.get("codes", []),
         "timeout": True
     }
+def _sse(evento, dados):
+    return f"event: {evento}\ndata: {json.dumps(dados, ensure_ascii=False)}\n\n"
+
+@app.route('/api/stream', methods=['GET', 'POST'])
+def api_stream():
+    """
+    Server-Sent Events: um cliente acompanha vários AIDs (ou todos os do
+    token, sem "aids") numa conexão só, sem polling.
+    """
+    data = request.get_json(silent=True) or {}
+    token = data.get("token") or request.args.get("token")
+    aids = data.get("aids") or [a for a in (request.args.get("aids") or "").split(",") if a]
+
+    if not token:
+        return {"error": "token é obrigatório"}, 400
+    user_id = autenticar_token(token)
+    if not user_id:
+        return {"error": "token inválido"}, 401
+    user_id = str(user_id)
+    aids = list(dict.fromkeys(str(a) for a in aids))[:API_BATCH_MAX * 10]
+
+    invalidos = {}
+    for aid in aids:
+        _, err = _ativacao_do_usuario(aid, user_id)
+        if err:
+            invalidos[aid] = err
+    validos = [a for a in aids if a not in invalidos]
+    if aids and not validos:
+        return {"error": "nenhum aid válido", "results": invalidos}, 404
+
+    # assina ANTES da foto do estado atual: nada se perde entre as duas
+    assinatura = barramento.assinar(user_id, validos or None)
+
+    def gerar():
+        try:
+            yield "retry: 3000\n\n"
+            for aid, err in invalidos.items():
+                yield _sse("error", dict(err, aid=aid))
+            if validos:
+                atuais = [(aid, status_map.get(aid)) for aid in validos]
+            else:
+                atuais = [(aid, info) for aid, info in list(status_map.items())
+                          if str(info.get('user_id')) == user_id]
+            for aid, info in atuais:
+                if not info:
+                    continue
+                if info.get("codes"):
+                    yield _sse("sms", {"aid": aid, "sms": list(info["codes"]), "codes": list(info["codes"])})
+                if info.get("estado") in ESTADOS_FINAIS:
+                    yield _sse("status", {"aid": aid, "status": ESTADO_API[info["estado"]]})
+            fim = time.time() + API_STREAM_MAX_SEC
+            while time.time() < fim and not assinatura.estourou:
+                try:
+                    evento, dados = assinatura.fila.get(timeout=15)
+                except queue.Empty:
+                    yield ": keepalive\n\n"
+                    continue
+                yield _sse(evento, dados)
+        finally:
+            barramento.cancelar(assinatura)
+
+    return Response(stream_with_context(gerar()), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
 def api_last_code(info):
     codes = info.get("codes") or []
     if not codes:
@@ -1149,7 +2273,8 @@ def public_api_docs():
     <hr>
 
     <h3>🔑 Autenticação</h3>
-    <p>O usuário precisa gerar um token no bot Telegram enviando <b>/token</b>.</p>
+    <p>O usuário precisa gerar um token no bot Telegram enviando <b>/token</b>.
+    Para revogar o token atual e gerar outro, envie <b>/token novo</b>.</p>
 
 <pre>{
     "token": "TOKEN_DO_USUARIO"
@@ -1187,6 +2312,31 @@ def public_api_docs():
 
 <hr>
 
+<h3>📦📦 /api/buy_batch — Comprar vários números</h3>
+<p><b>POST</b> <code>{{site}}/api/buy_batch</code> — até {{batch_max}} números por chamada.</p>
+<pre>{
+  "token": "TOKEN_DO_USUARIO",
+  "service": "mercado",
+  "quantity": 20
+}</pre>
+
+<p>O saldo de todo o lote é reservado de uma vez; o valor dos itens que não
+conseguiram número é devolvido na mesma resposta.</p>
+
+<pre>{
+  "status": "success",
+  "requested": 20,
+  "delivered": 18,
+  "refunded": 1.50,
+  "saldo_restante": 36.50,
+  "items": [
+    {"status": "success", "aid": "123456", "number": "5511999999999", "short": "11999999999", "price": 0.75, "provider": "servidor 1"},
+    {"status": "error", "error": "sem números disponíveis"}
+  ]
+}</pre>
+
+<hr>
+
 <h3>📮 /api/status — Verificar status do SMS</h3>
 <pre>{
   "token": "TOKEN_DO_USUARIO",
@@ -1246,6 +2396,78 @@ Resposta em caso de sucesso:
 
 <hr>
 
+<h3>📚 /api/status_batch, /api/cancel_batch, /api/retry_batch — Vários AIDs</h3>
+<p>Mesmas regras das versões unitárias, para até {{batch_max}} AIDs por chamada.
+O status de quem já recebeu SMS sai direto da memória; os cancelamentos são
+estornados numa única operação.</p>
+<pre>{
+  "token": "TOKEN_DO_USUARIO",
+  "aids": ["123456", "123457"]
+}</pre>
+
+Resposta (um resultado por AID; o cancel_batch inclui também <code>"saldo"</code>):
+<pre>{
+  "results": {
+    "123456": {"status": "received", "sms": ["654321"]},
+    "123457": {"status": "waiting", "sms": []}
+  }
+}</pre>
+
+<hr>
+
+<h3>📡 /api/stream — Receber SMS em tempo real (SSE)</h3>
+<p><b>GET</b> <code>{{site}}/api/stream?token=TOKEN&amp;aids=123456,123457</code></p>
+<p>Uma conexão só acompanha vários números. Sem <code>aids</code>, recebe os
+eventos de todos os números do token, inclusive os comprados depois. Ao
+conectar chega o estado atual; depois, cada evento assim que acontece.</p>
+<pre>
+event: number
+data: {"aid": "123458", "number": "5511999999999", "service": "mercado"}
+
+event: sms
+data: {"aid": "123456", "sms": ["654321"], "codes": ["654321"]}
+
+event: status
+data: {"aid": "123457", "status": "canceled"}
+
+event: refunded
+data: {"aid": "123457", "amount": 0.75, "saldo": 12.50}
+</pre>
+<p>A conexão é encerrada após {{stream_max}} segundos; o cliente reconecta normalmente.</p>
+
+<h4>Python</h4>
+<pre>
+import requests, json
+with requests.get("{{site}}/api/stream", params={"token": "TOKEN"}, stream=True) as r:
+    for linha in r.iter_lines(decode_unicode=True):
+        if linha.startswith("data: "):
+            print(json.loads(linha[6:]))
+</pre>
+
+<hr>
+
+<h3>🔔 /api/webhook — Receber eventos por POST</h3>
+<p>Registre uma URL; a cada SMS, cancelamento/expiração ou estorno enviamos um POST JSON.</p>
+<pre>{
+  "token": "TOKEN_DO_USUARIO",
+  "url": "https://seu-servidor.com/sms"
+}</pre>
+<p>A resposta traz o <code>secret</code> usado para assinar os envios
+(<code>X-Webhook-Signature: sha256=HMAC_SHA256(secret, corpo)</code>). Envie
+<code>"url": ""</code> para remover. Responda 2xx; caso contrário reenviamos
+com intervalo crescente por até {{webhook_tentativas}} tentativas. A URL precisa
+apontar para um endereço público (IPs internos/privados são recusados) e
+redirecionamentos não são seguidos.</p>
+<pre>{
+  "event": "sms",
+  "aid": "123456",
+  "data": {"aid": "123456", "sms": ["654321"], "codes": ["654321"]},
+  "ts": "2025-01-01T12:00:00"
+}</pre>
+<p>Eventos: <code>sms</code>, <code>status</code> (<code>canceled</code>/<code>expired</code>) e <code>refunded</code> (<code>amount</code>, <code>saldo</code>).</p>
+
+<hr>
+
 <h3>⌛ /api/wait — Esperar SMS (long-polling)</h3>
 <pre>{
   "token": "TOKEN_DO_USUARIO",
@@ -1259,6 +2481,12 @@ Se recebeu:
   "sms": ["123456"]
 }</pre>
 
+Cancelado / expirado:
+<pre>{
+  "status": "canceled",
+  "sms": []
+}</pre>
+
 Timeout:
 <pre>{
   "status": "waiting",
@@ -1266,6 +2494,8 @@ Timeout:
   "timeout": true
 }</pre>
 
+<p>O <code>timeout</code> máximo é {{wait_max}} segundos. A resposta chega assim que o SMS é recebido.</p>
+
 <hr>
 
 <h3>💰 /api/balance — Consultar saldo</h3>
@@ -1315,82 +2545,608 @@ print(r.json())
     site=SITE_URL,
     now=datetime.now().strftime("%d/%m/%Y %H:%M"),
     service_names=SERVICE_NAMES,
-    prices=SERVICE_PRICES
+    prices=SERVICE_PRICES,
+    wait_max=API_WAIT_MAX_SEC,
+    batch_max=API_BATCH_MAX,
+    stream_max=API_STREAM_MAX_SEC,
+    webhook_tentativas=WEBHOOK_MAX_TENTATIVAS
     )
 
 # =========================================================
 # ============= SALDO / NÚMEROS (mantido) =================
 # =========================================================
-def comprar_numero_atomico(uid, aid, price):
-    with get_db_conn() as conn:
-        with conn.cursor() as cur:
-            cur.execute("SELECT saldo, numeros FROM usuarios WHERE id=%s FOR UPDATE", (str(uid),))
-            user = cur.fetchone()
-            if not user:
-                return False
-            saldo = user['saldo']
-            numeros = json.loads(user['numeros'])
-            if saldo < price:
-                return False
-            if aid in numeros:
-                return False
-            saldo -= price
-            numeros.append(aid)
-            cur.execute("""
-                UPDATE usuarios SET saldo=%s, numeros=%s WHERE id=%s
-            """, (saldo, json.dumps(numeros), str(uid)))
+# O rollup é contado em memória por worker e gravado em lote fora das
+# transações de compra/estorno/SMS, que assim não disputam a linha do dia
+# do serviço. Se o processo morrer sem o flush, perde-se só a contagem
+# (nunca saldo) dos últimos ESTATISTICA_FLUSH_SEC.
+ESTATISTICA_FLUSH_SEC = float(os.getenv("ESTATISTICA_FLUSH_SEC", "5"))
+_CAMPOS_ESTATISTICA = ('vendidos', 'cancelados', 'recebidos')
+_estat_lock = threading.Lock()
+_estat_pendente = collections.defaultdict(lambda: [0, 0, 0])   # (dia, service_key) -> contagens
+
+def contar_estatistica(campo, service_key, dia=None, n=1):
+    """Soma n no rollup (em memória; chamar depois do COMMIT)."""
+    i = _CAMPOS_ESTATISTICA.index(campo)
+    chave = (dia or datetime.now().date(), service_key or 'desconhecido')
+    with _estat_lock:
+        _estat_pendente[chave][i] += n
+
+def flush_estatisticas():
+    """Grava as contagens pendentes; se falhar, elas voltam para a próxima."""
+    global _estat_pendente
+    with _estat_lock:
+        lote, _estat_pendente = _estat_pendente, collections.defaultdict(lambda: [0, 0, 0])
+    if not lote:
+        return 0
+    chaves = list(lote)
+    try:
+        with get_db_conn() as conn, conn.cursor() as cur:
             cur.execute("""
-                INSERT INTO numeros_sms (aid, user_id, price, cancelado, sms_recebido)
-                VALUES (%s, %s, %s, FALSE, FALSE)
-                ON CONFLICT (aid) DO NOTHING
-            """, (aid, str(uid), price))
-            conn.commit()
-    exportar_backup_json()
-    logger.info(f"Saldo de {uid} atualizado. Nº {aid} associado.")
-    # >>> LOG ADMIN: compra com saldo novo
-    log_admin(f"🧾 *COMPRA*\nUser: `{uid}`\nAID: `{aid}`\nPreço: R$ {price:.2f}\nNovo saldo: R$ {saldo:.2f}")
-    return True
-
-def marcar_cancelado_e_devolver(uid, aid):
-    novo_saldo = None
-    with get_db_conn() as conn:
-        with conn.cursor() as cur:
-            cur.execute("SELECT cancelado, price FROM numeros_sms WHERE aid=%s FOR UPDATE", (aid,))
-            row = cur.fetchone()
-            if not row or row['cancelado']:
-                return False
-            price = row['price']
-            cur.execute("UPDATE numeros_sms SET cancelado=TRUE WHERE aid=%s", (aid,))
-            cur.execute("UPDATE usuarios SET saldo=saldo+%s WHERE id=%s", (price, str(uid)))
-            # pegar saldo atualizado
-            cur.execute("SELECT saldo FROM usuarios WHERE id=%s", (str(uid),))
-            res = cur.fetchone()
-            if res:
-                novo_saldo = float(res['saldo'])
+                INSERT INTO estatisticas (dia, service_key, vendidos, cancelados, recebidos)
+                SELECT * FROM unnest(%s::date[], %s::text[], %s::int[], %s::int[], %s::int[])
+                ON CONFLICT (dia, service_key) DO UPDATE
+                SET vendidos = estatisticas.vendidos + EXCLUDED.vendidos,
+                    cancelados = estatisticas.cancelados + EXCLUDED.cancelados,
+                    recebidos = estatisticas.recebidos + EXCLUDED.recebidos
+            """, ([k[0] for k in chaves], [k[1] for k in chaves],
+                  [lote[k][0] for k in chaves], [lote[k][1] for k in chaves], [lote[k][2] for k in chaves]))
             conn.commit()
-    exportar_backup_json()
-    # >>> LOG ADMIN: cancelamento/reembolso com saldo novo
-    if novo_saldo is not None:
-        log_admin(f"↩️ *CANCELAMENTO / REEMBOLSO*\nUser: `{uid}`\nAID: `{aid}`\nValor devolvido: R$ {price:.2f}\nNovo saldo: R$ {novo_saldo:.2f}")
-    return True
+    except Exception:
+        with _estat_lock:
+            for k, v in lote.items():
+                p = _estat_pendente[k]
+                for i in range(3):
+                    p[i] += v[i]
+        raise
+    return len(chaves)
+
+def _flusher_estatisticas():
+    while True:
+        time.sleep(ESTATISTICA_FLUSH_SEC)
+        try:
+            flush_estatisticas()
+        except Exception as e:
+            logger.error(f"[ESTATISTICAS] erro ao gravar rollup: {e}")
 
-def registrar_sms_recebido(aid):
-    with get_db_conn() as conn:
-        with conn.cursor() as cur:
-            cur.execute("UPDATE numeros_sms SET sms_recebido=TRUE WHERE aid=%s", (aid,))
-            conn.commit()
+threading.Thread(target=_flusher_estatisticas, name="estatisticas-flush", daemon=True).start()
+
+def _flush_estatisticas_saida():
+    try:
+        flush_estatisticas()
+    except Exception as e:
+        logger.error(f"[ESTATISTICAS] rollup pendente perdido no desligamento: {e}")
+
+atexit.register(_flush_estatisticas_saida)
+
+def resumo_estatisticas(dias=7):
+    try:
+        flush_estatisticas()   # o que este worker contou aparece já
+    except Exception as e:
+        logger.error(f"[ESTATISTICAS] erro ao gravar rollup: {e}")
+    with get_db_conn() as conn, conn.cursor() as cur:
+        cur.execute("""
+            SELECT COALESCE(sum(vendidos), 0) AS total,
+                   COALESCE(sum(cancelados), 0) AS cancelados,
+                   COALESCE(sum(recebidos), 0) AS recebidos
+            FROM estatisticas
+        """)
+        totais = cur.fetchone()
+        cur.execute("""
+            SELECT service_key, sum(vendidos) AS vendidos,
+                   sum(cancelados) AS cancelados, sum(recebidos) AS recebidos
+            FROM estatisticas
+            GROUP BY service_key
+            ORDER BY sum(vendidos) DESC
+        """)
+        por_servico = cur.fetchall()
+        cur.execute("""
+            SELECT dia, sum(vendidos) AS vendidos,
+                   sum(cancelados) AS cancelados, sum(recebidos) AS recebidos
+            FROM estatisticas
+            WHERE dia > CURRENT_DATE - %s
+            GROUP BY dia
+            ORDER BY dia DESC
+        """, (dias,))
+        por_dia = cur.fetchall()
+    return totais, por_servico, por_dia
+
+# ---------- livro-razão de saldo ----------
+# compactação frequente: a soma dos lançamentos pendentes lida em cada compra fica curta
+SALDO_COMPACTAR_SEC = float(os.getenv("SALDO_COMPACTAR_SEC", "10"))
+SALDO_COMPACTAR_MIN = int(os.getenv("SALDO_COMPACTAR_MIN", "20"))   # lançamentos pendentes p/ compactar
+
+def centavos(valor):
+    return int(round(float(valor) * 100))
+
+def lancar_saldo(cur, uid, valor, tipo, ref=None):
+    """Acrescenta um lançamento (R$, positivo = crédito) na transação do chamador."""
+    cur.execute("""
+        INSERT INTO saldo_lancamentos (user_id, valor_centavos, tipo, ref)
+        VALUES (%s, %s, %s, %s)
+    """, (str(uid), centavos(valor), tipo, None if ref is None else str(ref)))
+
+def saldo_atual(uid, cur=None):
+    if cur is None:
+        with get_db_conn() as conn, conn.cursor() as c:
+            return saldo_atual(uid, c)
+    cur.execute(f"SELECT {SALDO_CENTAVOS_SQL} AS centavos", (str(uid), str(uid)))
+    return cur.fetchone()['centavos'] / 100
+
+def creditar_saldo(uid, valor, tipo, ref=None):
+    """Crédito avulso (recarga, bônus, admin); retorna o saldo novo."""
+    with get_db_conn() as conn, conn.cursor() as cur:
+        lancar_saldo(cur, uid, valor, tipo, ref)
+        saldo = saldo_atual(uid, cur)
+        conn.commit()
+    agendar_backup()
+    return saldo
+
+def reservar_saldo(uid, valor, tipo='compra', ref=None):
+    """
+    Reserva otimista, sem FOR UPDATE na linha do usuário: grava o débito,
+    confirma e só então confere o saldo (que já enxerga todos os débitos
+    concorrentes confirmados). Se ficou negativo, grava o estorno e recusa.
+    Retorna o saldo restante ou None.
+    """
+    with get_db_conn() as conn, conn.cursor() as cur:
+        lancar_saldo(cur, uid, -valor, tipo, ref)
+        conn.commit()
+        saldo = saldo_atual(uid, cur)
+        if saldo < 0:
+            lancar_saldo(cur, uid, valor, 'estorno_reserva', ref)
+            conn.commit()
+            return None
+    return saldo
+
+def compactar_saldos():
+    """Soma no snapshot os lançamentos pendentes de quem acumulou muitos."""
+    with get_db_conn() as conn, conn.cursor() as cur:
+        cur.execute("""
+            SELECT user_id FROM saldo_lancamentos
+            WHERE NOT compactado
+            GROUP BY user_id HAVING count(*) >= %s
+            LIMIT 1000
+        """, (SALDO_COMPACTAR_MIN,))
+        uids = [r['user_id'] for r in cur.fetchall()]
+    for uid in uids:
+        with get_db_conn() as conn, conn.cursor() as cur:
+            # uma transação: o leitor vê o lançamento pendente OU já no snapshot, nunca os dois
+            cur.execute("""
+                WITH c AS (
+                    UPDATE saldo_lancamentos SET compactado=TRUE
+                    WHERE user_id=%s AND NOT compactado
+                    RETURNING valor_centavos
+                )
+                INSERT INTO saldo_snapshot (user_id, centavos, atualizado_em)
+                SELECT %s, COALESCE(sum(valor_centavos), 0), NOW() FROM c
+                ON CONFLICT (user_id) DO UPDATE
+                SET centavos = saldo_snapshot.centavos + EXCLUDED.centavos, atualizado_em = NOW()
+            """, (uid, uid))
+            conn.commit()
+    return len(uids)
+
+def _compactador_saldos():
+    while True:
+        time.sleep(SALDO_COMPACTAR_SEC)
+        try:
+            n = compactar_saldos()
+            if n:
+                logger.info(f"[SALDO] {n} contas compactadas")
+        except Exception as e:
+            logger.error(f"[SALDO] erro na compactação: {e}")
+
+threading.Thread(target=_compactador_saldos, name="saldo-compactador", daemon=True).start()
+
+def comprar_numero_atomico(uid, aid, price, service_key=None):
+    """
+    Compra otimista, como reservar_saldo: débito + número numa transação (um
+    erro desfaz os dois), COMMIT e só então confere o saldo. Se ficou
+    negativo, outra transação apaga o número e estorna. Duas compras
+    simultâneas que juntas estouram o saldo podem ser ambas recusadas, e
+    um leitor pode ver por um instante o saldo negativo.
+    """
+    with get_db_conn() as conn:
+        with conn.cursor() as cur:
+            lancar_saldo(cur, uid, -price, 'compra', aid)
+            # duplicidade resolvida pela PK de numeros_sms (O(1), sem reescrever lista)
+            cur.execute("""
+                INSERT INTO numeros_sms (aid, user_id, price, cancelado, sms_recebido, service_key)
+                VALUES (%s, %s, %s, FALSE, FALSE, %s)
+                ON CONFLICT (aid) DO NOTHING
+                RETURNING aid
+            """, (aid, str(uid), price, service_key))
+            if not cur.fetchone():
+                conn.rollback()
+                return False
+            conn.commit()
+            saldo = saldo_atual(uid, cur)
+            if saldo < 0:
+                cur.execute("DELETE FROM numeros_sms WHERE aid=%s AND user_id=%s", (aid, str(uid)))
+                lancar_saldo(cur, uid, price, 'estorno_reserva', aid)
+                conn.commit()
+                return False
+    contar_estatistica('vendidos', service_key)
+    agendar_backup()
+    logger.info(f"Saldo de {uid} atualizado. Nº {aid} associado.")
+    # >>> LOG ADMIN: compra com saldo novo
+    log_admin(f"🧾 *COMPRA*\nUser: `{uid}`\nAID: `{aid}`\nPreço: R$ {price:.2f}\nNovo saldo: R$ {saldo:.2f}")
+    return True
+
+# >>> NOVO: compra em lote — reserva N×preço numa transação, registra os
+# números obtidos e devolve o que sobrou em outra, sem N FOR UPDATEs
+def confirmar_lote(uid, price, service_key, aids, reservados):
+    """
+    Associa os AIDs obtidos ao usuário e estorna (reservados - associados) × preço,
+    tudo na mesma transação. Retorna (aids associados, {aid: dono} dos que
+    já estavam registrados, saldo final). Só levanta se nada foi gravado
+    (pode repetir).
+    """
+    associados, donos = [], {}
+    with get_db_conn() as conn, conn.cursor() as cur:
+        if aids:
+            cur.execute("""
+                INSERT INTO numeros_sms (aid, user_id, price, cancelado, sms_recebido, service_key)
+                SELECT a, %s, %s, FALSE, FALSE, %s FROM unnest(%s::text[]) AS a
+                ON CONFLICT (aid) DO NOTHING
+                RETURNING aid
+            """, (str(uid), price, service_key, list(aids)))
+            associados = [r['aid'] for r in cur.fetchall()]
+            resto = list(set(aids) - set(associados))
+            if resto:
+                cur.execute("SELECT aid, user_id FROM numeros_sms WHERE aid = ANY(%s)", (resto,))
+                donos = {r['aid']: r['user_id'] for r in cur.fetchall()}
+        estorno = round((reservados - len(associados)) * price, 2)
+        if estorno > 0:
+            lancar_saldo(cur, uid, estorno, 'estorno_lote')
+        saldo = saldo_atual(uid, cur)
+        conn.commit()
+    # depois do COMMIT nada pode levantar: o chamador repetiria e estornaria em dobro
+    try:
+        if associados:
+            contar_estatistica('vendidos', service_key, n=len(associados))
+        agendar_backup()
+        log_admin(f"🧾 *COMPRA EM LOTE*\nUser: `{uid}`\nServiço: {service_key}\n"
+                  f"Pedidos: {reservados} | Entregues: {len(associados)}\n"
+                  f"Preço: R$ {price:.2f}\nNovo saldo: R$ {saldo:.2f}")
+    except Exception as e:
+        logger.error(f"[API] buy_batch pós-commit: {e}")
+    return associados, donos, saldo
+
+def desfazer_lote(uid, price, reservados, obtidos):
+    """
+    confirmar_lote falhou de vez: cancela no provider o que foi obtido e
+    estorna a reserva inteira. Se nem o estorno gravar, avisa o admin com
+    os dados para acerto manual.
+    """
+    # só cancela AID sem dono; sem conseguir checar, não cancela nenhum
+    # (o provider devolve sozinho o número não usado)
+    try:
+        with get_db_conn() as conn, conn.cursor() as cur:
+            cur.execute("SELECT aid FROM numeros_sms WHERE aid = ANY(%s)", (list(obtidos),))
+            com_dono = {r['aid'] for r in cur.fetchall()}
+    except Exception as e:
+        logger.error(f"[API] buy_batch sem checar donos dos AIDs, nada cancelado: {e}")
+        com_dono = set(obtidos)
+    for aid, (_, provider, _) in obtidos.items():
+        if aid in com_dono:
+            continue
+        try:
+            cancelar_numero(aid, provider)
+        except Exception as e:
+            logger.error(f"[API] buy_batch erro ao cancelar {aid}: {e}")
+    total = round(reservados * price, 2)
+    try:
+        return creditar_saldo(uid, total, 'estorno_lote')
+    except Exception as e:
+        log_admin(f"🚨 *LOTE SEM ESTORNO*\nUser: `{uid}`\nValor: R$ {total:.2f}\n"
+                  f"AIDs obtidos: {', '.join(obtidos) or '-'}\nErro: {e}")
+        return None
+
+def cancelar_lote_e_devolver(uid, aids):
+    """
+    Versão em lote de marcar_cancelado_e_devolver: marca e estorna todos numa
+    transação. Retorna (aids estornados, saldo final).
+    """
+    with get_db_conn() as conn, conn.cursor() as cur:
+        cur.execute("""
+            UPDATE numeros_sms SET cancelado=TRUE
+            WHERE aid = ANY(%s) AND user_id=%s AND NOT cancelado AND price IS NOT NULL
+            RETURNING aid, price, service_key, data_criacao::date AS dia
+        """, (list(aids), str(uid)))
+        rows = cur.fetchall()
+        total = round(sum(r['price'] for r in rows), 2)
+        for r in rows:
+            lancar_saldo(cur, uid, r['price'], 'estorno', r['aid'])
+        saldo = saldo_atual(uid, cur)
+        conn.commit()
+    for r in rows:
+        contar_estatistica('cancelados', r['service_key'], r['dia'])
+    for r in rows:
+        barramento.publicar(r['aid'], uid, 'refunded', {"aid": r['aid'], "amount": r['price'], "saldo": saldo})
+    if rows:
+        agendar_backup()
+        log_admin(f"↩️ *CANCELAMENTO EM LOTE*\nUser: `{uid}`\nNúmeros: {len(rows)}\n"
+                  f"Valor devolvido: R$ {total:.2f}\nNovo saldo: R$ {saldo:.2f}")
+    return [r['aid'] for r in rows], saldo
+
+def marcar_cancelado_e_devolver(uid, aid):
+    novo_saldo = None
+    with get_db_conn() as conn:
+        with conn.cursor() as cur:
+            cur.execute("""
+                SELECT cancelado, price, service_key, data_criacao::date AS dia
+                FROM numeros_sms WHERE aid=%s FOR UPDATE
+            """, (aid,))
+            row = cur.fetchone()
+            if not row or row['cancelado']:
+                return False
+            price = row['price']
+            if price is None:
+                # AID legado migrado do JSON, sem preço conhecido
+                return False
+            cur.execute("UPDATE numeros_sms SET cancelado=TRUE WHERE aid=%s", (aid,))
+            lancar_saldo(cur, uid, price, 'estorno', aid)
+            novo_saldo = saldo_atual(uid, cur)
+            conn.commit()
+    contar_estatistica('cancelados', row['service_key'], row['dia'])
+    agendar_backup()
+    barramento.publicar(aid, uid, 'refunded', {"aid": aid, "amount": price, "saldo": novo_saldo})
+    # >>> LOG ADMIN: cancelamento/reembolso com saldo novo
+    if novo_saldo is not None:
+        log_admin(f"↩️ *CANCELAMENTO / REEMBOLSO*\nUser: `{uid}`\nAID: `{aid}`\nValor devolvido: R$ {price:.2f}\nNovo saldo: R$ {novo_saldo:.2f}")
+    return True
+
+def registrar_sms_recebido(aid):
+    with get_db_conn() as conn:
+        with conn.cursor() as cur:
+            # só a primeira marcação conta no rollup
+            cur.execute("""
+                UPDATE numeros_sms SET sms_recebido=TRUE
+                WHERE aid=%s AND sms_recebido=FALSE
+                RETURNING service_key, data_criacao::date AS dia
+            """, (aid,))
+            row = cur.fetchone()
+            conn.commit()
+    if row:
+        contar_estatistica('recebidos', row['service_key'], row['dia'])
 
 # =========================================================
-# ================== SMSBOWER (mantido) ===================
+# ============== ENVIO TELEGRAM (mantido) =================
 # =========================================================
-def enviar_mensagem_bot(bot_instance, chat_id, texto, tentativas=3):
-    for _ in range(tentativas):
+# Fila de saída com token bucket global (por bot) e por chat, prioridades
+# e coalescência de edições: de uma mesma mensagem só a última edição
+# pendente é enviada. 429 respeita o retry_after sem dormir no chamador.
+# Cada worker tira da fila só quando está livre, então o que não foi enviado
+# continua no heap (prioridade e coalescência valem até o último momento).
+TG_GLOBAL_RATE    = float(os.getenv("TG_GLOBAL_RATE", "25"))   # msgs/s por bot (Telegram ~30)
+TG_CHAT_RATE      = float(os.getenv("TG_CHAT_RATE", "1"))      # msgs/s por chat
+TG_SEND_WORKERS   = int(os.getenv("TG_SEND_WORKERS", "4"))
+TG_RESULT_TIMEOUT = float(os.getenv("TG_RESULT_TIMEOUT", "30"))
+
+# prioridades (menor sai primeiro)
+PRIO_SMS, PRIO_COMPRA, PRIO_COUNTDOWN, PRIO_BROADCAST = range(4)
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.ts = time.monotonic()
+
+    def espera(self, agora):
+        """Segundos até haver 1 token (0 = pode enviar já)."""
+        self.tokens = min(self.burst, self.tokens + (agora - self.ts) * self.rate)
+        self.ts = agora
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def consumir(self):
+        self.tokens -= 1
+
+class _EnvioTelegram:
+    __slots__ = ("bot", "metodo", "chat_id", "args", "kwargs", "prioridade",
+                 "chave", "tentativas", "futuro", "criado")
+
+    def __init__(self, bot_inst, metodo, chat_id, args, kwargs, prioridade, chave, tentativas):
+        self.bot = bot_inst
+        self.metodo = metodo
+        self.chat_id = chat_id
+        self.args = args
+        self.kwargs = kwargs
+        self.prioridade = prioridade
+        self.chave = chave
+        self.tentativas = tentativas
+        self.futuro = Future()
+        self.criado = time.monotonic()
+
+class DespachanteTelegram:
+    def __init__(self, workers):
+        self._cond = threading.Condition()
+        self._heap = []
+        self._seq = itertools.count()
+        self._coalesce = {}        # chave -> item pendente
+        self._globais = {}         # id(bot) -> TokenBucket
+        self._chats = {}           # (id(bot), chat_id) -> TokenBucket
+        self._bloqueado_ate = {}   # (id(bot), chat_id) -> monotonic (429)
+        self._por_bot = collections.Counter()   # id(bot) -> itens no heap
+        self._workers = workers
+        self._threads = []
+        self.stats = {"enfileirados": 0, "enviados": 0, "coalescidos": 0, "falhas": 0, "retry_429": 0}
+
+    def _garantir_thread(self):
+        if len(self._threads) == self._workers and all(t.is_alive() for t in self._threads):
+            return
+        with self._cond:
+            self._threads = [t for t in self._threads if t.is_alive()]
+            while len(self._threads) < self._workers:
+                t = threading.Thread(target=self._loop, name=f"tg-envio-{len(self._threads)}", daemon=True)
+                t.start()
+                self._threads.append(t)
+
+    def _contar(self, campo):
+        with self._cond:
+            self.stats[campo] += 1
+
+    def pendentes(self):
+        with self._cond:
+            return len(self._heap)
+
+    def enviar(self, bot_inst, metodo, chat_id, *args, prioridade=PRIO_COMPRA, coalescer=None, tentativas=1, **kwargs):
+        """
+        Enfileira bot_inst.<metodo>(*args, **kwargs) e devolve um Future com o
+        resultado. Com 'coalescer', um envio ainda pendente com a mesma chave
+        é substituído (fica valendo o conteúdo mais novo, mesmo Future).
+        """
+        chave = (id(bot_inst), coalescer) if coalescer is not None else None
+        with self._cond:
+            if chave is not None:
+                antigo = self._coalesce.get(chave)
+                if antigo is not None:
+                    antigo.args, antigo.kwargs = args, kwargs
+                    if prioridade < antigo.prioridade:
+                        antigo.prioridade = prioridade
+                        heapq.heappush(self._heap, (prioridade, next(self._seq), antigo))
+                    self.stats["coalescidos"] += 1
+                    return antigo.futuro
+            item = _EnvioTelegram(bot_inst, metodo, chat_id, args, kwargs, prioridade, chave, tentativas)
+            if chave is not None:
+                self._coalesce[chave] = item
+            heapq.heappush(self._heap, (prioridade, next(self._seq), item))
+            self._por_bot[id(bot_inst)] += 1
+            self.stats["enfileirados"] += 1
+            self._cond.notify()
+        self._garantir_thread()
+        return item.futuro
+
+    def _proximo(self):
+        """
+        Item de maior prioridade cujo chat e bot têm token; senão (None, espera).
+        Se nenhum bot com itens pendentes tem token global, nem mexe no heap.
+        """
+        agora = time.monotonic()
+        if not self._heap:
+            return None, None
+        livres = set()
+        menor_espera = None
+        for kb, n in list(self._por_bot.items()):
+            if n <= 0:
+                del self._por_bot[kb]
+                continue
+            g = self._globais.setdefault(kb, TokenBucket(TG_GLOBAL_RATE, TG_GLOBAL_RATE))
+            e = g.espera(agora)
+            if e <= 0:
+                livres.add(kb)
+            else:
+                menor_espera = e if menor_espera is None else min(menor_espera, e)
+        if not livres:
+            return None, menor_espera
+        adiados = []
+        escolhido = None
+        while self._heap:
+            prio, seq, it = heapq.heappop(self._heap)
+            if it.prioridade != prio:
+                continue   # entrada duplicada por troca de prioridade
+            kb = id(it.bot)
+            if it.futuro.done():
+                self._por_bot[kb] -= 1
+                continue
+            if kb not in livres:
+                adiados.append((prio, seq, it))
+                continue
+            c = self._chats.setdefault((kb, it.chat_id), TokenBucket(TG_CHAT_RATE, 1))
+            e = max(c.espera(agora), self._bloqueado_ate.get((kb, it.chat_id), 0) - agora)
+            if e <= 0:
+                self._globais[kb].consumir()
+                c.consumir()
+                self._por_bot[kb] -= 1
+                escolhido = it
+                break
+            adiados.append((prio, seq, it))
+            menor_espera = e if menor_espera is None else min(menor_espera, e)
+        for entrada in adiados:
+            heapq.heappush(self._heap, entrada)
+        if escolhido is not None and escolhido.chave is not None:
+            if self._coalesce.get(escolhido.chave) is escolhido:
+                del self._coalesce[escolhido.chave]
+        if len(self._chats) > 10000:
+            # descarta buckets cheios (chats ociosos)
+            for k in [k for k, b in self._chats.items() if b.tokens >= b.burst]:
+                del self._chats[k]
+        return escolhido, menor_espera
+
+    def _loop(self):
+        # um worker só tira item do heap quando vai enviá-lo
+        while True:
+            with self._cond:
+                item, espera = self._proximo()
+                while item is None:
+                    self._cond.wait(espera)
+                    item, espera = self._proximo()
+            try:
+                self._executar(item)
+            except Exception as e:
+                if not item.futuro.done():
+                    item.futuro.set_exception(e)
+
+    def _reenfileirar(self, it, bloqueio=None):
+        with self._cond:
+            if bloqueio:
+                self._bloqueado_ate[(id(it.bot), it.chat_id)] = time.monotonic() + bloqueio
+            if it.chave is not None:
+                novo = self._coalesce.get(it.chave)
+                if novo is not None:
+                    # já existe edição mais nova na fila: esta ficou obsoleta
+                    it.futuro.set_result(None)
+                    return
+                self._coalesce[it.chave] = it
+            heapq.heappush(self._heap, (it.prioridade, next(self._seq), it))
+            self._por_bot[id(it.bot)] += 1
+            self._cond.notify()
+
+    def _executar(self, it):
+        t0 = time.perf_counter()
         try:
-            bot_instance.send_message(chat_id, texto)
-            return True
-        except Exception:
-            time.sleep(1)
-    return False
+            res = getattr(it.bot, it.metodo)(*it.args, **it.kwargs)
+        except telebot.apihelper.ApiTelegramException as e:
+            m_tg_seg.observar(time.perf_counter() - t0, it.metodo)
+            m_tg_resultado.inc(it.metodo, str(e.error_code))
+            if e.error_code == 429:
+                retry_after = ((e.result_json or {}).get("parameters") or {}).get("retry_after", 1)
+                self._contar("retry_429")
+                self._reenfileirar(it, bloqueio=float(retry_after))
+                return
+            self._contar("falhas")
+            it.futuro.set_exception(e)
+            return
+        except Exception as e:
+            m_tg_seg.observar(time.perf_counter() - t0, it.metodo)
+            m_tg_resultado.inc(it.metodo, "erro_rede")
+            if it.tentativas > 1:
+                it.tentativas -= 1
+                self._reenfileirar(it, bloqueio=1)
+                return
+            self._contar("falhas")
+            it.futuro.set_exception(e)
+            return
+        m_tg_seg.observar(time.perf_counter() - t0, it.metodo)
+        m_tg_resultado.inc(it.metodo, "ok")
+        self._contar("enviados")
+        it.futuro.set_result(res)
+
+despachante = DespachanteTelegram(TG_SEND_WORKERS)
+
+def tg_enviar(chat_id, texto, prioridade=PRIO_COMPRA, bot_inst=None, **kwargs):
+    """send_message pela fila; devolve Future (ignore se não precisar do resultado)."""
+    return despachante.enviar(bot_inst or bot, 'send_message', chat_id, chat_id, texto,
+                              prioridade=prioridade, **kwargs)
+
+def tg_editar(chat_id, message_id, texto, prioridade=PRIO_COUNTDOWN, bot_inst=None, **kwargs):
+    """edit_message_text coalescido por (chat, mensagem)."""
+    return despachante.enviar(bot_inst or bot, 'edit_message_text', chat_id, texto, chat_id, message_id,
+                              prioridade=prioridade, coalescer=('edit', chat_id, message_id), **kwargs)
+
+def enviar_mensagem_bot(bot_instance, chat_id, texto, tentativas=3):
+    tg_enviar(chat_id, texto, bot_inst=bot_instance, tentativas=tentativas)
+    return True
 
 def enviar_documento_bot(bot_instance, chat_id, file_path, tentativas=3):
     for _ in range(tentativas):
@@ -1402,158 +3158,355 @@ def enviar_documento_bot(bot_instance, chat_id, file_path, tentativas=3):
             time.sleep(1)
     return False
 
-def solicitar_numero_smsbower(servico, max_price=None):
-    params = {
-        'api_key': API_KEY_SMSBOWER,
-        'action': 'getNumber',
-        'service': servico,
-        'country': COUNTRY_ID
-    }
-    if max_price is not None:
-        params['maxPrice'] = f"{max_price:.4f}"
-    try:
-        r = requests.get(SMSBOWER_URL, params=params, timeout=15)
-        r.raise_for_status()
-        text = r.text.strip()
-        logger.info(f"GET_NUMBER (smsbower) → {text}")
-    except Exception as e:
-        logger.error(f"Erro getNumber smsbower: {e}")
-        return {"status":"error","message":str(e)}
-    if text.startswith("ACCESS_NUMBER:"):
-        _, aid, num = text.split(":", 2)
-        return {"status":"success","id":aid,"number":num}
-    return {"status":"error","message":text}
-
-def cancelar_numero_smsbower(aid):
-    try:
-        requests.get(
-            SMSBOWER_URL,
-            params={'api_key':API_KEY_SMSBOWER, 'action':'setStatus','status':'8','id':aid},
-            timeout=10
-        )
-        logger.info(f"Cancelado provider (smsbower): {aid}")
-    except Exception as e:
-        logger.error(f"Erro cancelar smsbower: {e}")
+# =========================================================
+# ============ CLIENTES HTTP DOS PROVIDERS ================
+# =========================================================
+# Uma Session keep-alive por upstream (sem DNS + TCP + TLS a cada poll),
+# timeouts por endpoint e contadores de latência por action.
+PROVIDER_POOL_SIZE = int(os.getenv("PROVIDER_POOL_SIZE", "32"))
+# disjuntor por provider/action: após N falhas seguidas (rede, timeout, 5xx)
+# recusa na hora por alguns segundos e depois deixa passar uma sondagem
+DISJUNTOR_FALHAS     = int(os.getenv("DISJUNTOR_FALHAS", "5"))
+DISJUNTOR_ABERTO_SEC = float(os.getenv("DISJUNTOR_ABERTO_SEC", "30"))
+
+class CircuitoAberto(requests.exceptions.ConnectionError):
+    """Upstream marcado como fora; os chamadores tratam como erro de rede."""
+
+class Disjuntor:
+    def __init__(self, limite=DISJUNTOR_FALHAS, aberto_sec=DISJUNTOR_ABERTO_SEC):
+        self.limite = limite
+        self.aberto_sec = aberto_sec
+        self._lock = threading.Lock()
+        self.falhas = 0
+        self.aberto_ate = 0.0
+        self.sondando = False
+
+    @property
+    def estado(self):
+        with self._lock:
+            if self.falhas < self.limite:
+                return "fechado"
+            return "aberto" if time.time() < self.aberto_ate else "meio-aberto"
+
+    def permitir(self):
+        with self._lock:
+            if self.falhas < self.limite:
+                return True
+            if time.time() < self.aberto_ate or self.sondando:
+                return False
+            self.sondando = True   # só uma chamada de teste por vez
+            return True
 
-def obter_status_smsbower(aid):
-    try:
-        r = requests.get(
-            SMSBOWER_URL,
-            params={'api_key': API_KEY_SMSBOWER,'action':'getStatus','id':aid},
-            timeout=10
-        )
-        r.raise_for_status()
-        return r.text.strip()
-    except Exception as e:
-        logger.error(f"Erro getStatus smsbower: {e}")
+    def sucesso(self):
+        with self._lock:
+            self.falhas = 0
+            self.sondando = False
+
+    def falha(self):
+        with self._lock:
+            self.falhas += 1
+            self.sondando = False
+            if self.falhas >= self.limite:
+                self.aberto_ate = time.time() + self.aberto_sec
+
+class ProviderClient:
+    TIMEOUTS = {}
+    DEFAULT_TIMEOUT = 10
+
+    def __init__(self, nome, url, api_key=None, pool_size=PROVIDER_POOL_SIZE, timeouts=None):
+        self.nome = nome
+        self.url = url
+        self.api_key = api_key
+        self.timeouts = dict(self.TIMEOUTS, **(timeouts or {}))
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self._stats_lock = threading.Lock()
+        self.stats = {}   # action -> {"calls", "errors", "total_ms", "max_ms"}
+        self.disjuntores = {}   # action -> Disjuntor
+
+    def disjuntor(self, action):
+        d = self.disjuntores.get(action)
+        if d is None:
+            with self._stats_lock:
+                d = self.disjuntores.setdefault(action, Disjuntor())
+        return d
+
+    def _registrar(self, action, ms, ok):
+        with self._stats_lock:
+            st = self.stats.setdefault(action, {"calls": 0, "errors": 0, "total_ms": 0.0, "max_ms": 0.0})
+            st["calls"] += 1
+            st["total_ms"] += ms
+            st["max_ms"] = max(st["max_ms"], ms)
+            if not ok:
+                st["errors"] += 1
+        m_provider_seg.observar(ms / 1000, self.nome, action)
+        if not ok:
+            m_provider_erros.inc(self.nome, action)
+
+    def _get(self, action, params, url=None, timeout=None):
+        disj = self.disjuntor(action)
+        if not disj.permitir():
+            m_provider_curto.inc(self.nome, action)
+            raise CircuitoAberto(f"{self.nome}/{action}: disjuntor aberto")
+        t0 = time.perf_counter()
+        ok = False
+        upstream_ok = False
+        try:
+            r = self.session.get(url or self.url, params=params,
+                                 timeout=timeout or self.timeouts.get(action, self.DEFAULT_TIMEOUT))
+            # 4xx é resposta do upstream (vivo); só rede/timeout/5xx abrem o disjuntor
+            upstream_ok = r.status_code < 500
+            r.raise_for_status()
+            ok = True
+            return r
+        finally:
+            (disj.sucesso if upstream_ok else disj.falha)()
+            self._registrar(action, (time.perf_counter() - t0) * 1000, ok)
+
+    def chamar(self, action, timeout=None, **params):
+        """GET no handler_api com api_key/action; levanta exceção em erro HTTP/rede."""
+        q = {'api_key': self.api_key, 'action': action}
+        q.update(params)
+        return self._get(action, q, timeout=timeout)
+
+    @staticmethod
+    def _parse_access_number(text):
+        if text.startswith("ACCESS_NUMBER:"):
+            _, aid, num = text.split(":", 2)
+            return {"status": "success", "id": aid, "number": num}
         return None
 
-# ============== SMS24H (Servidor 2) ======================
-def sms24h_key_ok():
-    if not API_KEY_SMS24H:
-        logger.error("[sms24h] API_KEY_SMS24H não definido no ambiente")
-        return False
-    return True
 
-def solicitar_numero_sms24h(service_code, operator="claro", country="73"):
-    if not sms24h_key_ok():
-        return {"status":"error","message":"NO_KEY"}
-    for op in [operator, "claro"]:
+class SMSBowerClient(ProviderClient):
+    TIMEOUTS = {'getNumber': 15, 'getStatus': 10, 'setStatus': 10, 'getPricesV2': 12}
+
+    def get_number(self, servico, max_price=None, country=COUNTRY_ID):
+        params = {'service': servico, 'country': country}
+        if max_price is not None:
+            params['maxPrice'] = f"{max_price:.4f}"
         try:
-            r = requests.get(
-                SMS24H_URL,
-                params={
-                    'api_key': API_KEY_SMS24H,
-                    'action': 'getNumber',
-                    'service': service_code,
-                    'operator': op,
-                    'country': country
-                },
-                timeout=15
-            )
-            r.raise_for_status()
-            text = r.text.strip()
+            text = self.chamar('getNumber', **params).text.strip()
+            logger.info(f"GET_NUMBER (smsbower) → {text}")
+        except Exception as e:
+            logger.error(f"Erro getNumber smsbower: {e}")
+            return {"status": "error", "message": str(e)}
+        return self._parse_access_number(text) or {"status": "error", "message": text}
+
+    def get_status(self, aid):
+        try:
+            return self.chamar('getStatus', id=aid).text.strip()
+        except Exception as e:
+            logger.error(f"Erro getStatus smsbower: {e}")
+            return None
+
+    def set_status(self, aid, status):
+        try:
+            return self.chamar('setStatus', status=str(status), id=aid).text.strip()
+        except Exception as e:
+            logger.error(f"Erro setStatus smsbower: {e}")
+            return None
+
+    def cancel(self, aid):
+        if self.set_status(aid, 8) is not None:
+            logger.info(f"Cancelado provider (smsbower): {aid}")
+
+    def get_prices_v2(self, service_code, country_id):
+        try:
+            return self.chamar('getPricesV2', service=service_code, country=country_id).json()
+        except Exception as e:
+            logger.error(f"[getPricesV2] erro: {e}")
+            return None
+
+
+# operadoras tentadas em paralelo no getNumber do sms24h (a primeira que
+# entregar número vence; números que chegarem depois são cancelados)
+SMS24H_OPERADORES   = [o.strip() for o in (os.getenv("SMS24H_OPERADORES") or "claro").split(",") if o.strip()]
+SMS24H_NUMERO_PRAZO = float(os.getenv("SMS24H_NUMERO_PRAZO", "6"))
+# todo getNumber passa por este pool; dimensione para compras simultâneas (lote + bot)
+SMS24H_NUMERO_WORKERS = int(os.getenv("SMS24H_NUMERO_WORKERS", "32"))
+
+class SMS24hClient(ProviderClient):
+    TIMEOUTS = {'getNumber': 15, 'getStatus': 10, 'setStatus': 10, 'getExtraActivation': 12}
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._pool_operadores = ThreadPoolExecutor(max_workers=SMS24H_NUMERO_WORKERS, thread_name_prefix="sms24h-op")
+
+    def key_ok(self):
+        if not self.api_key:
+            logger.error("[sms24h] API_KEY_SMS24H não definido no ambiente")
+            return False
+        return True
+
+    def _get_number_operadora(self, service_code, op, country):
+        try:
+            text = self.chamar('getNumber', service=service_code, operator=op, country=country).text.strip()
             logger.info(f"GET_NUMBER (sms24h {op}) → {text}")
         except Exception as e:
             logger.error(f"Erro getNumber sms24h ({op}): {e}")
-            continue
-        if text.startswith("ACCESS_NUMBER:"):
-            _, aid, num = text.split(":", 2)
-            return {"status":"success","id":aid,"number":num}
-    return {"status":"error","message":"NO_NUMBERS"}
+            return None
+        return self._parse_access_number(text)
+
+    def get_number(self, service_code, operator=None, country="73"):
+        if not self.key_ok():
+            return {"status": "error", "message": "NO_KEY"}
+        operadores = list(dict.fromkeys(([operator] if operator else []) + SMS24H_OPERADORES)) or ["claro"]
+        # mesmo com uma operadora só passa pelo pool: o prazo vale sempre e o
+        # número que chegar depois dele é cancelado no provider
+
+        lock = threading.Lock()
+        pronto = threading.Event()
+        estado = {"restantes": len(operadores)}   # "vencedor" entra quando decidido
+
+        def concluir(fut):
+            res = fut.result()
+            with lock:
+                estado["restantes"] -= 1
+                ganhou = bool(res) and "vencedor" not in estado
+                if ganhou:
+                    estado["vencedor"] = res
+                fim = ganhou or estado["restantes"] == 0
+            if res and not ganhou:
+                # perdeu a corrida (ou chegou depois do prazo): devolve ao provider
+                logger.info(f"[sms24h] cancelando número excedente {res['id']}")
+                self.set_status(res['id'], 8)
+            if fim:
+                pronto.set()
+
+        for op in operadores:
+            self._pool_operadores.submit(self._get_number_operadora, service_code, op, country).add_done_callback(concluir)
+        pronto.wait(SMS24H_NUMERO_PRAZO)
+        with lock:
+            res = estado.setdefault("vencedor", None)
+        return res or {"status": "error", "message": "NO_NUMBERS"}
+
+    def get_status(self, aid):
+        if not self.key_ok():
+            return None
+        try:
+            return self.chamar('getStatus', id=aid).text.strip()
+        except Exception as e:
+            logger.error(f"Erro getStatus sms24h: {e}")
+            return None
+
+    def set_status(self, aid, status):
+        """
+        status: 1 (SMS enviado), 3 (repetir SMS), 6 (finalizar), 8 (cancelar)
+        """
+        if not self.key_ok():
+            return None
+        try:
+            txt = self.chamar('setStatus', status=status, id=aid).text.strip()
+            logger.info(f"setStatus sms24h({status}) → {txt}")
+            return txt
+        except Exception as e:
+            logger.error(f"Erro setStatus sms24h: {e}")
+            return None
 
-def obter_status_sms24h(aid):
-    if not sms24h_key_ok():
-        return None
-    try:
-        r = requests.get(
-            SMS24H_URL,
-            params={'api_key': API_KEY_SMS24H, 'action': 'getStatus', 'id': aid},
-            timeout=10
-        )
-        r.raise_for_status()
-        return r.text.strip()
-    except Exception as e:
-        logger.error(f"Erro getStatus sms24h: {e}")
-        return None
+    def get_extra_activation(self, aid):
+        """Texto cru da API; deixa HTTPError subir para o chamador tratar."""
+        return self.chamar('getExtraActivation', activationId=aid).text.strip()
 
-def set_status_sms24h(aid, status):
-    """
-    status: 1 (SMS enviado), 3 (repetir SMS), 6 (finalizar), 8 (cancelar)
-    """
-    if not sms24h_key_ok():
-        return None
-    try:
-        r = requests.get(
-            SMS24H_URL,
-            params={'api_key': API_KEY_SMS24H, 'action': 'setStatus', 'status': status, 'id': aid},
-            timeout=10
-        )
-        r.raise_for_status()
-        txt = r.text.strip()
-        logger.info(f"setStatus sms24h({status}) → {txt}")
-        return txt
-    except Exception as e:
-        logger.error(f"Erro setStatus sms24h: {e}")
-        return None
+
+smsbower_api = SMSBowerClient('smsbower', SMSBOWER_URL, API_KEY_SMSBOWER)
+sms24h_api   = SMS24hClient('sms24h', SMS24H_URL, API_KEY_SMS24H)
+# site público do SMSBower (getPricesByService do scanner), sem api_key
+smsbower_web = ProviderClient('smsbower_web', SMSBOWER_WEB_URL,
+                              timeouts={'getPricesByService': 15})
 
 # >>> dispatcher de status por provider
 def obter_status(aid, provider):
     if provider == 'sms24h':
-        return obter_status_sms24h(aid)
-    return obter_status_smsbower(aid)
+        return sms24h_api.get_status(aid)
+    return smsbower_api.get_status(aid)
 
 def cancelar_numero(aid, provider):
     if provider == 'sms24h':
-        set_status_sms24h(aid, 8)  # cancelar
+        sms24h_api.set_status(aid, 8)  # cancelar
         return
-    cancelar_numero_smsbower(aid)
-
-# ========= menor preço via getPricesV2 (smsbower) =========
-def obter_menor_preco_v2(service_code, country_id):
-    try:
-        r = requests.get(
-            SMSBOWER_URL,
-            params={
-                'api_key': API_KEY_SMSBOWER,
-                'action': 'getPricesV2',
-                'service': service_code,
-                'country': country_id
-            },
-            timeout=12
-        )
-        r.raise_for_status()
-        data = r.json()
-    except Exception as e:
-        logger.error(f"[getPricesV2] erro: {e}")
-        return None
-
-    country_map = data.get(str(country_id)) or data.get(country_id) or {}
-    svc_map = country_map.get(service_code) or {}
-    if not isinstance(svc_map, dict) or not svc_map:
-        return None
-
-    candidatos = []
+    smsbower_api.cancel(aid)
+
+# ========= tabela de preços getPricesV2 em memória (smsbower) =========
+# Respostas por (país, serviço) com TTL; depois do TTL devolve o valor
+# velho e atualiza em segundo plano (stale-while-revalidate). Pedidos
+# simultâneos da mesma chave esperam uma única chamada ao provider.
+PRECOS_TTL_SEC       = float(os.getenv("PRECOS_TTL_SEC", "20"))
+PRECOS_MAX_STALE_SEC = float(os.getenv("PRECOS_MAX_STALE_SEC", "300"))
+
+class TabelaPrecos:
+    def __init__(self, client, ttl, max_stale):
+        self.client = client
+        self.ttl = ttl
+        self.max_stale = max_stale
+        self._lock = threading.Lock()
+        self._entradas = {}   # (country, service) -> {"data": {preço: qtd}, "ts": float}
+        self._em_voo = {}     # (country, service) -> threading.Event
+        self._pool = None
+        self.stats = {"hits": 0, "stale": 0, "misses": 0, "fetches": 0, "falhas": 0}
+
+    def _buscar(self, country_id, service_code):
+        data = self.client.get_prices_v2(service_code, country_id)
+        if not isinstance(data, dict):
+            return None
+        country_map = data.get(str(country_id)) or data.get(country_id) or {}
+        svc_map = country_map.get(service_code) or {}
+        return svc_map if isinstance(svc_map, dict) else {}
+
+    def _atualizar(self, chave):
+        """Executa o fetch da chave; só um por vez (os demais esperam o Event)."""
+        with self._lock:
+            ev = self._em_voo.get(chave)
+            dono = ev is None
+            if dono:
+                ev = self._em_voo[chave] = threading.Event()
+        if not dono:
+            ev.wait(self.client.timeouts.get('getPricesV2', 12) + 1)
+            return
+        try:
+            self.stats["fetches"] += 1
+            svc_map = self._buscar(*chave)
+            with self._lock:
+                if svc_map is None:
+                    self.stats["falhas"] += 1
+                else:
+                    self._entradas[chave] = {"data": svc_map, "ts": time.time()}
+        finally:
+            with self._lock:
+                self._em_voo.pop(chave, None)
+            ev.set()
+
+    def _atualizar_em_segundo_plano(self, chave):
+        with self._lock:
+            if chave in self._em_voo:
+                return
+            if self._pool is None:
+                self._pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="precos")
+        self._pool.submit(self._atualizar, chave)
+
+    def get(self, country_id, service_code):
+        chave = (str(country_id), service_code)
+        with self._lock:
+            ent = self._entradas.get(chave)
+        idade = time.time() - ent["ts"] if ent else None
+        if ent and idade < self.ttl:
+            self.stats["hits"] += 1
+            return ent["data"]
+        if ent and idade < self.max_stale:
+            self.stats["stale"] += 1
+            self._atualizar_em_segundo_plano(chave)
+            return ent["data"]
+        self.stats["misses"] += 1
+        self._atualizar(chave)
+        with self._lock:
+            ent = self._entradas.get(chave)
+        # se o provider falhou, um valor além do max_stale ainda é melhor que nada
+        return ent["data"] if ent else None
+
+tabela_precos = TabelaPrecos(smsbower_api, PRECOS_TTL_SEC, PRECOS_MAX_STALE_SEC)
+
+def _ofertas_preco(svc_map):
     for price_str, qty in svc_map.items():
         try:
             p = float(str(price_str).replace(',', '.'))
@@ -1563,57 +3516,30 @@ def obter_menor_preco_v2(service_code, country_id):
             q = int(qty)
         except:
             q = 0
-        if q > 4:
-            candidatos.append(p)
+        yield p, q
 
-    if not candidatos:
+# ========= menor preço via getPricesV2 (smsbower) =========
+def obter_menor_preco_v2(service_code, country_id):
+    svc_map = tabela_precos.get(country_id, service_code)
+    if not svc_map:
         return None
 
-    candidatos.sort()
-    return candidatos[0]
+    candidatos = [p for p, q in _ofertas_preco(svc_map) if q > 4]
+    if not candidatos:
+        return None
+    return min(candidatos)
 
 # ========= preço WA especial: decrescente até <= cap com qty>1 =========
 def obter_preco_wa_desc_v2(service_code, country_id, max_usd=0.7):
-    try:
-        r = requests.get(
-            SMSBOWER_URL,
-            params={
-                'api_key': API_KEY_SMSBOWER,
-                'action': 'getPricesV2',
-                'service': service_code,
-                'country': country_id
-            },
-            timeout=12
-        )
-        r.raise_for_status()
-        data = r.json()
-    except Exception as e:
-        logger.error(f"[getPricesV2/WA] erro: {e}")
-        return None
-
-    country_map = data.get(str(country_id)) or data.get(country_id) or {}
-    svc_map = country_map.get(service_code) or {}
-    if not isinstance(svc_map, dict) or not svc_map:
+    svc_map = tabela_precos.get(country_id, service_code)
+    if not svc_map:
         return None
 
-    candidatos = []
-    for price_str, qty in svc_map.items():
-        try:
-            p = float(str(price_str).replace(',', '.'))
-        except:
-            continue
-        try:
-            q = int(qty)
-        except:
-            q = 0
-        if p <= max_usd and q > 5:
-            candidatos.append((p, q))
-
+    candidatos = [p for p, q in _ofertas_preco(svc_map) if p <= max_usd and q > 5]
     if not candidatos:
         return None
 
-    candidatos.sort(key=lambda x: x[0], reverse=True)
-    escolhido = candidatos[0][0]
+    escolhido = max(candidatos)
     logger.info(f"[WA] preço escolhido (<= {max_usd} c/ qty>5): {escolhido}")
     return escolhido
 
@@ -1659,39 +3585,11 @@ def menu_id(c):
 def show_comprar_menu(chat_id):
     kb = telebot.types.InlineKeyboardMarkup(row_width=1)
 
-    def add_btn(key):
-        price = SERVICE_PRICES.get(key, 0.0)
-        label = f"{SERVICE_EMOJIS.get(key, '•')} {SERVICE_NAMES.get(key, key)} - R${price:.2f}"
+    # um snapshot só: a ordem do menu é a ordem do próprio mapping
+    for key, r in ROTAS_SERVICO.items():
+        label = f"{r.emoji} {r.nome} - R${r.preco:.2f}"
         kb.add(telebot.types.InlineKeyboardButton(label, callback_data=f'comprar_{key}'))
 
-    add_btn('mercado')
-    add_btn('mpsrv2')
-    add_btn('china')
-    add_btn('china2')
-    add_btn('china3')   # novo: logo abaixo da China 2
-    add_btn('picpay')
-    add_btn('picsrv2')
-    add_btn('wa1')
-    add_btn('wa2')
-
-    # Google
-    add_btn('google')
-    add_btn('googlesrv2')
-
-    # Bancos / SMS especiais
-    add_btn('nubank')
-    add_btn('c6srv1')
-    add_btn('c6')
-    add_btn('neon')
-    add_btn('agibank')      # novo S1
-    add_btn('agibanksrv2')  # novo S2
-    add_btn('app99')        # novo S1
-    add_btn('app99srv2')    # novo S2
-    add_btn('nextsrv2')     # novo S2
-
-    add_btn('outros')
-    add_btn('srv2')
-
     bot.send_message(chat_id, 'Escolha serviço:', reply_markup=kb)
 
 @bot.message_handler(commands=['start'])
@@ -1760,7 +3658,7 @@ def menu_numeros(c):
     try: bot.answer_callback_query(c.id)
     except: pass
     criar_usuario(c.from_user.id)
-    nums = carregar_usuario(c.from_user.id)['numeros']
+    nums = listar_numeros_usuario(c.from_user.id)
     if not nums:
         bot.send_message(c.message.chat.id, '📭 Sem números ativos.')
     else:
@@ -1816,164 +3714,18 @@ def cb_comprar(c):
     user_id, key = c.from_user.id, c.data.split('_')[1]
     criar_usuario(user_id)
 
-    prices = SERVICE_PRICES
-    names  = SERVICE_NAMES
-
-    idsms = {
-        'mercado':     get_service_code('mercado'),  # smsbower
-        'mpsrv2':      'cq',                         # sms24h - Mercado
-        'china':       get_service_code('china'),    # smsbower
-        'china2':      get_service_code('china2'),   # smsbower
-        'china3':      'ot',                         # sms24h - China 3
-        'picpay':      get_service_code('picpay'),   # smsbower
-        'picsrv2':     'ev',                         # sms24h - PicPay
-        'wa1':         'wa',                         # smsbower - WhatsApp
-        'wa2':         'wa',                         # sms24h  - WhatsApp
-        'outros':      get_service_code('outros'),   # smsbower
-        'srv2':        'ot',                         # sms24h - Outros
-        # sms24h:
-        'nubank':      'aaa',
-        'c6':          'aff',
-        'neon':        'aex',
-        'agibanksrv2': 'sa',                         # novo
-        'app99srv2':   'ki',                         # novo
-        'nextsrv2':    'aey',                        # novo
-        # Servidor 1:
-        'c6srv1':      get_service_code('outros'),
-        'google':      'go',
-        'agibank':     'sa',                         # novo
-        'app99':       'ki',                         # novo
-        # Servidor 2:
-        'googlesrv2':  'go',
-    }
+    rota = ROTAS_SERVICO.get(key)
+    if rota is None:
+        return bot.answer_callback_query(c.id, '❌ Opção inválida.', True)
 
     balance = carregar_usuario(user_id)['saldo']
-    price   = prices.get(key)
-    service = names.get(key)
-
-    if (price is None) or (service is None) or (key not in idsms):
-        return bot.answer_callback_query(c.id, '❌ Opção inválida.', True)
+    price   = rota.preco
+    service = rota.nome
 
     if balance < price:
         return bot.answer_callback_query(c.id, '❌ Saldo insuficiente.', True)
 
-    # ============ fluxo sms24h (Servidor 2) ============
-    if key in ('srv2', 'mpsrv2', 'picsrv2', 'wa2', 'nubank', 'c6', 'neon', 'googlesrv2', 'agibanksrv2', 'app99srv2', 'nextsrv2', 'china3'):
-        resp = solicitar_numero_sms24h(idsms[key], operator="claro", country=COUNTRY_ID)
-        if resp.get('status') != 'success':
-            return bot.send_message(c.message.chat.id, '🚫 Sem números disponíveis.')
-        aid   = resp['id']
-        full  = resp['number']
-        short = full[2:] if full.startswith('55') else full
-
-        ok = comprar_numero_atomico(user_id, aid, price)
-        if not ok:
-            return bot.send_message(c.message.chat.id, "⚠️ Erro ao descontar saldo ou duplicidade, tente novamente.")
-
-        kb_blocked = telebot.types.InlineKeyboardMarkup()
-        kb_blocked.row(telebot.types.InlineKeyboardButton('❌ Cancelar (2m)', callback_data=f'cancel_blocked_{aid}'))
-        kb_blocked.row(telebot.types.InlineKeyboardButton('🛒 Comprar mesmo serviço', callback_data=f'comprar_{key}'))
-        kb_blocked.row(telebot.types.InlineKeyboardButton('📲 Comprar serviços', callback_data='menu_comprar'),
-                       telebot.types.InlineKeyboardButton('📜 Menu', callback_data='menu'))
-        kb_unlocked = telebot.types.InlineKeyboardMarkup()
-        kb_unlocked.row(telebot.types.InlineKeyboardButton('❌ Cancelar', callback_data=f'cancel_{aid}'))
-        kb_unlocked.row(telebot.types.InlineKeyboardButton('🛒 Comprar mesmo serviço', callback_data=f'comprar_{key}'))
-        kb_unlocked.row(telebot.types.InlineKeyboardButton('📲 Comprar serviços', callback_data='menu_comprar'),
-                        telebot.types.InlineKeyboardButton('📜 Menu', callback_data='menu'))
-        text = (
-            f"📦 {service}\n"
-            f"🆔 *ID de ativação:* `{aid}`\n"
-            f"☎️ Número: `{full}`\n"
-            f"☎️ Sem DDI: `{short}`\n\n"
-            f"🕘 Prazo: {PRAZO_MINUTOS} minutos\n\n"
-            f"💡 Ativo por {PRAZO_MINUTOS} minutos; sem SMS, saldo devolvido automaticamente."
-        )
-        msg = bot.send_message(c.message.chat.id, text, parse_mode='Markdown', reply_markup=kb_blocked)
-        status_map[aid] = {
-            'user_id':    user_id,
-            'price':      price,
-            'chat_id':    msg.chat.id,
-            'message_id': msg.message_id,
-            'service':    service,
-            'service_key': key,
-            'full':       full,
-            'short':      short,
-            'provider':   'sms24h'
-        }
-        spawn_sms_thread(aid)
-
-        def countdown():
-            for minute in range(PRAZO_MINUTOS):
-                time.sleep(60)
-                rem = PRAZO_MINUTOS - (minute + 1)
-                info = status_map.get(aid)
-                if not info: return
-                # >>>>>>>>>>>>>>>>>>>>>>>>>>>
-                # BLOQUEIA EDIÇÃO SE JÁ RECEBEU SMS
-                if info.get('codes'):
-                    return
-                # <<<<<<<<<<<<<<<<<<<<<<<<<<<<
-                new_text = (
-                    f"📦 {service}\n"
-                    f"🆔 *ID de ativação:* `{aid}`\n"
-                    f"☎️ Número: `{full}`\n"
-                    f"☎️ Sem DDI: `{short}`\n\n"
-                    f"🕘 Prazo: {rem} minutos\n\n"
-                    f"💡 Ativo por {PRAZO_MINUTOS} minutos; sem SMS, saldo devolvido automaticamente."
-                )
-                kb_sel = kb_blocked if minute < 2 else kb_unlocked
-                try:
-                    bot.edit_message_text(
-                        new_text,
-                        info['chat_id'],
-                        info['message_id'],
-                        parse_mode='Markdown',
-                        reply_markup=kb_sel
-                    )
-                except telebot.apihelper.ApiTelegramException as e:
-                    # IGNORA erros de mensagem sumida
-                    if "message to edit not found" in str(e) or "message is not modified" in str(e):
-                        return
-                    else:
-                        raise
-
-
-        def auto_cancel():
-            time.sleep(PRAZO_SEGUNDOS)
-            info = status_map.get(aid)
-            if info and not info.get('codes') and not info.get('canceled_by_user'):
-                cancelar_numero(aid, provider='sms24h')
-                ok2 = marcar_cancelado_e_devolver(info['user_id'], aid)
-                if info.get("is_api"):
-                    # salvar log opcional
-                    logger.info(f"[API] Cancelamento automático devolveu saldo para {info['user_id']} (AID: {aid})")
-                    return
-                if ok2:
-                    try: bot.delete_message(info['chat_id'], info['message_id'])
-                    except: pass
-
-        threading.Thread(target=countdown, daemon=True).start()
-        threading.Thread(target=auto_cancel, daemon=True).start()
-        return
-
-    # ================== fluxo smsbower (Servidor 1) ==================
-    s1_effective_cap = min(float(SMSBOWER_MAX_PRICE_CAP), float(S1_CAPS.get(key, 0.10)))
-
-    # Descobrir o "menor" preço (ou regra especial do WA)
-    if key == 'wa1':
-        base_max_price = obter_preco_wa_desc_v2(idsms[key], COUNTRY_ID, max_usd=s1_effective_cap)
-    elif key == 'china2':
-        with SCANNER_PRICE_LOCK:
-            mp = SCANNER_LAST_PRICE
-        base_max_price = float(mp) if mp is not None else obter_menor_preco_v2(idsms[key], COUNTRY_ID)
-    else:
-        base_max_price = obter_menor_preco_v2(idsms[key], COUNTRY_ID)
-
-    if (base_max_price is None) or (float(base_max_price) > s1_effective_cap):
-        return bot.send_message(c.message.chat.id, '🚫 Sem números disponíveis.')
-
-    # Forçar compra no preço mínimo encontrado (para realmente “comprar o menor”)
-    resp = solicitar_numero_smsbower(idsms[key], max_price=float(base_max_price))
+    resp, provider, _ = solicitar_numero_api(key)
     if resp.get('status') != 'success':
         return bot.send_message(c.message.chat.id, '🚫 Sem números disponíveis.')
 
@@ -1981,10 +3733,13 @@ def cb_comprar(c):
     full  = resp['number']
     short = full[2:] if full.startswith('55') else full
 
-    ok = comprar_numero_atomico(user_id, aid, price)
+    ok = comprar_numero_atomico(user_id, aid, price, key)
     if not ok:
         return bot.send_message(c.message.chat.id, "⚠️ Erro ao descontar saldo ou duplicidade, tente novamente.")
 
+    iniciar_ativacao_telegram(c.message.chat.id, user_id, key, service, price, aid, full, short, provider)
+
+def teclados_ativacao(aid, key):
     kb_blocked = telebot.types.InlineKeyboardMarkup()
     kb_blocked.row(telebot.types.InlineKeyboardButton('❌ Cancelar (2m)', callback_data=f'cancel_blocked_{aid}'))
     kb_blocked.row(telebot.types.InlineKeyboardButton('🛒 Comprar mesmo serviço', callback_data=f'comprar_{key}'))
@@ -1995,169 +3750,537 @@ def cb_comprar(c):
     kb_unlocked.row(telebot.types.InlineKeyboardButton('🛒 Comprar mesmo serviço', callback_data=f'comprar_{key}'))
     kb_unlocked.row(telebot.types.InlineKeyboardButton('📲 Comprar serviços', callback_data='menu_comprar'),
                     telebot.types.InlineKeyboardButton('📜 Menu', callback_data='menu'))
-    text = (
-        f"📦 {service}\n"
-        f"☎️ Número: `{full}`\n"
-        f"☎️ Sem DDI: `{short}`\n\n"
-        f"🕘 Prazo: {PRAZO_MINUTOS} minutos\n\n"
+    return kb_blocked, kb_unlocked
+
+def texto_ativacao(aid, info, minutos_restantes):
+    # Servidor 2 mostra o AID (usado na reativação)
+    linha_aid = f"🆔 *ID de ativação:* `{aid}`\n" if info.get('provider') == 'sms24h' else ""
+    return (
+        f"📦 {info['service']}\n"
+        f"{linha_aid}"
+        f"☎️ Número: `{info['full']}`\n"
+        f"☎️ Sem DDI: `{info['short']}`\n\n"
+        f"🕘 Prazo: {minutos_restantes} minutos\n\n"
         f"💡 Ativo por {PRAZO_MINUTOS} minutos; sem SMS, saldo devolvido automaticamente."
     )
-    msg = bot.send_message(c.message.chat.id, text, parse_mode='Markdown', reply_markup=kb_blocked)
-    status_map[aid] = {
+
+def iniciar_ativacao_telegram(chat_id, user_id, key, service, price, aid, full, short, provider):
+    """
+    Registro no status_map + polling/contagem/expiração no agendador e, só
+    depois, a mensagem da compra (o saldo já foi descontado: a ativação tem
+    que existir mesmo se o envio atrasar ou falhar). O message_id chega pelo
+    callback do envio; se o envio falhar, a tarefa 'mensagem' cancela no
+    provider e devolve.
+    """
+    info = {
         'user_id':    user_id,
         'price':      price,
-        'chat_id':    msg.chat.id,
-        'message_id': msg.message_id,
+        'chat_id':    chat_id,
+        'message_id': None,
         'service':    service,
         'service_key': key,
         'full':       full,
         'short':      short,
-        'provider':   'smsbower'
+        'provider':   provider,
+        'creation_ts': time.time(),
+        'expira_em':  time.time() + PRAZO_SEGUNDOS,
     }
-    spawn_sms_thread(aid)
-
-    def countdown():
-        for minute in range(PRAZO_MINUTOS):
-            time.sleep(60)
-            rem = PRAZO_MINUTOS - (minute + 1)
-            info = status_map.get(aid)
-            if not info: return
-            # >>>>>>>>>>>>>>>>>>>>>>>>>>>
-            # BLOQUEIA EDIÇÃO SE JÁ RECEBEU SMS
-            if info.get('codes'):
+    registrar_ativacao(aid, info)
+    iniciar_polling(aid)
+    agendador.agendar(aid, 'countdown', 60)
+    agendador.agendar(aid, 'expirar', PRAZO_SEGUNDOS)
+
+    kb_blocked, _ = teclados_ativacao(aid, key)
+    fut = tg_enviar(chat_id, texto_ativacao(aid, info, PRAZO_MINUTOS), prioridade=PRIO_COMPRA,
+                    parse_mode='Markdown', reply_markup=kb_blocked)
+
+    def _apos_enviar(f):
+        # roda na thread do despachante: só anota e passa o resto ao agendador
+        e = f.exception()
+        if e is None:
+            msg = f.result()
+            info['chat_id'] = msg.chat.id
+            info['message_id'] = msg.message_id
+        else:
+            info['mensagem_falhou'] = str(e)
+        agendador.agendar(aid, 'mensagem', 0)
+    fut.add_done_callback(_apos_enviar)
+
+# =========================================================
+# ===================== STATUS / CANCEL ===================
+# =========================================================
+# Um único agendador (heap de timers + pool pequeno de workers) cuida do
+# polling, da contagem regressiva e da expiração de todas as ativações.
+# Antes eram 3 threads dormindo até 23 min por número.
+AGENDADOR_WORKERS   = int(os.getenv("AGENDADOR_WORKERS", "16"))
+POLL_INTERVALO_SEC  = 5
+
+class AgendadorAtivacoes:
+    """
+    Tarefas são (aid, tipo). Reagendar um (aid, tipo) invalida a entrada
+    anterior por geração, então cada AID tem no máximo um poller/contagem/
+    expiração vivo. O handler do tipo devolve o atraso até a próxima
+    execução, ou None para encerrar.
+    """
+
+    def __init__(self, workers):
+        self._heap = []
+        self._cond = threading.Condition()
+        self._seq = itertools.count()
+        self._gen = {}        # (aid, tipo) -> geração vigente
+        self._handlers = {}
+        self._workers = workers
+        self._pool = None
+        self._thread = None
+
+    def registrar(self, tipo, fn):
+        self._handlers[tipo] = fn
+
+    def _garantir_thread(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._cond:
+            if self._thread is None or not self._thread.is_alive():
+                if self._pool is None:
+                    self._pool = ThreadPoolExecutor(max_workers=self._workers, thread_name_prefix="ativacoes")
+                self._thread = threading.Thread(target=self._loop, name="agendador-ativacoes", daemon=True)
+                self._thread.start()
+
+    def agendar(self, aid, tipo, atraso):
+        with self._cond:
+            g = self._gen.get((aid, tipo), 0) + 1
+            self._gen[(aid, tipo)] = g
+            heapq.heappush(self._heap, (time.time() + atraso, next(self._seq), aid, tipo, g))
+            self._cond.notify()
+        self._garantir_thread()
+
+    def cancelar(self, aid, tipo=None):
+        tipos = [tipo] if tipo else list(self._handlers)
+        with self._cond:
+            for t in tipos:
+                self._gen.pop((aid, t), None)
+
+    def pendentes(self):
+        with self._cond:
+            return len(self._gen)
+
+    def _loop(self):
+        while True:
+            with self._cond:
+                while not self._heap:
+                    self._cond.wait()
+                quando, _, aid, tipo, g = self._heap[0]
+                atraso = quando - time.time()
+                if atraso > 0:
+                    self._cond.wait(atraso)
+                    continue
+                heapq.heappop(self._heap)
+                if self._gen.get((aid, tipo)) != g:
+                    continue   # substituída ou cancelada
+            self._pool.submit(self._executar, aid, tipo, g)
+
+    def _executar(self, aid, tipo, g):
+        prox = None
+        try:
+            prox = self._handlers[tipo](aid)
+        except Exception as e:
+            logger.error(f"[agendador] {tipo} {aid}: {e}")
+        with self._cond:
+            if self._gen.get((aid, tipo)) != g:
                 return
-            # <<<<<<<<<<<<<<<<<<<<<<<<<<<<
-            new_text = (
-                f"📦 {service}\n"
-                f"☎️ Número: `{full}`\n"
-                f"☎️ Sem DDI: `{short}`\n\n"
-                f"🕘 Prazo: {rem} minutos\n\n"
-                f"💡 Ativo por {PRAZO_MINUTOS} minutos; sem SMS, saldo devolvido automaticamente."
-            )
-            kb_sel = kb_blocked if minute < 2 else kb_unlocked
+            if prox is None:
+                self._gen.pop((aid, tipo), None)
+            else:
+                heapq.heappush(self._heap, (time.time() + prox, next(self._seq), aid, tipo, g))
+                self._cond.notify()
+
+agendador = AgendadorAtivacoes(AGENDADOR_WORKERS)
+
+def extrair_codigos(service_key, texto):
+    # texto completo ou só números com 4+ dígitos, conforme a rota do serviço
+    rota = ROTAS_SERVICO.get(service_key)
+    if rota is not None and rota.texto_completo:
+        return [texto.strip()]
+    return [n for n in re.findall(r"\d+", texto) if len(n) >= 4]
+
+# ---------- notificação por AID (long-polling sem tráfego no provider) ----------
+API_WAIT_MAX_SEC = int(os.getenv("API_WAIT_MAX_SEC", "120"))
+ESTADOS_FINAIS   = ('cancelada', 'expirada')
+
+class NotificadorAtivacoes:
+    """
+    Uma Condition por AID, criada só enquanto houver alguém esperando.
+    Quem muda o estado da ativação chama sinalizar(aid) DEPOIS de mudar;
+    quem espera testa o predicado sob a Condition, então nada se perde.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._conds = {}   # aid -> [Condition, n_esperando]
+
+    def esperar(self, aid, pronto, timeout):
+        with self._lock:
+            ent = self._conds.setdefault(aid, [threading.Condition(), 0])
+            ent[1] += 1
+        try:
+            with ent[0]:
+                return ent[0].wait_for(pronto, timeout)
+        finally:
+            with self._lock:
+                ent[1] -= 1
+                if ent[1] <= 0:
+                    self._conds.pop(aid, None)
+
+    def sinalizar(self, aid):
+        with self._lock:
+            ent = self._conds.get(aid)
+        if ent is None:
+            return
+        with ent[0]:
+            ent[0].notify_all()
+
+    def esperando(self):
+        with self._lock:
+            return sum(e[1] for e in self._conds.values())
+
+notificador = NotificadorAtivacoes()
+
+# ---------- pub/sub de eventos das ativações (/api/stream) ----------
+API_STREAM_MAX_SEC = int(os.getenv("API_STREAM_MAX_SEC", "1800"))   # cliente reconecta depois
+API_STREAM_FILA    = int(os.getenv("API_STREAM_FILA", "1000"))
+
+class _Assinatura:
+    __slots__ = ("user_id", "aids", "fila", "estourou")
+
+    def __init__(self, user_id, aids):
+        self.user_id = user_id
+        self.aids = aids
+        self.fila = queue.Queue(maxsize=API_STREAM_FILA)
+        self.estourou = False
+
+class BarramentoEventos:
+    """
+    Entrega em memória dos eventos de cada AID para quem assinou o AID ou
+    (sem lista de AIDs) o usuário inteiro. Nunca bloqueia quem publica: se a
+    fila de um cliente lento encher, a assinatura é encerrada e o cliente
+    reconecta recebendo o estado atual.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._por_aid = collections.defaultdict(set)
+        self._por_usuario = collections.defaultdict(set)
+        self.ouvintes = []   # callables(aid, user_id, evento, dados) chamados em todo evento
+        self.stats = {"publicados": 0, "estouros": 0}
+
+    def assinar(self, user_id, aids=None):
+        a = _Assinatura(str(user_id), tuple(aids) if aids else None)
+        with self._lock:
+            if a.aids:
+                for aid in a.aids:
+                    self._por_aid[aid].add(a)
+            else:
+                self._por_usuario[a.user_id].add(a)
+        return a
+
+    def cancelar(self, a):
+        with self._lock:
+            chaves = [(self._por_aid, aid) for aid in a.aids] if a.aids else [(self._por_usuario, a.user_id)]
+            for mapa, chave in chaves:
+                conjunto = mapa.get(chave)
+                if conjunto is not None:
+                    conjunto.discard(a)
+                    if not conjunto:
+                        mapa.pop(chave, None)
+
+    def publicar(self, aid, user_id, evento, dados):
+        for ouvinte in self.ouvintes:
             try:
-                bot.edit_message_text(
-                    new_text,
-                    info['chat_id'],
-                    info['message_id'],
-                    parse_mode='Markdown',
-                    reply_markup=kb_sel
-                )
-            except telebot.apihelper.ApiTelegramException as e:
-                # IGNORA erros de mensagem sumida
-                if "message to edit not found" in str(e) or "message is not modified" in str(e):
-                    return
-                else:
-                    raise
+                ouvinte(aid, user_id, evento, dados)
+            except Exception as e:
+                logger.error(f"[eventos] ouvinte falhou ({evento} {aid}): {e}")
+        with self._lock:
+            alvos = list(self._por_aid.get(aid, ())) + list(self._por_usuario.get(str(user_id), ()))
+        if not alvos:
+            return
+        self.stats["publicados"] += 1
+        for a in alvos:
+            try:
+                a.fila.put_nowait((evento, dados))
+            except queue.Full:
+                a.estourou = True
+                self.stats["estouros"] += 1
 
-    def auto_cancel():
-        time.sleep(PRAZO_SEGUNDOS)
-        info = status_map.get(aid)
-        if info and not info.get('codes') and not info.get('canceled_by_user'):
-            cancelar_numero(aid, provider='smsbower')
-            ok2 = marcar_cancelado_e_devolver(info['user_id'], aid)
-            if info.get("is_api"):
-                # salvar log opcional
-                logger.info(f"[API] Cancelamento automático devolveu saldo para {info['user_id']} (AID: {aid})")
-                return
-            if ok2:
-                try: bot.delete_message(info['chat_id'], info['message_id'])
-                except: pass
+    def assinantes(self):
+        with self._lock:
+            return sum(len(v) for v in self._por_aid.values()) + sum(len(v) for v in self._por_usuario.values())
 
-    threading.Thread(target=countdown, daemon=True).start()
-    threading.Thread(target=auto_cancel, daemon=True).start()
+barramento = BarramentoEventos()
+ESTADO_API = {'cancelada': 'canceled', 'expirada': 'expired'}
 
-# =========================================================
-# ===================== STATUS / CANCEL ===================
-# =========================================================
-def spawn_sms_thread(aid):
+# ---------- persistência write-through das ativações ----------
+ATIVACOES_RETENCAO_SEC = int(os.getenv("ATIVACOES_RETENCAO_SEC", str(24 * 3600)))
+
+def persistir_ativacao(aid, info, estado=None):
+    try:
+        dados = dict(info)
+        dados['codes'] = list(info.get('codes') or [])
+        with get_db_conn() as conn, conn.cursor() as cur:
+            cur.execute("""
+                INSERT INTO ativacoes (aid, user_id, estado, dados)
+                VALUES (%s, %s, COALESCE(%s, 'ativa'), %s)
+                ON CONFLICT (aid) DO UPDATE SET
+                    dados = EXCLUDED.dados,
+                    estado = COALESCE(%s, ativacoes.estado),
+                    atualizado_em = NOW()
+            """, (str(aid), str(info.get('user_id')), estado, json.dumps(dados, default=str), estado))
+            conn.commit()
+    except Exception as e:
+        logger.error(f"[ativacoes] erro ao persistir {aid}: {e}")
+
+def registrar_ativacao(aid, info):
+    info.setdefault('codes', [])
+    with status_lock:
+        status_map[aid] = info
+    persistir_ativacao(aid, info, estado='ativa')
+    barramento.publicar(aid, info.get('user_id'), 'number', {
+        "aid": aid, "number": info.get('full'), "service": info.get('service_key')
+    })
+
+def adicionar_codigos(aid, info, payloads):
+    """Anexa os códigos novos a info['codes'] e grava; retorna só os novos."""
+    info.setdefault('codes', [])
+    novos = []
+    for p in payloads:
+        if p not in info['codes']:
+            info['codes'].append(p)
+            novos.append(p)
+    if novos:
+        notificador.sinalizar(aid)
+        barramento.publicar(aid, info.get('user_id'), 'sms', {"aid": aid, "sms": novos, "codes": list(info['codes'])})
+        registrar_sms_recebido(aid)
+        persistir_ativacao(aid, info)
+    return novos
+
+def finalizar_ativacao(aid, estado):
+    """Cancelada/expirada: encerra as tarefas do agendador e grava o estado final."""
+    agendador.cancelar(aid)
+    info = status_map.get(aid)
+    if info is not None:
+        info['estado'] = estado
+        notificador.sinalizar(aid)
+        barramento.publicar(aid, info.get('user_id'), 'status', {"aid": aid, "status": ESTADO_API.get(estado, estado)})
+        persistir_ativacao(aid, info, estado=estado)
+
+def reidratar_ativacoes():
+    """Startup: recarrega status_map do banco e reagenda polling/contagem/expiração."""
+    try:
+        with get_db_conn() as conn, conn.cursor() as cur:
+            cur.execute("""
+                SELECT aid, estado, dados FROM ativacoes
+                WHERE atualizado_em > NOW() - (%s * INTERVAL '1 second')
+            """, (ATIVACOES_RETENCAO_SEC,))
+            rows = cur.fetchall()
+    except Exception as e:
+        logger.error(f"[ativacoes] erro ao reidratar: {e}")
+        return
+    agora = time.time()
+    reagendadas = 0
+    for r in rows:
+        aid, info = r['aid'], r['dados']
+        info.setdefault('codes', [])
+        info['estado'] = r['estado']
+        with status_lock:
+            if aid in status_map:
+                continue
+            status_map[aid] = info
+        if r['estado'] != 'ativa' or info.get('canceled_by_user'):
+            continue
+        if info.get('poll_ate', 0) > agora:
+            agendador.agendar(aid, 'poll', 0)
+        if info.get('expira_em'):
+            agendador.agendar(aid, 'expirar', max(0, info['expira_em'] - agora))
+            restante = info['expira_em'] - agora
+            if restante > 60 and info.get('message_id') and not info['codes']:
+                info['countdown_n'] = max(0, PRAZO_MINUTOS - int(restante // 60) - 1)
+                agendador.agendar(aid, 'countdown', restante % 60)
+        reagendadas += 1
+    logger.info(f"[ativacoes] {len(rows)} ativações reidratadas, {reagendadas} reagendadas")
+
+def iniciar_polling(aid):
+    """(Re)inicia o polling do AID; substitui qualquer poller anterior."""
     with status_lock:
         info = status_map.get(aid)
     if not info:
         return
+    info.setdefault('codes', [])
+    info['canceled_by_user'] = False
+    info['poll_ate'] = time.time() + PRAZO_SEGUNDOS
+    persistir_ativacao(aid, info)
+    agendador.agendar(aid, 'poll', 0)
 
+def _tick_polling(aid):
+    info = status_map.get(aid)
+    if not info or time.time() > info.get('poll_ate', 0):
+        return None
     provider = info.get('provider', 'smsbower')
-    service  = info['service']
-    full     = info['full']
-    short    = info['short']
-    chat_id  = info['chat_id']
-    msg_id   = info.get('sms_message_id')
     service_key = info.get('service_key', 'outros')
-    info.setdefault('codes', [])
-    info['canceled_by_user'] = False
+    # Se já chegou SMS via webhook, não precisa polling
+    if provider == 'smsbower' and info.get("codes"):
+        return None
+    status = obter_status(aid, provider)
+    if info.get('canceled_by_user'):
+        return None
+    if not status or status.startswith('STATUS_WAIT'):
+        return POLL_INTERVALO_SEC
+    if status == 'STATUS_CANCEL':
+        finalizar_ativacao(aid, 'cancelada')
+        if not info['codes']:
+            ok = marcar_cancelado_e_devolver(info['user_id'], aid)
+            if info.get("is_api"):
+                logger.info(f"[API] STATUS_CANCEL devolveu saldo: AID {aid}")
+                return None
+            if ok:
+                tg_enviar(info['chat_id'], f"❌ Cancelado pelo provider. R${info['price']:.2f} devolvido.")
+        return None
 
-    def check_sms():
-        start = time.time()
-        while time.time() - start < PRAZO_SEGUNDOS:
-            # Se já chegou SMS via webhook, não precisa polling
-            if provider == 'smsbower' and info.get("codes"):
-                return
-            status = obter_status(aid, provider)
-            if info['canceled_by_user']:
-                return
-            if not status or status.startswith('STATUS_WAIT'):
-                time.sleep(5)
-                continue
-            if status == 'STATUS_CANCEL':
-                if not info['codes']:
-                    ok = marcar_cancelado_e_devolver(info['user_id'], aid)
-                    if info.get("is_api"):
-                        logger.info(f"[API] STATUS_CANCEL devolveu saldo: AID {aid}")
-                        return
-                    if ok:
-                        bot.send_message(chat_id, f"❌ Cancelado pelo provider. R${info['price']:.2f} devolvido.")
-                return
+    payload = status.split(':', 1)[1] if ':' in status else status
 
-            payload = status.split(':', 1)[1] if ':' in status else status
-            display = payload
+    if adicionar_codigos(aid, info, extrair_codigos(service_key, payload)):
+        if not info.get('is_api'):
+            _notificar_codigos_telegram(aid, info)
 
-            codes_added = False
+    return POLL_INTERVALO_SEC
 
-            # Tratamento especial: SMS para China 3 → extrair só dígitos com 4+ caracteres
-            if service_key == "outros":
-                payloads = [payload.strip()]
-            else:
-                payloads = [n for n in re.findall(r"\d+", payload) if len(n) >= 4]
-
-            codes_added = False
-            for p in payloads:
-                if p not in info['codes']:
-                    info['codes'].append(p)
-                    codes_added = True
-
-            if codes_added:
-                registrar_sms_recebido(aid)
-                rt = datetime.now().strftime('%d/%m/%Y %H:%M:%S')
-                text = (
-                    f"📦 {service}\n"
-                    f"☎️ Número: `{full}`\n"
-                    f"☎️ Sem DDI: `{short}`\n\n"
-                )
-                for idx, cd in enumerate(info['codes'], 1):
-                    text += f"📩 SMS{idx}: `{cd}`\n"
-                text += f"🕘 {rt}"
-                kb = telebot.types.InlineKeyboardMarkup()
-                kb.row(telebot.types.InlineKeyboardButton('📲 Receber outro SMS', callback_data=f'retry_{aid}'))
-                kb.row(telebot.types.InlineKeyboardButton('🛒 Comprar mesmo serviço', callback_data=f'comprar_{service_key}'))
-                kb.row(
-                    telebot.types.InlineKeyboardButton('📲 Comprar serviços', callback_data='menu_comprar'),
-                    telebot.types.InlineKeyboardButton('📜 Menu', callback_data='menu')
-                )
-                try:
-                    if msg_id:
-                        bot.edit_message_text(text, chat_id, msg_id, parse_mode='Markdown', reply_markup=kb)
-                    else:
-                        m = bot.send_message(chat_id, text, parse_mode='Markdown', reply_markup=kb)
-                        info['sms_message_id'] = m.message_id
-                except telebot.apihelper.ApiTelegramException as e:
-                    if "message is not modified" not in str(e):
-                        raise
-                except Exception:
-                    pass
+_sms_msg_lock = threading.Lock()
+_sms_msg_pendente = {}   # aid -> (texto, kb) mais recente enquanto a 1ª mensagem de código não volta
+
+def _log_falha_sms(aid):
+    def _cb(f):
+        e = f.exception()
+        if e is not None and "message is not modified" not in str(e):
+            logger.error(f"[SMS] falha ao atualizar código do AID {aid}: {e}")
+    return _cb
 
-            time.sleep(5)
+def _notificar_codigos_telegram(aid, info, rt=None):
+    service_key = info.get('service_key', 'outros')
+    rt = rt or datetime.now().strftime('%d/%m/%Y %H:%M:%S')
+    text = (
+        f"📦 {info['service']}\n"
+        f"☎️ Número: `{info['full']}`\n"
+        f"☎️ Sem DDI: `{info['short']}`\n\n"
+    )
+    for idx, cd in enumerate(info['codes'], 1):
+        text += f"📩 SMS{idx}: `{cd}`\n"
+    text += f"🕘 {rt}"
+    kb = telebot.types.InlineKeyboardMarkup()
+    kb.row(telebot.types.InlineKeyboardButton('📲 Receber outro SMS', callback_data=f'retry_{aid}'))
+    kb.row(telebot.types.InlineKeyboardButton('🛒 Comprar mesmo serviço', callback_data=f'comprar_{service_key}'))
+    kb.row(
+        telebot.types.InlineKeyboardButton('📲 Comprar serviços', callback_data='menu_comprar'),
+        telebot.types.InlineKeyboardButton('📜 Menu', callback_data='menu')
+    )
+    # código SMS tem a maior prioridade na fila de saída; nada aqui espera o
+    # envio (roda em worker do agendador / no webhook do provider)
+    with _sms_msg_lock:
+        if aid in _sms_msg_pendente:
+            # 1ª mensagem ainda sem message_id: edita com o texto mais novo quando voltar
+            _sms_msg_pendente[aid] = (text, kb)
+            return
+        msg_id = info.get('sms_message_id')
+        if not msg_id:
+            _sms_msg_pendente[aid] = None
+    if msg_id:
+        tg_editar(info['chat_id'], msg_id, text, prioridade=PRIO_SMS,
+                  parse_mode='Markdown', reply_markup=kb).add_done_callback(_log_falha_sms(aid))
+        return
+
+    def _apos_enviar(f):
+        e = f.exception()
+        with _sms_msg_lock:
+            pendente = _sms_msg_pendente.pop(aid, None)
+            if e is None:
+                info['sms_message_id'] = f.result().message_id
+        if e is not None:
+            logger.error(f"[SMS] falha ao enviar código do AID {aid}: {e}")
+        elif pendente:
+            tg_editar(info['chat_id'], info['sms_message_id'], pendente[0], prioridade=PRIO_SMS,
+                      parse_mode='Markdown', reply_markup=pendente[1]).add_done_callback(_log_falha_sms(aid))
+    tg_enviar(info['chat_id'], text, prioridade=PRIO_SMS,
+              parse_mode='Markdown', reply_markup=kb).add_done_callback(_apos_enviar)
+
+def _tick_countdown(aid):
+    info = status_map.get(aid)
+    if not info or info.get('mensagem_falhou'):
+        return None
+    if not info.get('message_id'):
+        return 60   # mensagem da compra ainda na fila de saída
+
+    # BLOQUEIA EDIÇÃO SE JÁ RECEBEU SMS
+    if info.get('codes'):
+        return None
+    minute = info.get('countdown_n', 0)
+    info['countdown_n'] = minute + 1
+    rem = PRAZO_MINUTOS - (minute + 1)
+    kb_blocked, kb_unlocked = teclados_ativacao(aid, info['service_key'])
+    kb_sel = kb_blocked if minute < 2 else kb_unlocked
+    fut = tg_editar(
+        info['chat_id'],
+        info['message_id'],
+        texto_ativacao(aid, info, rem),
+        prioridade=PRIO_COUNTDOWN,
+        parse_mode='Markdown',
+        reply_markup=kb_sel
+    )
 
-    threading.Thread(target=check_sms, daemon=True).start()
+    def _apos_editar(f):
+        e = f.exception()
+        # mensagem sumida → para a contagem
+        if e is not None and ("message to edit not found" in str(e) or "message is not modified" in str(e)):
+            agendador.cancelar(aid, 'countdown')
+    fut.add_done_callback(_apos_editar)
+    return 60 if minute + 1 < PRAZO_MINUTOS else None
+
+def _tick_mensagem(aid):
+    """Depois do envio da mensagem da compra: grava o message_id ou desfaz a compra."""
+    info = status_map.get(aid)
+    if not info:
+        return None
+    if not info.get('mensagem_falhou'):
+        persistir_ativacao(aid, info)
+        return None
+    # o usuário nunca viu o número: cancela no provider e devolve
+    if info.get('codes') or info.get('canceled_by_user'):
+        return None
+    logger.error(f"[COMPRA] mensagem do AID {aid} não enviada ({info['mensagem_falhou']}); cancelando e devolvendo")
+    info['canceled_by_user'] = True
+    finalizar_ativacao(aid, 'cancelada')
+    cancelar_numero(aid, provider=info.get('provider', 'smsbower'))
+    if marcar_cancelado_e_devolver(info['user_id'], aid):
+        tg_enviar(info['chat_id'], f"❌ Falha ao entregar o número. R${info['price']:.2f} devolvido.")
+    return None
+
+def _expirar_ativacao(aid):
+    info = status_map.get(aid)
+    if info and not info.get('codes') and not info.get('canceled_by_user'):
+        finalizar_ativacao(aid, 'expirada')
+        cancelar_numero(aid, provider=info.get('provider', 'smsbower'))
+        ok2 = marcar_cancelado_e_devolver(info['user_id'], aid)
+        if info.get("is_api"):
+            # salvar log opcional
+            logger.info(f"[API] Cancelamento automático devolveu saldo para {info['user_id']} (AID: {aid})")
+            return None
+        if ok2:
+            try: bot.delete_message(info['chat_id'], info['message_id'])
+            except: pass
+    return None
+
+agendador.registrar('poll', _tick_polling)
+agendador.registrar('countdown', _tick_countdown)
+agendador.registrar('expirar', _expirar_ativacao)
+agendador.registrar('mensagem', _tick_mensagem)
+
+reidratar_ativacoes()
 
 @bot.callback_query_handler(lambda c: c.data.startswith('retry_'))
 def retry_sms(c):
@@ -2165,19 +4288,12 @@ def retry_sms(c):
     info = status_map.get(aid) or {}
     provider = info.get('provider', 'smsbower')
     if provider == 'smsbower':
-        try:
-            requests.get(
-                SMSBOWER_URL,
-                params={'api_key':API_KEY_SMSBOWER,'action':'setStatus','status':'3','id':aid},
-                timeout=10
-            )
-        except:
-            pass
+        smsbower_api.set_status(aid, 3)
         bot.answer_callback_query(c.id, '🔄 Novo SMS solicitado.', show_alert=True)
     else:
-        set_status_sms24h(aid, 3)
+        sms24h_api.set_status(aid, 3)
         bot.answer_callback_query(c.id, '🔄 Novo SMS solicitado.', show_alert=True)
-    spawn_sms_thread(aid)
+    iniciar_polling(aid)
 
 @bot.callback_query_handler(lambda c: c.data.startswith('cancel_blocked_'))
 def cancel_blocked(c):
@@ -2192,6 +4308,7 @@ def cancelar_user(c):
     if info.get('canceled_by_user'):
         return bot.answer_callback_query(c.id, '❌ Já cancelado.', True)
     info['canceled_by_user'] = True
+    finalizar_ativacao(aid, 'cancelada')
     provider = info.get('provider', 'smsbower')
     cancelar_numero(aid, provider)
     ok = marcar_cancelado_e_devolver(info['user_id'], aid)
@@ -2205,33 +4322,30 @@ def cancelar_user(c):
 # =========================================================
 # ================== PAINEL ADMIN (ATUALIZADO) ============
 # =========================================================
+ERRO_SALVAR_CONFIG = "❌ Erro ao gravar a configuração no banco; nada foi alterado. Tente de novo."
+
 @app.route('/admin', methods=['GET', 'POST'])
 def painel_admin():
     token = request.args.get('token', '')
     if token != PAINEL_TOKEN:
         return "Acesso negado.", 401
 
-    global SCANNER_ENABLED
-    global SERVICE_PRICES, SERVICE_EMOJIS
-    global SMSBOWER_MAX_PRICE_CAP, S1_CAPS
-
     msg_feedback = ""
     if request.method == 'POST':
         action = request.form.get('action')
         if action == 'enviar_mensagem':
             texto = request.form.get('texto')
             if texto:
-                with get_db_conn() as conn:
-                    with conn.cursor() as cur:
-                        cur.execute("SELECT id FROM usuarios")
-                        uids = [row['id'] for row in cur.fetchall()]
-                enviados = 0
-                for uid in uids:
-                    try:
-                        bot.send_message(int(uid), texto)
-                        enviados += 1
-                    except: pass
-                msg_feedback = f'Mensagem enviada para {enviados} usuários.'
+                job_id, total = criar_broadcast(texto)
+                msg_feedback = f'Broadcast #{job_id} agendado para {total} usuários.'
+        elif action == 'cancelar_broadcast':
+            job_id = (request.form.get('job_id') or '').strip()
+            if not job_id.isdigit():
+                msg_feedback = 'ID de broadcast inválido.'
+            elif cancelar_broadcast(int(job_id)):
+                msg_feedback = f'Broadcast #{job_id} cancelado.'
+            else:
+                msg_feedback = 'Broadcast não encontrado ou já finalizado.'
         elif action == 'adicionar_saldo':
             val = float(request.form.get('valor', '0'))
             todos = request.form.get('todos')
@@ -2239,64 +4353,71 @@ def painel_admin():
             with get_db_conn() as conn:
                 with conn.cursor() as cur:
                     if todos:
-                        cur.execute("UPDATE usuarios SET saldo=saldo+%s", (val,))
+                        cur.execute("""
+                            INSERT INTO saldo_lancamentos (user_id, valor_centavos, tipo)
+                            SELECT id, %s, 'admin' FROM usuarios
+                        """, (centavos(val),))
                         conn.commit()
                         msg_feedback = f"Saldo de R$ {val:.2f} adicionado a TODOS os usuários."
                     elif uid:
-                        cur.execute("UPDATE usuarios SET saldo=saldo+%s WHERE id=%s", (val, str(uid)))
+                        lancar_saldo(cur, uid, val, 'admin')
                         conn.commit()
                         msg_feedback = f"Saldo de R$ {val:.2f} adicionado ao usuário {uid}."
-            exportar_backup_json()
+            agendar_backup()
 
         elif action == 'scanner_onoff':
             op = request.form.get('op')
-            if op == 'on':
-                SCANNER_ENABLED = True
-                msg_feedback = "Scanner China 2 LIGADO."
-            elif op == 'off':
-                SCANNER_ENABLED = False
-                msg_feedback = "Scanner China 2 DESLIGADO."
+            if op in ('on', 'off'):
+                if salvar_config('scanner_enabled', op == 'on'):
+                    msg_feedback = f"Scanner China 2 {'LIGADO' if op == 'on' else 'DESLIGADO'}."
+                else:
+                    msg_feedback = ERRO_SALVAR_CONFIG
             else:
                 msg_feedback = "Opção inválida para o scanner."
 
         elif action == 'china2_manual':
             manual_code = (request.form.get('manual_code') or '').strip()
-            if manual_code:
-                set_china2_service_code(manual_code, reason="(manual via painel)")
+            if not manual_code:
+                msg_feedback = "Informe um código de serviço válido (ex.: ki, ev, ...)."
+            elif set_china2_service_code(manual_code, reason="(manual via painel)"):
                 msg_feedback = f"China 2 definido manualmente para '{manual_code}'."
             else:
-                msg_feedback = "Informe um código de serviço válido (ex.: ki, ev, ...)."
+                msg_feedback = ERRO_SALVAR_CONFIG
 
         elif action == 'update_prices':
             changed = []
-            for key in SERVICE_PRICES.keys():
+            novos = dict(SERVICE_PRICES)
+            for key in novos.keys():
                 field = f"price_{key}"
                 if field in request.form:
                     val_str = (request.form.get(field) or "").strip()
                     if val_str:
                         try:
                             new_val = float(val_str)
-                            SERVICE_PRICES[key] = new_val
+                            novos[key] = new_val
                             changed.append(f"{SERVICE_NAMES.get(key, key)} → R${new_val:.2f}")
                         except:
                             pass
-            if changed:
-                save_prices_emojis_to_db()
+            if changed and not salvar_config('service_prices', novos):
+                msg_feedback = ERRO_SALVAR_CONFIG
+            elif changed:
                 msg_feedback = "Preços atualizados:\n" + "\n".join(changed)
             else:
                 msg_feedback = "Nenhum preço alterado."
 
         elif action == 'update_emojis':
             changed = []
-            for key in SERVICE_EMOJIS.keys():
+            novos = dict(SERVICE_EMOJIS)
+            for key in novos.keys():
                 field = f"emoji_{key}"
                 if field in request.form:
                     val_str = (request.form.get(field) or "").strip()
                     if val_str:
-                        SERVICE_EMOJIS[key] = val_str
+                        novos[key] = val_str
                         changed.append(f"{SERVICE_NAMES.get(key, key)} → {val_str}")
-            if changed:
-                save_prices_emojis_to_db()
+            if changed and not salvar_config('service_emojis', novos):
+                msg_feedback = ERRO_SALVAR_CONFIG
+            elif changed:
                 msg_feedback = "Emojis atualizados:\n" + "\n".join(changed)
             else:
                 msg_feedback = "Nenhum emoji alterado."
@@ -2307,16 +4428,18 @@ def painel_admin():
                 new_cap = float(val_str)
                 if new_cap <= 0:
                     raise ValueError()
-                SMSBOWER_MAX_PRICE_CAP = new_cap
-                save_smsg_cap_to_db()
-                msg_feedback = f"Limite máximo GLOBAL do SMSBower atualizado para US$ {SMSBOWER_MAX_PRICE_CAP:.4f}"
+                if salvar_config('smsbower_max_price_cap', new_cap):
+                    msg_feedback = f"Limite máximo GLOBAL do SMSBower atualizado para US$ {new_cap:.4f}"
+                else:
+                    msg_feedback = ERRO_SALVAR_CONFIG
             except:
                 msg_feedback = "Valor inválido para CAP global do SMSBower."
 
         # >>> NOVO: atualizar caps por serviço (Servidor 1)
         elif action == 'update_s1_caps':
             changed = []
-            for key in DEFAULT_S1_CAPS.keys():
+            novos = dict(S1_CAPS)
+            for key in S1_CAPS.keys():
                 field = f"cap_{key}"
                 if field in request.form:
                     vs = (request.form.get(field) or "").strip()
@@ -2325,28 +4448,25 @@ def painel_admin():
                             val = float(vs)
                             if val <= 0:
                                 continue
-                            S1_CAPS[key] = val
+                            novos[key] = val
                             changed.append(f"{SERVICE_NAMES.get(key, key)} → US$ {val:.4f}")
                         except:
                             pass
-            if changed:
-                save_s1_caps_to_db()
+            if changed and not salvar_config('smsbower_service_caps', novos):
+                msg_feedback = ERRO_SALVAR_CONFIG
+            elif changed:
                 msg_feedback = "Limites por serviço (Servidor 1) atualizados:\n" + "\n".join(changed)
             else:
                 msg_feedback = "Nenhum limite por serviço alterado."
 
-    with get_db_conn() as conn:
-        with conn.cursor() as cur:
-            cur.execute("SELECT count(*) FROM numeros_sms")
-            total = cur.fetchone()['count']
-            cur.execute("SELECT count(*) FROM numeros_sms WHERE cancelado=TRUE")
-            cancelados = cur.fetchone()['count']
-            cur.execute("SELECT count(*) FROM numeros_sms WHERE sms_recebido=TRUE")
-            recebidos = cur.fetchone()['count']
+    totais, stats_servico, stats_dia = resumo_estatisticas()
+    total, cancelados, recebidos = totais['total'], totais['cancelados'], totais['recebidos']
 
     with SERVICE_CODE_LOCK:
         china2_code = GLOBAL_SERVICE_MAP.get('china2')
 
+    broadcasts = listar_broadcasts()
+
     items_sorted = sorted(SERVICE_PRICES.items(), key=lambda kv: SERVICE_NAMES.get(kv[0], kv[0]).lower())
 
     return render_template_string("""
@@ -2359,6 +4479,32 @@ def painel_admin():
             <button type="submit">Enviar Mensagem</button>
         </form>
 
+        {% if broadcasts %}
+        <table border="1" cellpadding="6" cellspacing="0">
+            <tr><th>#</th><th>Status</th><th>Progresso</th><th>Enviados</th><th>Falhas</th><th>Bloqueados</th><th>ETA</th><th></th></tr>
+            {% for b in broadcasts %}
+            <tr>
+                <td>{{ b.id }}</td>
+                <td>{{ b.status }}</td>
+                <td>{{ b.processados }}/{{ b.total }} ({{ b.pct }}%)</td>
+                <td>{{ b.enviados }}</td>
+                <td>{{ b.falhas }}</td>
+                <td>{{ b.bloqueados }}</td>
+                <td>{{ b.eta or '-' }}</td>
+                <td>
+                    {% if b.status in ('pendente', 'executando') %}
+                    <form method="post" style="margin:0">
+                        <input type="hidden" name="action" value="cancelar_broadcast">
+                        <input type="hidden" name="job_id" value="{{ b.id }}">
+                        <button type="submit">Cancelar</button>
+                    </form>
+                    {% endif %}
+                </td>
+            </tr>
+            {% endfor %}
+        </table>
+        {% endif %}
+
         <form method=post>
             <h3>Adicionar saldo</h3>
             <input type="hidden" name="action" value="adicionar_saldo">
@@ -2372,6 +4518,10 @@ def painel_admin():
         <h3>Scanner China 2</h3>
         <p>Status: <b>{{ 'Ligado' if scanner_enabled else 'Desligado' }}</b></p>
         <p>Serviço China 2 atual: <code>{{ china2_code }}</code></p>
+        {% if scanner_stats.duracao_s is not none %}
+        <p>Última varredura: {{ scanner_stats.consultados }} serviços em {{ scanner_stats.duracao_s }}s
+           ({{ scanner_stats.erros }} erros, {{ scanner_stats.candidatos }} candidatos)</p>
+        {% endif %}
         <form method="post" style="display:inline-block; margin-right: 10px;">
             <input type="hidden" name="action" value="scanner_onoff">
             <input type="hidden" name="op" value="{{ 'off' if scanner_enabled else 'on' }}">
@@ -2454,28 +4604,548 @@ def painel_admin():
             <li>Números cancelados: {{cancelados}}</li>
             <li>Números que receberam SMS: {{recebidos}}</li>
         </ul>
-    """, msg_feedback=msg_feedback, total=total, cancelados=cancelados, recebidos=recebidos,
-       scanner_enabled=SCANNER_ENABLED, china2_code=china2_code,
+        <h4>Por serviço</h4>
+        <table border="1" cellpadding="6" cellspacing="0">
+            <tr><th>Serviço</th><th>Vendidos</th><th>Cancelados</th><th>Receberam SMS</th></tr>
+            {% for r in stats_servico %}
+            <tr><td>{{ service_names.get(r.service_key, r.service_key) }}</td><td>{{ r.vendidos }}</td><td>{{ r.cancelados }}</td><td>{{ r.recebidos }}</td></tr>
+            {% endfor %}
+        </table>
+        <h4>Últimos 7 dias</h4>
+        <table border="1" cellpadding="6" cellspacing="0">
+            <tr><th>Dia</th><th>Vendidos</th><th>Cancelados</th><th>Receberam SMS</th></tr>
+            {% for r in stats_dia %}
+            <tr><td>{{ r.dia.strftime('%d/%m') }}</td><td>{{ r.vendidos }}</td><td>{{ r.cancelados }}</td><td>{{ r.recebidos }}</td></tr>
+            {% endfor %}
+        </table>
+    """, msg_feedback=msg_feedback, stats_servico=stats_servico, stats_dia=stats_dia, broadcasts=broadcasts, total=total, cancelados=cancelados, recebidos=recebidos,
+       scanner_enabled=SCANNER_ENABLED, china2_code=china2_code, scanner_stats=SCANNER_STATS,
        items_sorted=items_sorted, service_names=SERVICE_NAMES, service_emojis=SERVICE_EMOJIS,
        smsg_cap=SMSBOWER_MAX_PRICE_CAP,
        s1_caps=S1_CAPS,
-       s1_caps_labels=[
-           ('mercado', SERVICE_NAMES['mercado']),
-           ('china', SERVICE_NAMES['china']),
-           ('china2', SERVICE_NAMES['china2']),
-           ('picpay', SERVICE_NAMES['picpay']),
-           ('wa1', SERVICE_NAMES['wa1']),
-           ('outros', SERVICE_NAMES['outros']),
-           ('c6srv1', SERVICE_NAMES['c6srv1']),
-           ('google', SERVICE_NAMES['google']),
-           ('agibank', SERVICE_NAMES['agibank']),   # novo
-           ('app99', SERVICE_NAMES['app99']),       # novo
-       ])
+       s1_caps_labels=[(k, r.nome) for k, r in ROTAS_SERVICO.items() if r.provider == 'smsbower'])
+
+
+# =========================================================
+# ================ BROADCAST EM SEGUNDO PLANO =============
+# =========================================================
+# O job fica em broadcast_jobs; um worker por processo pega o job com
+# lease (SKIP LOCKED), envia em lotes pela fila de saída (prioridade mais
+# baixa) e grava cursor + contadores a cada lote. Se o processo cair, a
+# lease expira e o job é retomado do cursor.
+BROADCAST_LOTE      = int(os.getenv("BROADCAST_LOTE", "100"))
+BROADCAST_LEASE_SEC = int(os.getenv("BROADCAST_LEASE_SEC", "120"))
+_broadcast_wake = threading.Event()
+
+def criar_broadcast(texto):
+    with get_db_conn() as conn, conn.cursor() as cur:
+        cur.execute("SELECT count(*) FROM usuarios WHERE NOT COALESCE(bloqueado, FALSE)")
+        total = cur.fetchone()['count']
+        cur.execute("INSERT INTO broadcast_jobs (texto, total) VALUES (%s, %s) RETURNING id", (texto, total))
+        job_id = cur.fetchone()['id']
+        conn.commit()
+    _broadcast_wake.set()
+    return job_id, total
+
+def cancelar_broadcast(job_id):
+    with get_db_conn() as conn, conn.cursor() as cur:
+        cur.execute("""
+            UPDATE broadcast_jobs SET status='cancelado', concluido_em=NOW()
+            WHERE id=%s AND status IN ('pendente', 'executando')
+        """, (int(job_id),))
+        ok = cur.rowcount > 0
+        conn.commit()
+    return ok
+
+def listar_broadcasts(limite=5):
+    with get_db_conn() as conn, conn.cursor() as cur:
+        cur.execute("""
+            SELECT id, status, total, enviados, falhas, bloqueados,
+                   EXTRACT(EPOCH FROM (COALESCE(concluido_em, NOW()) - iniciado_em)) AS decorrido
+            FROM broadcast_jobs ORDER BY id DESC LIMIT %s
+        """, (limite,))
+        jobs = cur.fetchall()
+    for j in jobs:
+        j['processados'] = j['enviados'] + j['falhas'] + j['bloqueados']
+        j['pct'] = int(100 * j['processados'] / j['total']) if j['total'] else 100
+        j['eta'] = None
+        decorrido = float(j['decorrido'] or 0)
+        if j['status'] == 'executando' and j['processados'] and decorrido > 0:
+            restante = max(0, j['total'] - j['processados'])
+            j['eta'] = f"{int(restante * decorrido / j['processados'])}s"
+    return jobs
+
+def _pegar_broadcast():
+    with get_db_conn() as conn, conn.cursor() as cur:
+        cur.execute("""
+            UPDATE broadcast_jobs
+            SET status='executando',
+                iniciado_em=COALESCE(iniciado_em, NOW()),
+                lease_ate=NOW() + (%s * INTERVAL '1 second')
+            WHERE id = (
+                SELECT id FROM broadcast_jobs
+                WHERE status IN ('pendente', 'executando')
+                  AND (lease_ate IS NULL OR lease_ate < NOW())
+                ORDER BY id
+                LIMIT 1
+                FOR UPDATE SKIP LOCKED
+            )
+            RETURNING id, texto, cursor
+        """, (BROADCAST_LEASE_SEC,))
+        job = cur.fetchone()
+        conn.commit()
+    return job
+
+def _chat_bloqueou_bot(e):
+    if not isinstance(e, telebot.apihelper.ApiTelegramException):
+        return False
+    desc = str(e).lower()
+    return e.error_code == 403 or "chat not found" in desc or "user is deactivated" in desc
+
+def _renovar_lease_broadcast(job_id):
+    with get_db_conn() as conn, conn.cursor() as cur:
+        cur.execute("""
+            UPDATE broadcast_jobs SET lease_ate=NOW() + (%s * INTERVAL '1 second')
+            WHERE id=%s AND status='executando'
+        """, (BROADCAST_LEASE_SEC, job_id))
+        conn.commit()
+
+def _executar_broadcast(job):
+    job_id, texto, cursor = job['id'], job['texto'], job['cursor']
+    while True:
+        with get_db_conn() as conn, conn.cursor() as cur:
+            cur.execute("SELECT status FROM broadcast_jobs WHERE id=%s", (job_id,))
+            row = cur.fetchone()
+            if not row or row['status'] != 'executando':
+                return
+            cur.execute("""
+                SELECT id FROM usuarios
+                WHERE id > %s AND NOT COALESCE(bloqueado, FALSE)
+                ORDER BY id LIMIT %s
+            """, (cursor, BROADCAST_LOTE))
+            uids = [r['id'] for r in cur.fetchall()]
+        if not uids:
+            with get_db_conn() as conn, conn.cursor() as cur:
+                cur.execute("""
+                    UPDATE broadcast_jobs SET status='concluido', concluido_em=NOW(), lease_ate=NULL
+                    WHERE id=%s AND status='executando'
+                """, (job_id,))
+                conn.commit()
+            logger.info(f"[BROADCAST] #{job_id} concluído")
+            return
+
+        enviados, falhas, bloqueados = 0, 0, []
+        futs = []
+        for uid in uids:
+            try:
+                futs.append((uid, tg_enviar(int(uid), texto, prioridade=PRIO_BROADCAST)))
+            except ValueError:
+                falhas += 1
+        # um lote pode passar do lease (fila cheia, 429); renova enquanto espera
+        # para outro worker não assumir o job e reenviar
+        renovar_em = time.monotonic() + BROADCAST_LEASE_SEC / 3
+        for uid, f in futs:
+            if time.monotonic() >= renovar_em:
+                _renovar_lease_broadcast(job_id)
+                renovar_em = time.monotonic() + BROADCAST_LEASE_SEC / 3
+            try:
+                f.result(min(TG_RESULT_TIMEOUT, BROADCAST_LEASE_SEC / 3))
+                enviados += 1
+            except Exception as e:
+                if _chat_bloqueou_bot(e):
+                    bloqueados.append(uid)
+                else:
+                    falhas += 1
+        cursor = uids[-1]
+
+        with get_db_conn() as conn, conn.cursor() as cur:
+            if bloqueados:
+                cur.execute("UPDATE usuarios SET bloqueado=TRUE WHERE id = ANY(%s)", (bloqueados,))
+            cur.execute("""
+                UPDATE broadcast_jobs
+                SET cursor=%s, enviados=enviados+%s, falhas=falhas+%s, bloqueados=bloqueados+%s,
+                    lease_ate=NOW() + (%s * INTERVAL '1 second')
+                WHERE id=%s
+            """, (cursor, enviados, falhas, len(bloqueados), BROADCAST_LEASE_SEC, job_id))
+            conn.commit()
+
+def _broadcast_worker():
+    while True:
+        try:
+            job = _pegar_broadcast()
+            if job:
+                _executar_broadcast(job)
+                continue
+        except Exception as e:
+            logger.error(f"[BROADCAST] erro: {e}")
+        _broadcast_wake.wait(30)
+        _broadcast_wake.clear()
+
+threading.Thread(target=_broadcast_worker, name="broadcast-worker", daemon=True).start()
+
+# =========================================================
+# ================ WEBHOOKS DE CLIENTES ===================
+# =========================================================
+# O cliente registra uma URL por token (/api/webhook). Eventos sms / status /
+# refunded entram numa fila em memória (o barramento não espera banco) e uma
+# thread os grava em lote em webhook_entregas (sobrevivem a restart); um despachante pega as devidas com lease (SKIP LOCKED), envia
+# em paralelo limitado, assina com HMAC e reagenda falhas com backoff
+# exponencial. Cada URL tem seu Disjuntor: endpoint fora não ocupa os envios.
+WEBHOOK_WORKERS        = int(os.getenv("WEBHOOK_WORKERS", "8"))
+WEBHOOK_TIMEOUT        = float(os.getenv("WEBHOOK_TIMEOUT", "10"))
+WEBHOOK_MAX_TENTATIVAS = int(os.getenv("WEBHOOK_MAX_TENTATIVAS", "10"))
+WEBHOOK_BACKOFF_BASE   = float(os.getenv("WEBHOOK_BACKOFF_BASE", "5"))      # s, dobra a cada falha
+WEBHOOK_BACKOFF_MAX    = float(os.getenv("WEBHOOK_BACKOFF_MAX", "3600"))
+WEBHOOK_CACHE_TTL      = float(os.getenv("WEBHOOK_CACHE_TTL", "60"))
+WEBHOOK_RETENCAO_DIAS  = int(os.getenv("WEBHOOK_RETENCAO_DIAS", "7"))
+WEBHOOK_MAX_IDADE_SEC  = float(os.getenv("WEBHOOK_MAX_IDADE_SEC", str(24 * 3600)))  # adiada pelo disjuntor até aqui
+WEBHOOK_DISJUNTORES_MAX = int(os.getenv("WEBHOOK_DISJUNTORES_MAX", "2000"))
+WEBHOOK_EVENTOS        = ('sms', 'status', 'refunded')
+WEBHOOK_FILA_MAX       = int(os.getenv("WEBHOOK_FILA_MAX", "10000"))
+
+m_webhook_envio   = Histograma("client_webhook_request_seconds", "Duração do POST ao endpoint do cliente")
+m_webhook_atraso  = Histograma("client_webhook_delivery_seconds", "Do evento até a entrega confirmada",
+                               buckets=(0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 1800))
+m_webhook_result  = Contador("client_webhook_attempts_total", "Tentativas de entrega por resultado", ("resultado",))
+
+def validar_url_webhook(url):
+    """
+    None se a URL pode receber POST do servidor; senão o motivo. Resolve o
+    host e recusa loopback, link-local, rede privada e faixas reservadas
+    (evita SSRF contra 127.0.0.1, 169.254.169.254, 10/8...).
+    """
+    try:
+        partes = urllib.parse.urlsplit(url)
+        porta = partes.port or (443 if partes.scheme == 'https' else 80)
+    except ValueError:
+        return "url inválida"
+    if partes.scheme not in ('http', 'https') or not partes.hostname:
+        return "url inválida (use http:// ou https://)"
+    try:
+        enderecos = {info[4][0] for info in socket.getaddrinfo(partes.hostname, porta, proto=socket.IPPROTO_TCP)}
+    except (socket.gaierror, UnicodeError):
+        return "host não resolve"
+    for end in enderecos:
+        ip = ipaddress.ip_address(end.split('%', 1)[0])
+        if (ip.is_private or ip.is_loopback or ip.is_link_local or ip.is_reserved
+                or ip.is_multicast or ip.is_unspecified):
+            return "destino não permitido (endereço interno)"
+    return None
+
+class WebhooksClientes:
+    def __init__(self, workers):
+        self._cache = {}   # user_id -> (ts, (url, segredo) | None)
+        self._cache_lock = threading.Lock()
+        self._disjuntores = collections.OrderedDict()   # url -> Disjuntor (LRU)
+        self._disj_lock = threading.Lock()
+        self._livres = threading.BoundedSemaphore(workers)
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="client-webhook")
+        self._acordar = threading.Event()
+        self._entrada = queue.Queue(maxsize=WEBHOOK_FILA_MAX)   # eventos ainda não gravados
+        self.workers = workers
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=16, pool_maxsize=workers, max_retries=0)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self._ultima_limpeza = 0.0
+
+    # ---------- cadastro ----------
+    def destino(self, user_id):
+        user_id = str(user_id)
+        agora = time.time()
+        with self._cache_lock:
+            ent = self._cache.get(user_id)
+        if ent and agora - ent[0] < WEBHOOK_CACHE_TTL:
+            return ent[1]
+        with get_db_conn() as conn, conn.cursor() as cur:
+            cur.execute("SELECT url, segredo FROM api_webhooks WHERE user_id=%s", (user_id,))
+            row = cur.fetchone()
+        valor = (row['url'], row['segredo']) if row else None
+        with self._cache_lock:
+            self._cache[user_id] = (agora, valor)
+        return valor
+
+    def registrar(self, user_id, url):
+        segredo = secrets.token_hex(24)
+        with get_db_conn() as conn, conn.cursor() as cur:
+            cur.execute("""
+                INSERT INTO api_webhooks (user_id, url, segredo) VALUES (%s, %s, %s)
+                ON CONFLICT (user_id) DO UPDATE SET url=EXCLUDED.url, segredo=EXCLUDED.segredo, criado_em=NOW()
+            """, (str(user_id), url, segredo))
+            conn.commit()
+        with self._cache_lock:
+            self._cache[str(user_id)] = (time.time(), (url, segredo))
+        return segredo
+
+    def remover(self, user_id):
+        with get_db_conn() as conn, conn.cursor() as cur:
+            cur.execute("DELETE FROM api_webhooks WHERE user_id=%s", (str(user_id),))
+            cur.execute("""
+                UPDATE webhook_entregas SET status='descartado'
+                WHERE user_id=%s AND status='pendente'
+            """, (str(user_id),))
+            conn.commit()
+        with self._cache_lock:
+            self._cache[str(user_id)] = (time.time(), None)
+
+    # ---------- entrada (ouvinte do barramento) ----------
+    def ao_evento(self, aid, user_id, evento, dados):
+        # roda dentro de barramento.publicar (webhook SMS, polling, estorno):
+        # só enfileira, quem toca no banco é _gravar_loop
+        if evento not in WEBHOOK_EVENTOS or not user_id:
+            return
+        try:
+            self._entrada.put_nowait((aid, str(user_id), evento, dados, datetime.now().isoformat()))
+        except queue.Full:
+            m_webhook_result.inc("descartado")
+            logger.error(f"[WEBHOOK] fila de entrada cheia, evento {evento} de {aid} descartado")
+
+    def _gravar(self, itens):
+        linhas = []
+        for aid, user_id, evento, dados, ts in itens:
+            dest = self.destino(user_id)
+            if dest:
+                payload = {"event": evento, "aid": aid, "data": dados, "ts": ts}
+                linhas.append((user_id, dest[0], evento, json.dumps(payload)))
+        if not linhas:
+            return
+        with get_db_conn() as conn, conn.cursor() as cur:
+            cur.executemany("""
+                INSERT INTO webhook_entregas (user_id, url, evento, payload)
+                VALUES (%s, %s, %s, %s)
+            """, linhas)
+            conn.commit()
+        self._acordar.set()
+
+    def _gravar_loop(self):
+        while True:
+            itens = [self._entrada.get()]
+            while len(itens) < 200:
+                try:
+                    itens.append(self._entrada.get_nowait())
+                except queue.Empty:
+                    break
+            for tentativa in range(3):
+                try:
+                    self._gravar(itens)
+                    break
+                except Exception as e:
+                    logger.error(f"[WEBHOOK] erro ao gravar {len(itens)} eventos (tentativa {tentativa + 1}): {e}")
+                    time.sleep(1 + tentativa)
+            else:
+                m_webhook_result.inc("descartado", n=len(itens))
+
+    # ---------- saída ----------
+    def _disjuntor(self, url):
+        with self._disj_lock:
+            d = self._disjuntores.get(url)
+            if d is None:
+                d = self._disjuntores[url] = Disjuntor()
+                while len(self._disjuntores) > WEBHOOK_DISJUNTORES_MAX:
+                    self._disjuntores.popitem(last=False)
+            else:
+                self._disjuntores.move_to_end(url)
+            return d
+
+    def _pegar(self, n):
+        with get_db_conn() as conn, conn.cursor() as cur:
+            # lease: se o processo cair no meio, a linha volta a vencer sozinha
+            cur.execute("""
+                UPDATE webhook_entregas e
+                SET proxima_em = NOW() + (%s * INTERVAL '1 second')
+                FROM api_webhooks w
+                WHERE e.id IN (
+                    SELECT id FROM webhook_entregas
+                    WHERE status='pendente' AND proxima_em <= NOW()
+                    ORDER BY proxima_em
+                    LIMIT %s
+                    FOR UPDATE SKIP LOCKED
+                )
+                AND w.user_id = e.user_id
+                RETURNING e.id, e.url, e.evento, e.payload, e.tentativas,
+                          EXTRACT(EPOCH FROM e.criado_em) AS criado_ts, w.segredo
+            """, (WEBHOOK_TIMEOUT * 3, n))
+            rows = cur.fetchall()
+            conn.commit()
+        return rows
+
+    def _concluir(self, ent, ok, erro=None, adiar=None):
+        with get_db_conn() as conn, conn.cursor() as cur:
+            if ok:
+                cur.execute("""
+                    UPDATE webhook_entregas SET status='entregue', entregue_em=NOW(), tentativas=tentativas+1
+                    WHERE id=%s
+                """, (ent['id'],))
+            elif adiar is not None:
+                # disjuntor aberto: não conta tentativa, só espera (até a idade máxima)
+                cur.execute("""
+                    UPDATE webhook_entregas SET proxima_em = NOW() + (%s * INTERVAL '1 second'),
+                        status = CASE WHEN criado_em < NOW() - (%s * INTERVAL '1 second')
+                                      THEN 'falhou' ELSE status END,
+                        ultimo_erro = COALESCE(ultimo_erro, 'disjuntor aberto')
+                    WHERE id=%s
+                """, (adiar, WEBHOOK_MAX_IDADE_SEC, ent['id']))
+            else:
+                tent = ent['tentativas'] + 1
+                espera = min(WEBHOOK_BACKOFF_MAX, WEBHOOK_BACKOFF_BASE * (2 ** (tent - 1)))
+                espera *= random.uniform(0.8, 1.2)
+                cur.execute("""
+                    UPDATE webhook_entregas
+                    SET tentativas=%s, ultimo_erro=%s,
+                        status = CASE WHEN %s >= %s THEN 'falhou' ELSE 'pendente' END,
+                        proxima_em = NOW() + (%s * INTERVAL '1 second')
+                    WHERE id=%s
+                """, (tent, (erro or "")[:500], tent, WEBHOOK_MAX_TENTATIVAS, espera, ent['id']))
+            conn.commit()
+
+    def _entregar(self, ent):
+        disj, devendo = None, False   # devendo: permitir() liberou e falta sucesso/falha
+        try:
+            # revalida na entrega (o DNS pode ter mudado desde o cadastro), antes
+            # do disjuntor: uma sondagem meio-aberta nunca fica sem resultado
+            motivo = validar_url_webhook(ent['url'])
+            if motivo:
+                m_webhook_result.inc("bloqueado")
+                self._concluir(ent, False, motivo)
+                return
+            disj = self._disjuntor(ent['url'])
+            if not disj.permitir():
+                m_webhook_result.inc("disjuntor")
+                self._concluir(ent, False, adiar=max(1.0, disj.aberto_ate - time.time()))
+                return
+            devendo = True
+            corpo = json.dumps(ent['payload'], ensure_ascii=False).encode()
+            assinatura = hmac.new(ent['segredo'].encode(), corpo, hashlib.sha256).hexdigest()
+            t0 = time.perf_counter()
+            erro = None
+            try:
+                r = self.session.post(ent['url'], data=corpo, timeout=WEBHOOK_TIMEOUT, allow_redirects=False, headers={
+                    "Content-Type": "application/json",
+                    "X-Webhook-Event": ent['evento'],
+                    "X-Webhook-Id": str(ent['id']),
+                    "X-Webhook-Signature": f"sha256={assinatura}",
+                })
+                ok = 200 <= r.status_code < 300
+                if not ok:
+                    erro = f"HTTP {r.status_code}"
+            except requests.RequestException as e:
+                ok, erro = False, str(e)
+            m_webhook_envio.observar(time.perf_counter() - t0)
+            (disj.sucesso if ok else disj.falha)()
+            devendo = False
+            m_webhook_result.inc("ok" if ok else "erro")
+            if ok:
+                m_webhook_atraso.observar(max(0.0, time.time() - float(ent['criado_ts'])))
+            self._concluir(ent, ok, erro)
+        except Exception as e:
+            logger.error(f"[WEBHOOK] entrega {ent.get('id')}: {e}")
+            if devendo:
+                disj.falha()
+        finally:
+            self._livres.release()
+
+    def _limpar(self):
+        if time.time() - self._ultima_limpeza < 3600:
+            return
+        self._ultima_limpeza = time.time()
+        with get_db_conn() as conn, conn.cursor() as cur:
+            cur.execute("""
+                DELETE FROM webhook_entregas
+                WHERE status <> 'pendente' AND criado_em < NOW() - (%s * INTERVAL '1 day')
+            """, (WEBHOOK_RETENCAO_DIAS,))
+            conn.commit()
+
+    def loop(self):
+        while True:
+            livres = 0   # permissões em mãos que ainda não foram para um _entregar
+            try:
+                self._limpar()
+                # só pega o que cabe nos envios livres (nada fica preso em memória)
+                if self._livres.acquire(timeout=5):
+                    livres = 1
+                    while livres < self.workers and self._livres.acquire(blocking=False):
+                        livres += 1
+                if not livres:
+                    continue
+                rows = self._pegar(livres)
+                for ent in rows:
+                    self._pool.submit(self._entregar, ent)
+                    livres -= 1   # agora é de _entregar, que libera no finally
+                if rows:
+                    continue
+            except Exception as e:
+                logger.error(f"[WEBHOOK] erro no despachante: {e}")
+            finally:
+                # sobra (ou _pegar falhou): devolve, senão os envios secam
+                for _ in range(livres):
+                    self._livres.release()
+            self._acordar.wait(2)
+            self._acordar.clear()
+
+    def pendentes(self):
+        with get_db_conn() as conn, conn.cursor() as cur:
+            cur.execute("SELECT count(*) FROM webhook_entregas WHERE status='pendente'")
+            return cur.fetchone()['count']
+
+webhooks_clientes = WebhooksClientes(WEBHOOK_WORKERS)
+barramento.ouvintes.append(webhooks_clientes.ao_evento)
+threading.Thread(target=webhooks_clientes.loop, name="client-webhooks", daemon=True).start()
+threading.Thread(target=webhooks_clientes._gravar_loop, name="client-webhooks-entrada", daemon=True).start()
+
+@app.route('/api/webhook', methods=['POST'])
+def api_webhook():
+    data = request.json or {}
+    token = data.get("token")
+    url = (data.get("url") or "").strip()
+
+    if not token:
+        return {"error": "token é obrigatório"}, 400
+    user_id = autenticar_token(token)
+    if not user_id:
+        return {"error": "token inválido"}, 401
+
+    if not url:
+        webhooks_clientes.remover(user_id)
+        return {"status": "removed"}
+    if len(url) > 500:
+        return {"error": "url inválida (máx. 500 caracteres)"}, 400
+    motivo = validar_url_webhook(url)
+    if motivo:
+        return {"error": motivo}, 400
+    segredo = webhooks_clientes.registrar(user_id, url)
+    return {"status": "registered", "url": url, "secret": segredo}
 
 
 # =========================================================
 # =================== HEALTH / WEBHOOKS ===================
 # =========================================================
+Medidor("ativacoes_ativas", "Ativações em memória (status_map)", lambda: len(status_map))
+Medidor("db_pool_em_uso", "Conexões emprestadas do pool", lambda: db_pool_stats()["in_use"])
+Medidor("telegram_fila_pendentes", "Envios aguardando na fila de saída", lambda: despachante.pendentes())
+Medidor("agendador_pendentes", "Tarefas de ativação agendadas", lambda: agendador.pendentes())
+Medidor("api_wait_esperando", "Clientes presos em /api/wait", lambda: notificador.esperando())
+Medidor("api_stream_assinaturas", "Assinaturas abertas em /api/stream", lambda: barramento.assinantes())
+Medidor("client_webhook_pendentes", "Entregas de webhook aguardando envio", lambda: webhooks_clientes.pendentes())
+Medidor("telegram_log_fila", "Logs aguardando envio ao Telegram", lambda: handler.queue_depth())
+
+@app.before_request
+def _metrica_inicio():
+    request._t0_metrica = time.perf_counter()
+
+@app.after_request
+def _metrica_fim(resp):
+    t0 = getattr(request, "_t0_metrica", None)
+    rule = request.url_rule.rule if request.url_rule else None
+    if t0 is not None and rule and (rule.startswith("/api/") or rule.startswith("/webhook/")):
+        m_http_seg.observar(time.perf_counter() - t0, rule)
+    return resp
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    if METRICS_TOKEN and request.args.get('token') != METRICS_TOKEN:
+        return "Acesso negado", 403
+    return renderizar_metricas(), 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+
 @app.route('/', methods=['GET'])
 def health():
     return 'OK', 200
@@ -2487,70 +5157,180 @@ def telegram_webhook():
     bot.process_new_updates([upd])
     return '', 200
 
+# Webhook só grava o ID em mp_fila e responde; um worker busca o pagamento
+# e credita usuário + indicador + registro em payments numa transação só,
+# com o INSERT em payments (ON CONFLICT) como trava de idempotência.
+MP_FILA_LEASE_SEC     = int(os.getenv("MP_FILA_LEASE_SEC", "60"))
+MP_FILA_MAX_TENTATIVAS = int(os.getenv("MP_FILA_MAX_TENTATIVAS", "12"))
+MP_BONUS_INDICACAO    = 0.10
+_mp_fila_wake = threading.Event()
+
 @app.route('/webhook/mercadopago', methods=['POST'])
 def mp_webhook():
-    data = request.get_json() or {}
+    data = request.get_json(silent=True) or {}
     if data.get('type') == 'payment':
-        pid = data['data']['id']
+        pid = str((data.get('data') or {}).get('id') or '')
+        if not pid:
+            return '', 200
         try:
             with get_db_conn() as conn, conn.cursor() as cur:
-                cur.execute("SELECT 1 FROM payments WHERE id=%s", (str(pid),))
-                if cur.fetchone():
-                    return '', 200
-
-            resp = mp_client.payment().get(pid)['response']
-            if resp.get('status') == 'approved':
-                ext = resp.get('external_reference', '')
-                if ':' in ext:
-                    uid_str, amt_str = ext.split(':', 1)
-                    uid = int(uid_str)
-                    amt = float(amt_str)
-
-                    with get_db_conn() as conn, conn.cursor() as cur:
-                        cur.execute("INSERT INTO payments (id, raw) VALUES (%s, %s) ON CONFLICT DO NOTHING",
-                                    (str(pid), json.dumps(resp)))
-                        conn.commit()
+                # reenvio do MP: reabre a não ser que já tenha sido creditado
+                cur.execute("""
+                    INSERT INTO mp_fila (payment_id) VALUES (%s)
+                    ON CONFLICT (payment_id) DO UPDATE
+                    SET status='pendente', proxima_em=NOW(), tentativas=0
+                    WHERE mp_fila.status NOT IN ('processado', 'pendente')
+                """, (pid,))
+                conn.commit()
+            _mp_fila_wake.set()
+        except Exception as e:
+            # sem gravar, deixa o MP reenviar
+            logger.error(f"[MP] Erro ao enfileirar {pid}: {e}")
+            return '', 500
+    return '', 200
 
-                    user = carregar_usuario(uid)
-                    if user:
-                        current = user.get('saldo', 0.0)
-                        refid = user.get("refer")
-                        bonus = 0.0
-                        ref_text = ""
-                        if refid:
-                            ref_user = carregar_usuario(refid)
-                            if ref_user:
-                                bonus = round(amt * 0.10, 2)
-                                with get_db_conn() as conn, conn.cursor() as cur:
-                                    cur.execute("UPDATE usuarios SET saldo=saldo+%s WHERE id=%s", (bonus, str(refid)))
-                                    conn.commit()
-                                try:
-                                    bot.send_message(int(refid), f"🎉 Você ganhou R$ {bonus:.2f} de bônus pois seu indicado recarregou saldo!")
-                                except:
-                                    pass
-                                ref_text = f"\nIndicado por: {refid}\nBônus enviado: R$ {bonus:.2f}"
-
-                        with get_db_conn() as conn, conn.cursor() as cur:
-                            cur.execute("UPDATE usuarios SET saldo=saldo+%s WHERE id=%s", (amt, str(uid)))
-                            conn.commit()
-                        exportar_backup_json()
-                        bot.send_message(uid, f"✅ Recarga de R$ {amt:.2f} confirmada! Seu novo saldo é R$ {current + amt:.2f}")
-
-                        msg_dep = (
-                            f"💰 Novo DEPÓSITO\n"
-                            f"User: {uid}\n"
-                            f"Valor: R$ {amt:.2f}\n"
-                            f"Data: {datetime.now().strftime('%d/%m/%Y %H:%M:%S')}{ref_text}"
-                        )
-                        enviar_mensagem_bot(admin_bot, ADMIN_CHAT_ID, msg_dep)
-                        try:
-                            enviar_mensagem_bot(admin_bot, HIST_CHANNEL, msg_dep)
-                        except Exception as e:
-                            logger.error(f"Falha ao publicar no canal de histórico: {e}")
+def _pegar_mp_fila(n=10):
+    with get_db_conn() as conn, conn.cursor() as cur:
+        cur.execute("""
+            UPDATE mp_fila SET proxima_em = NOW() + (%s * INTERVAL '1 second'), tentativas = tentativas + 1
+            WHERE payment_id IN (
+                SELECT payment_id FROM mp_fila
+                WHERE status='pendente' AND proxima_em <= NOW()
+                ORDER BY proxima_em
+                LIMIT %s
+                FOR UPDATE SKIP LOCKED
+            )
+            RETURNING payment_id, tentativas
+        """, (MP_FILA_LEASE_SEC, n))
+        rows = cur.fetchall()
+        conn.commit()
+    return rows
+
+def _marcar_mp_fila(pid, status, erro=None, tentativas=0):
+    with get_db_conn() as conn, conn.cursor() as cur:
+        if status == 'pendente':
+            espera = min(3600, 10 * (2 ** max(0, tentativas - 1)))
+            cur.execute("""
+                UPDATE mp_fila SET ultimo_erro=%s, proxima_em = NOW() + (%s * INTERVAL '1 second'),
+                       status = CASE WHEN tentativas >= %s THEN 'falhou' ELSE 'pendente' END
+                WHERE payment_id=%s
+                RETURNING status
+            """, ((erro or '')[:500], espera, MP_FILA_MAX_TENTATIVAS, pid))
+            row = cur.fetchone()
+            if row and row['status'] == 'falhou':
+                log_admin(f"[MP] pagamento {pid} desistido após {tentativas} tentativas: {erro}")
+        else:
+            cur.execute("""
+                UPDATE mp_fila SET status=%s, ultimo_erro=%s, processado_em=NOW()
+                WHERE payment_id=%s
+            """, (status, erro, pid))
+        conn.commit()
+
+def creditar_pagamento_mp(pid, resp):
+    """
+    Uma transação: registra o pagamento (trava de idempotência), credita o
+    usuário e o bônus do indicador e fecha a fila. Retorna dict para as
+    notificações ou None se já tinha sido creditado / sem usuário.
+    """
+    ext = resp.get('external_reference', '') or ''
+    if ':' not in ext:
+        return None
+    uid_str, amt_str = ext.split(':', 1)
+    uid = str(int(uid_str))
+    amt = float(amt_str)
+    with get_db_conn() as conn, conn.cursor() as cur:
+        cur.execute("""
+            INSERT INTO payments (id, raw) VALUES (%s, %s)
+            ON CONFLICT (id) DO NOTHING
+            RETURNING id
+        """, (pid, json.dumps(resp)))
+        if not cur.fetchone():
+            cur.execute("UPDATE mp_fila SET status='processado', processado_em=NOW() WHERE payment_id=%s", (pid,))
+            conn.commit()
+            return None
+        cur.execute("""
+            SELECT u.refer, r.id AS ref_existe
+            FROM usuarios u LEFT JOIN usuarios r ON r.id = u.refer
+            WHERE u.id=%s
+        """, (uid,))
+        user = cur.fetchone()
+        resultado = None
+        if user:
+            lancar_saldo(cur, uid, amt, 'recarga', pid)
+            bonus, refid = 0.0, None
+            if user['refer'] and user['ref_existe']:
+                refid = user['refer']
+                bonus = round(amt * MP_BONUS_INDICACAO, 2)
+                lancar_saldo(cur, refid, bonus, 'bonus_indicacao', pid)
+            resultado = {"uid": uid, "amt": amt, "refid": refid, "bonus": bonus,
+                         "saldo": saldo_atual(uid, cur)}
+        else:
+            logger.error(f"[MP] pagamento {pid} aprovado para usuário inexistente {uid}")
+        cur.execute("UPDATE mp_fila SET status='processado', processado_em=NOW() WHERE payment_id=%s", (pid,))
+        conn.commit()
+    agendar_backup()
+    return resultado
+
+def _notificar_recarga(r):
+    ref_text = ""
+    if r["refid"]:
+        tg_enviar(int(r["refid"]), f"🎉 Você ganhou R$ {r['bonus']:.2f} de bônus pois seu indicado recarregou saldo!")
+        ref_text = f"\nIndicado por: {r['refid']}\nBônus enviado: R$ {r['bonus']:.2f}"
+    tg_enviar(int(r["uid"]), f"✅ Recarga de R$ {r['amt']:.2f} confirmada! Seu novo saldo é R$ {r['saldo']:.2f}")
+    msg_dep = (
+        f"💰 Novo DEPÓSITO\n"
+        f"User: {r['uid']}\n"
+        f"Valor: R$ {r['amt']:.2f}\n"
+        f"Data: {datetime.now().strftime('%d/%m/%Y %H:%M:%S')}{ref_text}"
+    )
+    enviar_mensagem_bot(admin_bot, ADMIN_CHAT_ID, msg_dep)
+    try:
+        enviar_mensagem_bot(admin_bot, HIST_CHANNEL, msg_dep)
+    except Exception as e:
+        logger.error(f"Falha ao publicar no canal de histórico: {e}")
+
+def _processar_mp(pid, tentativas):
+    try:
+        result = mp_client.payment().get(pid)
+    except Exception as e:
+        _marcar_mp_fila(pid, 'pendente', f"consulta MP: {e}", tentativas)
+        return
+    # o SDK não levanta em erro HTTP: devolve {"status": <http>, "response": {...}}
+    if result.get('status') != 200:
+        _marcar_mp_fila(pid, 'pendente', f"consulta MP: HTTP {result.get('status')} {result.get('response')}", tentativas)
+        return
+    resp = result.get('response') or {}
+    if resp.get('status') != 'approved':
+        # pendente/recusado: o MP notifica de novo quando mudar
+        _marcar_mp_fila(pid, 'ignorado', resp.get('status'))
+        return
+    try:
+        r = creditar_pagamento_mp(pid, resp)
+    except ValueError as e:
+        logger.error(f"[MP] external_reference inválida em {pid}: {e}")
+        _marcar_mp_fila(pid, 'ignorado', f"external_reference: {e}")
+        return
+    except Exception as e:
+        logger.error(f"[MP] Erro ao creditar {pid}: {e}")
+        _marcar_mp_fila(pid, 'pendente', str(e), tentativas)
+        return
+    if r:
+        _notificar_recarga(r)
 
+def _mp_fila_worker():
+    while True:
+        try:
+            rows = _pegar_mp_fila()
+            for row in rows:
+                _processar_mp(row['payment_id'], row['tentativas'])
+            if rows:
+                continue
         except Exception as e:
-            logger.error(f"[MP] Erro webhook: {e}")
-    return '', 200
+            logger.error(f"[MP] erro no worker: {e}")
+        _mp_fila_wake.wait(5)
+        _mp_fila_wake.clear()
+
+threading.Thread(target=_mp_fila_worker, name="mp-fila", daemon=True).start()
 
 # =========================================================
 # ================= SCANNER 20m (China 2) =================
@@ -2561,6 +5341,76 @@ SCANNER_MAX_PRICE = 0.100
 SCANNER_MIN_COUNT = 50
 SCANNER_COUNTRY_ID = "14"  # Brazil na resposta do getPricesByService
 
+SCANNER_CONCURRENCY = int(os.getenv("SCANNER_CONCURRENCY", "16"))
+SCANNER_MAX_SERVICE_ID = 1319
+
+# última varredura (exibida no painel / métricas)
+SCANNER_STATS = {"inicio": None, "duracao_s": None, "consultados": 0, "erros": 0, "candidatos": 0}
+
+def _consultar_servico_scanner(sid):
+    """(min_price, count) do Brasil para o serviceId, ou None. Levanta em erro de rede/JSON."""
+    r = smsbower_web._get('getPricesByService', {'serviceId': sid, 'withPopular': 'true', 'rank': 1})
+    payload = r.json()
+    services = payload.get("services") or {}
+    svc = services.get(str(sid))
+    if not svc:
+        return None
+    countries = (svc.get("countries") or {})
+    br = countries.get(SCANNER_COUNTRY_ID)  # "14"
+    if not br:
+        return None
+    min_price = br.get("min_price")
+    if min_price is None:
+        return None
+    try:
+        return float(min_price), br.get("count", 0)
+    except:
+        return None
+
+def varrer_china2():
+    """
+    Uma varredura completa com até SCANNER_CONCURRENCY requisições em paralelo.
+    Só consulta serviceIds que têm activate_org_code no services.json — os
+    demais nunca podiam ser escolhidos.
+    Retorna (min_price, service_id, activate_org_code, title, count) ou None.
+    """
+    with services_index_lock:
+        alvos = {
+            int(sid): si for sid, si in services_index.items()
+            if sid.isdigit() and 1 <= int(sid) <= SCANNER_MAX_SERVICE_ID and si.get("activate_org_code")
+        }
+    t0 = time.time()
+    erros = 0
+    candidatos = []
+    with ThreadPoolExecutor(max_workers=max(1, SCANNER_CONCURRENCY), thread_name_prefix="scanner") as ex:
+        futuros = {ex.submit(_consultar_servico_scanner, sid): sid for sid in alvos}
+        for fut in as_completed(futuros):
+            sid = futuros[fut]
+            try:
+                res = fut.result()
+            except Exception:
+                erros += 1
+                continue
+            if not res:
+                continue
+            mp, count = res
+            if count > SCANNER_MIN_COUNT and (SCANNER_MIN_PRICE <= mp <= SCANNER_MAX_PRICE):
+                si = alvos[sid]
+                title = si.get("title") or f"serviceId {sid}"
+                candidatos.append((mp, sid, si["activate_org_code"], title, count))
+    m_scanner_seg.observar(time.time() - t0)
+    SCANNER_STATS.update({
+        "inicio": t0,
+        "duracao_s": round(time.time() - t0, 2),
+        "consultados": len(alvos),
+        "erros": erros,
+        "candidatos": len(candidatos),
+    })
+    logger.info(f"[SCANNER] Varredura: {len(alvos)} serviços em {SCANNER_STATS['duracao_s']}s "
+                f"({erros} erros, {len(candidatos)} candidatos)")
+    # menor preço; empate fica com o menor serviceId (mesma ordem da varredura sequencial)
+    return min(candidatos, key=lambda c: (c[0], c[1])) if candidatos else None
+
 def scanner_loop():
     while True:
         try:
@@ -2569,46 +5419,7 @@ def scanner_loop():
                 time.sleep(SCANNER_INTERVAL_SEC)
                 continue
 
-            best = None  # (min_price, service_id, activate_org_code, title, count)
-            for sid in range(1, 1320):  # 1..1319
-                url = f"https://smsbower.org/activations/getPricesByService?serviceId={sid}&withPopular=true&rank=1"
-                try:
-                    r = requests.get(url, timeout=15)
-                    r.raise_for_status()
-                except Exception:
-                    continue
-                try:
-                    payload = r.json()
-                except Exception:
-                    continue
-                services = payload.get("services") or {}
-                svc = services.get(str(sid))
-                if not svc:
-                    continue
-                countries = (svc.get("countries") or {})
-                br = countries.get(SCANNER_COUNTRY_ID)  # "14"
-                if not br:
-                    continue
-                min_price = br.get("min_price")
-                count = br.get("count", 0)
-                if min_price is None:
-                    continue
-                try:
-                    mp = float(min_price)
-                except:
-                    continue
-                if count > SCANNER_MIN_COUNT and (SCANNER_MIN_PRICE <= mp <= SCANNER_MAX_PRICE):
-                    with services_index_lock:
-                        si = services_index.get(str(sid))
-                    if not si:
-                        title = f"serviceId {sid}"
-                        aoc = None
-                    else:
-                        title = si.get("title") or f"serviceId {sid}"
-                        aoc = si.get("activate_org_code")
-                    if aoc:
-                        if (best is None) or (mp < best[0]):
-                            best = (mp, sid, aoc, title, count)
+            best = varrer_china2()
 
             if best:
                 mp, sid, aoc, title, count = best
@@ -2625,6 +5436,8 @@ def scanner_loop():
 # ======================== MAIN ===========================
 # =========================================================
 if __name__ == '__main__':
+    # SIGTERM (deploy/restart no Render) → sys.exit para rodar os atexit (flush do backup)
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
     threading.Thread(target=scanner_loop, daemon=True).start()
     try:
         bot.remove_webhook()